@@ -2,7 +2,13 @@ CREATE USER ddd WITH PASSWORD 'asas';
 DROP USER ddd;
 SELECT VERSION();
 
+DROP TABLE IF EXISTS snakraws_rolluphourly;
+DROP TABLE IF EXISTS snakraws_rollupdaily;
+DROP TABLE IF EXISTS snakraws_watermarks;
+DROP TABLE IF EXISTS snakraws_profanityverdicts;
 DROP TABLE IF EXISTS snakraws_blacklist;
+DROP TABLE IF EXISTS snakraws_shorturlclicks;
+DROP TABLE IF EXISTS snakraws_visitorsketches;
 DROP TABLE IF EXISTS snakraws_factevents;
 DROP TABLE IF EXISTS snakraws_dimgeolocations;
 DROP TABLE IF EXISTS snakraws_dimcities;
@@ -17,6 +23,7 @@ DROP TABLE IF EXISTS snakraws_dimpostalcodes;
 DROP TABLE IF EXISTS snakraws_dimreferers;
 DROP TABLE IF EXISTS snakraws_shorturls;
 DROP TABLE IF EXISTS snakraws_longurls;
+DROP SEQUENCE IF EXISTS snakraws_shorturl_codes;
 
 create table snakraws_dimgeolocations (
   id               INT          PRIMARY KEY GENERATED BY DEFAULT AS IDENTITY,
@@ -138,12 +145,19 @@ create table snakraws_shorturls (
     shorturl            VARCHAR(40) NOT NULL,
     shorturl_path_size  SMALLINT NULL,
     compression_ratio   DECIMAL(10,2) NULL,
-    is_active           BOOLEAN NOT NULL DEFAULT TRUE
+    is_active           BOOLEAN NOT NULL DEFAULT TRUE,
+    cache_max_age       INT NULL,
+    version             INT NOT NULL DEFAULT 1,
+    modified_on         TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
 );
 
 CREATE UNIQUE INDEX IX_snakraws_shorturls_is_active_longurl_id
 ON snakraws_shorturls (is_active, longurl_id);
 
+-- the short url filters' catch-ups and export_redirects --delta read the recently changed rows
+CREATE INDEX IX_snakraws_shorturls_modified_on
+ON snakraws_shorturls (modified_on);
+
 INSERT INTO snakraws_shorturls (id, longurl_id, hash, shorturl, shorturl_path_size, is_active)
 VALUES (0, 0, 4967328134902799212, 'unspecified', NULL, TRUE);
 
@@ -151,6 +165,42 @@ ALTER TABLE snakraws_shorturls
 ADD CONSTRAINT fk_snakraws_shorturls_longurl_id
 FOREIGN KEY (longurl_id) REFERENCES snakraws_longurls (id) ON DELETE CASCADE;
 
+-- ids for SHORTURL_GENERATION_MODE = 'sequence'; each nextval() leases a block of INCREMENT BY ids to one worker
+CREATE SEQUENCE snakraws_shorturl_codes
+  AS BIGINT
+  START WITH 1
+  INCREMENT BY 100;
+
+CREATE TABLE snakraws_shorturlclicks (
+  shorturl_id      INT          PRIMARY KEY,
+  clicks           BIGINT       NOT NULL DEFAULT 0,
+  updated_on       TIMESTAMP    NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IX_snakraws_shorturlclicks_clicks
+ON snakraws_shorturlclicks
+  (clicks DESC);
+
+ALTER TABLE snakraws_shorturlclicks ADD CONSTRAINT fk_snakraws_shorturlclicks_shorturl_id
+FOREIGN KEY (shorturl_id)
+REFERENCES snakraws_shorturls (id) ON DELETE CASCADE;
+
+CREATE TABLE snakraws_visitorsketches (
+  id               INT          PRIMARY KEY GENERATED BY DEFAULT AS IDENTITY,
+  shorturl_id      INT          NOT NULL,
+  event_yyyymmdd   CHAR(8)      NOT NULL,
+  dimension        CHAR(1)      NOT NULL CHECK (dimension IN ('I','U')),
+  sketch           BYTEA        NOT NULL
+);
+
+CREATE UNIQUE INDEX UX_snakraws_visitorsketches
+ON snakraws_visitorsketches
+  (shorturl_id, event_yyyymmdd, dimension);
+
+ALTER TABLE snakraws_visitorsketches ADD CONSTRAINT fk_snakraws_visitorsketches_shorturl_id
+FOREIGN KEY (shorturl_id)
+REFERENCES snakraws_shorturls (id) ON DELETE CASCADE;
+
 create table snakraws_factevents (
   id               INT          PRIMARY KEY GENERATED BY DEFAULT AS IDENTITY,
   event_yyyymmdd   CHAR(8) DEFAULT TO_CHAR(CURRENT_TIMESTAMP, 'YYYYMMDD') NOT NULL,
@@ -276,3 +326,64 @@ CREATE UNIQUE INDEX UX_snakraws_blacklist_by_technographics
     host_id,
     geo_id
 );
+
+CREATE TABLE snakraws_watermarks (
+  name             VARCHAR(50)  PRIMARY KEY,
+  last_id          BIGINT       NOT NULL DEFAULT 0,
+  last_ts          TIMESTAMP    NULL,
+  updated_on       TIMESTAMP    NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE snakraws_profanityverdicts (
+  id               BIGINT       PRIMARY KEY GENERATED BY DEFAULT AS IDENTITY,
+  version          VARCHAR(16)  NOT NULL,
+  token_hash       BIGINT       NOT NULL,
+  verdict          SMALLINT     NOT NULL,
+  created_on       TIMESTAMP    NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE UNIQUE INDEX UX_snakraws_profanityverdicts
+ON snakraws_profanityverdicts
+  (version, token_hash);
+
+CREATE TABLE snakraws_rollupdaily (
+  id               INT          PRIMARY KEY GENERATED BY DEFAULT AS IDENTITY,
+  shorturl_id      INT          NOT NULL,
+  event_yyyymmdd   CHAR(8)      NOT NULL,
+  countrycode      VARCHAR(2)   NOT NULL,
+  event_type       CHAR(1)      NOT NULL,
+  events           BIGINT       NOT NULL DEFAULT 0
+);
+
+CREATE UNIQUE INDEX UX_snakraws_rollupdaily
+ON snakraws_rollupdaily
+  (shorturl_id, event_yyyymmdd, countrycode, event_type);
+
+CREATE INDEX IX_snakraws_rollupdaily_yyyymmdd
+ON snakraws_rollupdaily
+  (event_yyyymmdd);
+
+ALTER TABLE snakraws_rollupdaily ADD CONSTRAINT fk_snakraws_rollupdaily_shorturl_id
+FOREIGN KEY (shorturl_id)
+REFERENCES snakraws_shorturls (id) ON DELETE CASCADE;
+
+CREATE TABLE snakraws_rolluphourly (
+  id               INT          PRIMARY KEY GENERATED BY DEFAULT AS IDENTITY,
+  shorturl_id      INT          NOT NULL,
+  event_yyyymmdd   CHAR(8)      NOT NULL,
+  event_hh         CHAR(2)      NOT NULL,
+  event_type       CHAR(1)      NOT NULL,
+  events           BIGINT       NOT NULL DEFAULT 0
+);
+
+CREATE UNIQUE INDEX UX_snakraws_rolluphourly
+ON snakraws_rolluphourly
+  (shorturl_id, event_yyyymmdd, event_hh, event_type);
+
+CREATE INDEX IX_snakraws_rolluphourly_yyyymmdd_hh
+ON snakraws_rolluphourly
+  (event_yyyymmdd, event_hh);
+
+ALTER TABLE snakraws_rolluphourly ADD CONSTRAINT fk_snakraws_rolluphourly_shorturl_id
+FOREIGN KEY (shorturl_id)
+REFERENCES snakraws_shorturls (id) ON DELETE CASCADE;
@@ -7,3 +7,31 @@ admin.site.site_header = getattr(settings, "VERBOSE_NAME", _("SnakrAWS"))
 admin.site.site_title = _("%s Admin Portal") % admin.site.site_header
 admin.site.index_title = getattr(settings, "PAGE_TITLE", _("SnakrAWS"))
 
+
+class ReadOnlyRollupAdmin(admin.ModelAdmin):
+    """Rollups are maintained by the rollup_factevents command; the admin only reads them."""
+    list_select_related = ('shorturl',)
+    ordering = ('-event_yyyymmdd',)
+    search_fields = ('shorturl__shorturl',)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(models.RollupDaily)
+class RollupDailyAdmin(ReadOnlyRollupAdmin):
+    list_display = ('shorturl', 'event_yyyymmdd', 'countrycode', 'event_type', 'events')
+    list_filter = ('event_type', 'countrycode')
+
+
+@admin.register(models.RollupHourly)
+class RollupHourlyAdmin(ReadOnlyRollupAdmin):
+    list_display = ('shorturl', 'event_yyyymmdd', 'event_hh', 'event_type', 'events')
+    list_filter = ('event_type',)
+    ordering = ('-event_yyyymmdd', '-event_hh')
@@ -0,0 +1,286 @@
+'''
+bloom.py keeps in-memory Bloom filters over the short URLs in snakraws_shorturls, so that "is this taken?" and "does
+this exist?" can usually be answered with a definite no without a database query.
+
+Each worker loads its filters in a background thread the first time they are used, and answers "maybe" until the
+load is done. New short URLs are added by the worker that created them, which also bumps a generation counter in
+the Django cache; before any worker trusts a negative answer it compares that counter with the one it last caught
+up to and, if another worker has created short URLs since, reads the rows with new ids and the rows changed in the
+last CATCH_UP_SETTLE_SECONDS first. One thread per worker catches up, outside the filter's lock; until it is done,
+or for LOAD_RETRY_SECONDS after a catch-up fails, negative answers become "maybe". A "yes" only means "maybe" and is checked against the database. A "no" is right
+unless the short URL was created on a node whose workers share no cache with this one, and not yet caught up with,
+or by a transaction that ran for longer than CATCH_UP_SETTLE_SECONDS, so callers must not treat it as proof.
+'''
+
+import hashlib
+import math
+import os
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import DatabaseError, InterfaceError, connection, transaction as xaction
+
+from snakraws import settings
+from snakraws.logsinks import get_logger
+from snakraws.metrics import count
+from snakraws.models import ShortURLs
+from snakraws.utils import urlparts
+
+SHORTURL_FILTER_GENERATION_KEY = 'snakraws_shorturlfilter_generation'
+
+# rows read per query while loading or catching up
+LOAD_CHUNK_SIZE = 50000
+
+# each catch-up also reads again the rows changed this many seconds before the previous one (or the load) started,
+# for rows whose id was assigned before it but which committed after it
+CATCH_UP_SETTLE_SECONDS = 300
+
+# seconds to wait before loading or catching up again after a failed load or catch-up
+LOAD_RETRY_SECONDS = 30
+
+
+class BloomFilter:
+    """A fixed-size Bloom filter sized for `capacity` keys at `error_rate` false positives, using double hashing."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        self.size = max(int(-self.capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.hashes = max(int(round(self.size / self.capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        return
+
+    def _positions(self, key):
+        if not isinstance(key, bytes):
+            key = str(key).encode('utf-8')
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        return
+
+    def __contains__(self, key):
+        bits = self.bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class ShortURLFilter:
+    """
+    A Bloom filter over one key derived from each snakraws_shorturls row: `column` is read from the table and passed
+    through `key` before being added. might_contain() is False only when the key is definitely not in the table.
+    """
+
+    def __init__(self, name, column, key=None):
+        self.name = name
+        self.enabled = getattr(settings, "ENABLE_SHORTURL_FILTERS", True)
+        self.column = column
+        self.key = key or (lambda value: value)
+        self.capacity = getattr(settings, "SHORTURL_FILTER_CAPACITY", 1000000)
+        self.error_rate = getattr(settings, "SHORTURL_FILTER_ERROR_RATE", 0.01)
+        self.rebuild_seconds = getattr(settings, "SHORTURL_FILTER_REBUILD_SECONDS", 3600)
+        self._lock = threading.Lock()
+        self._catch_up_lock = threading.Lock()
+        self._catch_up_retry_at = 0
+        self._pid = None
+        self._filter = None
+        self._loaded_at = 0
+        self._retry_at = 0
+        self._rows = 0
+        self._high_water = 0
+        # database time the last load or catch-up started, less CATCH_UP_SETTLE_SECONDS
+        self._changed_since = None
+        self._generation = None
+        return
+
+    def _ensure_loading(self):
+        if self._pid != os.getpid() and time.time() >= self._retry_at:
+            with self._lock:
+                if self._pid != os.getpid() and time.time() >= self._retry_at:
+                    # a filter inherited across a fork is stale and its loader thread didn't survive; start over
+                    self._pid = os.getpid()
+                    self._filter = None
+                    threading.Thread(target=self._load, name="snakraws-%s-filter" % self.name, daemon=True).start()
+        return
+
+    def _read(self, bloom, after_id):
+        """Adds the rows with ids above after_id; returns the highest id read and how many rows were read."""
+        added = 0
+        high_water = after_id
+        while True:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT id, %s FROM %s WHERE id > %%s ORDER BY id LIMIT %d'
+                               % (self.column, ShortURLs._meta.db_table, LOAD_CHUNK_SIZE), [high_water])
+                rows = cursor.fetchall()
+            for row_id, value in rows:
+                bloom.add(self.key(value))
+            added += len(rows)
+            if rows:
+                high_water = rows[-1][0]
+            if len(rows) < LOAD_CHUNK_SIZE:
+                return high_water, added
+
+    @staticmethod
+    def _settled_since():
+        # modified_on is a UTC TIMESTAMP defaulting to the inserting transaction's start, so go by the database clock
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT (now() AT TIME ZONE 'UTC') - make_interval(secs => %s)", [CATCH_UP_SETTLE_SECONDS])
+            return cursor.fetchone()[0]
+
+    def _read_changed(self, bloom, since):
+        """Adds the rows changed after `since`, which are mostly in the filter already and so aren't counted."""
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT id, %s FROM %s WHERE modified_on > %%s'
+                           % (self.column, ShortURLs._meta.db_table), [since])
+            rows = cursor.fetchall()
+        for row_id, value in rows:
+            bloom.add(self.key(value))
+        return
+
+    def _load(self):
+        started = time.time()
+        try:
+            generation = cache.get(SHORTURL_FILTER_GENERATION_KEY, 0)
+            changed_since = self._settled_since()
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT COUNT(*) FROM %s' % ShortURLs._meta.db_table)
+                rows = cursor.fetchone()[0]
+            bloom = BloomFilter(max(self.capacity, rows * 2), self.error_rate)
+            high_water, added = self._read(bloom, 0)
+            with self._lock:
+                self._filter = bloom
+                self._high_water = high_water
+                self._changed_since = changed_since
+                self._generation = generation
+                self._loaded_at = time.time()
+                self._rows = added
+            count('shorturl_filter_loads_total', filter=self.name)
+            get_logger().info('%s filter loaded %d short URLs in %.1fs' % (self.name, added, time.time() - started))
+        except Exception as e:
+            get_logger().warning('%s filter failed to load: %s' % (self.name, str(e)))
+            with self._lock:
+                # let a caller try again in a while
+                self._pid = None
+                self._retry_at = time.time() + LOAD_RETRY_SECONDS
+        finally:
+            connection.close()
+        return
+
+    def _catch_up(self, generation):
+        """
+        Reads the rows created since the filter last caught up, without holding the filter's lock over the queries.
+        Returns False if the filter couldn't be brought up to `generation` now, in which case a "no" can't be trusted.
+        """
+        if time.time() < self._catch_up_retry_at or not self._catch_up_lock.acquire(blocking=False):
+            # the database failed us a moment ago, or another thread is already reading the new rows
+            return False
+        try:
+            with self._lock:
+                bloom = self._filter
+                after_id = self._high_water
+                since = self._changed_since
+                if bloom is None:
+                    return False
+                if generation == self._generation:
+                    return True
+            try:
+                # a savepoint when called inside a request's transaction, so a failed query doesn't break it
+                with xaction.atomic():
+                    changed_since = self._settled_since()
+                    # rows committed since the last catch-up: those with new ids, and those with older ids whose
+                    # transaction was still open then, which changed within the settle window before it
+                    high_water, added = self._read(bloom, after_id)
+                    self._read_changed(bloom, since)
+            except (DatabaseError, InterfaceError) as e:
+                self._catch_up_retry_at = time.time() + LOAD_RETRY_SECONDS
+                count('shorturl_filter_catch_up_errors_total', filter=self.name)
+                get_logger().warning('%s filter failed to catch up: %s' % (self.name, str(e)))
+                return False
+            with self._lock:
+                if self._filter is not bloom:
+                    # reloaded meanwhile; the new filter keeps the generation it was loaded at
+                    return False
+                self._changed_since = changed_since
+                self._high_water = max(self._high_water, high_water)
+                self._generation = generation
+                self._rows += added
+                full = self._rows > bloom.capacity
+                stale = time.time() - self._loaded_at > self.rebuild_seconds
+                if full or stale:
+                    self._loaded_at = time.time()
+        finally:
+            self._catch_up_lock.release()
+        count('shorturl_filter_catch_ups_total', filter=self.name)
+        if full or stale:
+            # rebuild a bigger, fresh filter in the background; this one keeps answering until it is ready
+            threading.Thread(target=self._load, name="snakraws-%s-filter" % self.name, daemon=True).start()
+        return True
+
+    def add(self, value):
+        """Adds a short URL row's column value created by this worker."""
+        bloom = self._filter
+        if bloom is not None and self._pid == os.getpid():
+            bloom.add(self.key(value))
+        return
+
+    def might_contain(self, key):
+        """False if `key` is definitely not in snakraws_shorturls; True if it may be, or the filter isn't loaded yet."""
+        if not self.enabled:
+            return True
+        self._ensure_loading()
+        bloom = self._filter
+        if bloom is None:
+            count('shorturl_filter_checks_total', filter=self.name, answer='unloaded')
+            return True
+        if key in bloom:
+            count('shorturl_filter_checks_total', filter=self.name, answer='maybe')
+            return True
+        generation = cache.get(SHORTURL_FILTER_GENERATION_KEY, 0)
+        if generation != self._generation:
+            if not self._catch_up(generation):
+                count('shorturl_filter_checks_total', filter=self.name, answer='behind')
+                return True
+            if key in bloom:
+                count('shorturl_filter_checks_total', filter=self.name, answer='maybe')
+                return True
+        count('shorturl_filter_checks_total', filter=self.name, answer='no')
+        return False
+
+
+def shortpath_of(shorturl):
+    return urlparts(shorturl).path.lstrip('/')
+
+
+# vanity and generated paths in use, whatever the scheme and host of their short URL
+shortpath_filter = ShortURLFilter('shortpath', 'shorturl', key=shortpath_of)
+
+# hashes of every short url, for answering redirects to unknown short urls and the double-shortening check
+shorturl_hash_filter = ShortURLFilter('shorturl_hash', 'hash')
+
+SHORTURL_FILTERS = (shortpath_filter, shorturl_hash_filter)
+
+
+def shorturl_created(shorturl):
+    """
+    Call with a newly inserted ShortURLs row. Adds it to this worker's filters once the transaction commits, and bumps
+    the generation so the other workers read it before their next negative answer.
+    """
+    def created():
+        for f in SHORTURL_FILTERS:
+            f.add(getattr(shorturl, f.column))
+        try:
+            cache.incr(SHORTURL_FILTER_GENERATION_KEY)
+        except ValueError:
+            # evicted or never set; restart from the clock so it can't come back as a value a worker already holds
+            if not cache.add(SHORTURL_FILTER_GENERATION_KEY, int(time.time() * 1000), timeout=None):
+                cache.incr(SHORTURL_FILTER_GENERATION_KEY)
+    if getattr(settings, "ENABLE_SHORTURL_FILTERS", True):
+        xaction.on_commit(created)
+    return
@@ -0,0 +1,161 @@
+'''
+counters.py keeps per-short-URL click counts in memory and writes them behind to snakraws_shorturlclicks in batches,
+so reading a click count never means running COUNT(*) over the fact table.
+'''
+
+import atexit
+import logging
+import os
+import threading
+import time
+
+from django.db import connection, transaction as xaction
+from django.utils import timezone
+
+from snakraws import settings
+from snakraws.models import ShortURLClicks
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """
+    Base class for per-key aggregates that are accumulated in this process and written behind to the database in
+    batches, once flush_seconds have passed or flush_size distinct keys are pending. A daemon thread also flushes every
+    flush_seconds, so aggregates don't wait on the next add() in a quiet worker. Subclasses say how a new value is
+    folded into a pending aggregate, how two aggregates combine, and how a sorted batch is written.
+    """
+
+    def __init__(self, flush_seconds, flush_size):
+        self.flush_seconds = flush_seconds
+        self.flush_size = flush_size
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+        self._pid = None
+        return
+
+    def _ensure_flusher(self):
+        # (re)start the flusher lazily, and again in each forked worker process, since threads don't survive a fork
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    threading.Thread(target=self._run, name="snakraws-%s-flusher" % self.__class__.__name__.lower(),
+                                     daemon=True).start()
+                    self._pid = os.getpid()
+        return
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            if time.time() - self._last_flush >= self.flush_seconds:
+                self.flush()
+                # this thread's connection would otherwise sit idle between flushes and go stale
+                connection.close()
+
+    def add(self, key, value):
+        self._ensure_flusher()
+        with self._lock:
+            self._pending[key] = self._fold(self._pending.get(key), value)
+            due = len(self._pending) >= self.flush_size or time.time() - self._last_flush >= self.flush_seconds
+        if due:
+            # never flush inside the caller's transaction. Outside one, flush right away rather than through
+            # on_commit, which connects to the database just to check autocommit and raises if it can't
+            if connection.in_atomic_block:
+                xaction.on_commit(self.flush)
+            else:
+                self.flush()
+        return
+
+    def pending(self, key):
+        with self._lock:
+            return self._pending.get(key, None)
+
+    def pending_items(self, predicate):
+        with self._lock:
+            return [(key, aggregate) for key, aggregate in self._pending.items() if predicate(key)]
+
+    def flush(self):
+        with self._lock:
+            batch = self._pending
+            self._pending = {}
+            self._last_flush = time.time()
+        if not batch:
+            return 0
+        # sort by key so that concurrent flushes from several workers always lock rows in the same order
+        rows = sorted(batch.items())
+        try:
+            self._write(rows)
+        except Exception as e:
+            # put the aggregates back so they go out with the next flush instead of being lost
+            with self._lock:
+                for key, aggregate in rows:
+                    current = self._pending.get(key, None)
+                    self._pending[key] = aggregate if current is None else self._combine(current, aggregate)
+            logger.warning("%s flush of %d keys failed: %s" % (self.__class__.__name__, len(rows), str(e)))
+            return 0
+        return len(rows)
+
+    def _fold(self, aggregate, value):
+        raise NotImplementedError
+
+    def _combine(self, aggregate, other):
+        raise NotImplementedError
+
+    def _write(self, rows):
+        raise NotImplementedError
+
+
+class ClickCounter(WriteBehindBuffer):
+    """Click deltas per short URL id, flushed as a single multi-row upsert into snakraws_shorturlclicks."""
+
+    def __init__(self):
+        super().__init__(getattr(settings, "CLICK_COUNTER_FLUSH_SECONDS", 10),
+                         getattr(settings, "CLICK_COUNTER_FLUSH_SIZE", 1000))
+        return
+
+    def increment(self, shorturl_id, clicks=1):
+        self.add(shorturl_id, clicks)
+        return
+
+    def _fold(self, aggregate, value):
+        return (aggregate or 0) + value
+
+    def _combine(self, aggregate, other):
+        return aggregate + other
+
+    def _write(self, rows):
+        now = timezone.now()
+        params = []
+        for shorturl_id, clicks in rows:
+            params.extend([shorturl_id, clicks, now])
+        table = ShortURLClicks._meta.db_table
+        sql = "INSERT INTO %s (shorturl_id, clicks, updated_on) VALUES %s " \
+              "ON CONFLICT (shorturl_id) DO UPDATE SET clicks = %s.clicks + EXCLUDED.clicks, updated_on = EXCLUDED.updated_on" \
+              % (table, ', '.join(['(%s, %s, %s)'] * len(rows)), table)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+        return
+
+
+click_counter = ClickCounter()
+atexit.register(click_counter.flush)
+
+
+def count_click(shorturl_id):
+    if shorturl_id and shorturl_id > 0:
+        click_counter.increment(shorturl_id)
+    return
+
+
+def get_click_count(shorturl_id):
+    """Returns the persisted click count for the short URL plus any clicks this process has not flushed yet."""
+    persisted = ShortURLClicks.objects.filter(shorturl_id=shorturl_id).values_list('clicks', flat=True).first()
+    return (persisted or 0) + (click_counter.pending(shorturl_id) or 0)
+
+
+def get_top_clicked(limit=10):
+    """Returns (shorturl, clicks) tuples for the most clicked short URLs, most clicked first."""
+    return list(ShortURLClicks.objects.select_related('shorturl')
+                .order_by('-clicks')
+                .values_list('shorturl__shorturl', 'clicks')[:limit])
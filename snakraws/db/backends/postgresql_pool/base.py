@@ -0,0 +1,30 @@
+'''
+A PostgreSQL backend that borrows connections from snakraws.dbpool instead of opening and closing one per request.
+Use it by setting 'ENGINE': 'snakraws.db.backends.postgresql_pool' (and a POOL dict) in DATABASES.
+'''
+
+from django.db.backends.postgresql.base import Database, DatabaseWrapper as PostgresDatabaseWrapper
+
+from snakraws.dbpool import find_pool, get_pool
+
+
+class DatabaseWrapper(PostgresDatabaseWrapper):
+
+    def get_new_connection(self, conn_params):
+        connection = get_pool(self.alias, self.settings_dict, lambda: Database.connect(**conn_params)).acquire()
+        # what the parent's get_new_connection() does once it has connected
+        options = self.settings_dict['OPTIONS']
+        self.isolation_level = options.get('isolation_level', connection.isolation_level)
+        if self.isolation_level != connection.isolation_level:
+            connection.set_session(isolation_level=self.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                pool = find_pool(self.alias)
+                if pool is None:
+                    # not borrowed from this process's pool, e.g. inherited across a fork, so there's no slot to return
+                    self.connection.close()
+                else:
+                    pool.release(self.connection)
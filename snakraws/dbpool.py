@@ -0,0 +1,134 @@
+'''
+dbpool.py is a small in-process pool of psycopg2 connections, used by the snakraws.db.backends.postgresql_pool
+database backend so a request borrows an already-open Postgres connection instead of paying for a new one.
+
+Each database alias gets one pool per process, configured by the POOL dict of its DATABASES entry:
+
+    MAX                     connections open at once (default 10)
+    TIMEOUT                 seconds to wait for a free connection before failing (default 5)
+    MAX_AGE                 seconds after which a connection is closed instead of reused (default 900)
+    HEALTH_CHECK_SECONDS    connections idle longer than this are pinged before reuse (default 30)
+'''
+
+import os
+import threading
+import time
+from time import perf_counter
+
+import psycopg2
+from psycopg2 import extensions
+
+from snakraws.metrics import count, registry, METRICS_ENABLED
+
+
+class ConnectionPool:
+
+    def __init__(self, alias, connect, max_size=10, timeout=5, max_age=900, health_check_seconds=30):
+        self.alias = alias
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_age = max_age
+        self.health_check_seconds = health_check_seconds
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        # idle connections as (connection, opened, last used), most recently used last
+        self._idle = []
+        self._opened = {}
+        return
+
+    def acquire(self):
+        started = perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            count('db_pool_timeouts_total', alias=self.alias)
+            raise psycopg2.OperationalError('No connection available in the %s pool after %ss' % (self.alias, self.timeout))
+        if METRICS_ENABLED:
+            registry.observe('db_pool_wait_seconds', (('alias', self.alias),), perf_counter() - started)
+        try:
+            while True:
+                with self._lock:
+                    item = self._idle.pop() if self._idle else None
+                if item is None:
+                    return self._open()
+                connection, opened, last_used = item
+                now = time.monotonic()
+                if self.max_age and now - opened > self.max_age:
+                    self._discard(connection, 'expired')
+                elif now - last_used > self.health_check_seconds and not self._is_usable(connection):
+                    self._discard(connection, 'unusable')
+                else:
+                    count('db_pool_connections_reused_total', alias=self.alias)
+                    return connection
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, connection):
+        try:
+            if connection.closed:
+                self._discard(connection, 'closed')
+                return
+            status = connection.get_transaction_status()
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                self._discard(connection, 'unusable')
+                return
+            if status != extensions.TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+            with self._lock:
+                self._idle.append((connection, self._opened.get(id(connection), time.monotonic()), time.monotonic()))
+        except psycopg2.Error:
+            self._discard(connection, 'unusable')
+        finally:
+            self._slots.release()
+        return
+
+    def _open(self):
+        connection = self._connect()
+        self._opened[id(connection)] = time.monotonic()
+        count('db_pool_connections_opened_total', alias=self.alias)
+        return connection
+
+    def _discard(self, connection, reason):
+        self._opened.pop(id(connection), None)
+        count('db_pool_connections_closed_total', alias=self.alias, reason=reason)
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+        return
+
+    @staticmethod
+    def _is_usable(connection):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            return True
+        except psycopg2.Error:
+            return False
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, settings_dict, connect):
+    """The pool for this alias in this process; pools inherited across a fork are abandoned, not shared."""
+    key = (os.getpid(), alias)
+    pool = _pools.get(key, None)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key, None)
+            if pool is None:
+                options = settings_dict.get('POOL', None) or {}
+                pool = _pools[key] = ConnectionPool(alias,
+                                                    connect,
+                                                    max_size=options.get('MAX', 10),
+                                                    timeout=options.get('TIMEOUT', 5),
+                                                    max_age=options.get('MAX_AGE', 900),
+                                                    health_check_seconds=options.get('HEALTH_CHECK_SECONDS', 30))
+    return pool
+
+
+def find_pool(alias):
+    """The pool for this alias in this process, or None if there isn't one yet."""
+    return _pools.get((os.getpid(), alias), None)
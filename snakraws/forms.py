@@ -7,6 +7,9 @@ from django.utils.translation import ugettext_lazy as _
 from snakraws.models import LongURLs
 from snakraws.utils import get_message
 
+VANITY_PATH_PATTERN = re.compile(r'[\w-]*$')
+VANITY_PATH_MIN_SIZE = 3
+
 
 class ShortForm(forms.ModelForm):
     longurl = forms.URLField(
@@ -49,9 +52,9 @@ class ShortForm(forms.ModelForm):
     def clean_vanityurl(self):
         vu = self.cleaned_data['vanityurl'].strip()
         if len(vu) > 0:
-            if len(vu) < 3 or not re.match(r'[\w-]*$', vu):
+            if len(vu) < VANITY_PATH_MIN_SIZE or not VANITY_PATH_PATTERN.match(vu):
                 msg = get_message("VANITY_PATH_INVALID")
-                raise ValidationError(msg % (vu, 3))
+                raise ValidationError(msg % (vu, VANITY_PATH_MIN_SIZE))
         return vu
 
     def clean_byline(self):
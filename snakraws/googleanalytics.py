@@ -0,0 +1,112 @@
+'''
+googleanalytics.py forwards Google Analytics Measurement Protocol hits from a background thread, so a slow or
+unreachable google-analytics.com never adds to redirect or shortening latency.
+'''
+
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from urllib.parse import urlencode
+
+import requests
+
+from snakraws import settings
+
+logger = logging.getLogger(__name__)
+
+# the Measurement Protocol batch endpoint accepts at most 20 hits per request
+GA_MAX_BATCH_SIZE = 20
+
+
+class GAForwarder:
+    """
+    Queues hits in memory and sends them to the Measurement Protocol batch endpoint from a daemon thread.
+    When the queue is full new hits are dropped (and counted) rather than blocking the request that produced them;
+    batches that still fail after GOOGLE_ANALYTICS_MAX_RETRIES are dropped too.
+    """
+
+    def __init__(self):
+        self.endpoint = getattr(settings, "GOOGLE_ANALYTICS_ENDPOINT", "https://www.google-analytics.com/batch")
+        self.timeout = getattr(settings, "GOOGLE_ANALYTICS_TIMEOUT", 5)
+        self.max_retries = getattr(settings, "GOOGLE_ANALYTICS_MAX_RETRIES", 3)
+        self.batch_size = min(getattr(settings, "GOOGLE_ANALYTICS_BATCH_SIZE", GA_MAX_BATCH_SIZE), GA_MAX_BATCH_SIZE)
+        self.queue = queue.Queue(maxsize=getattr(settings, "GOOGLE_ANALYTICS_QUEUE_SIZE", 10000))
+        self.sent = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+        self._session = None
+        return
+
+    def send(self, hit):
+        self._ensure_worker()
+        try:
+            self.queue.put_nowait(hit)
+        except queue.Full:
+            self.dropped += 1
+        return
+
+    def _ensure_worker(self):
+        # (re)start the sender lazily, and again in each forked worker process, since threads don't survive a fork
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self.queue = queue.Queue(maxsize=self.queue.maxsize)
+                    self._session = requests.Session()
+                    self._thread = threading.Thread(target=self._run, name="snakraws-ga-forwarder", daemon=True)
+                    self._thread.start()
+                    self._pid = os.getpid()
+        return
+
+    def _next_batch(self, block=True):
+        batch = []
+        try:
+            batch.append(self.queue.get(block=block))
+            while len(batch) < self.batch_size:
+                batch.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _run(self):
+        while True:
+            self._post(self._next_batch())
+
+    def _post(self, batch, retries=None):
+        if not batch:
+            return True
+        retries = self.max_retries if retries is None else retries
+        payload = '\n'.join(urlencode(hit) for hit in batch)
+        for attempt in range(retries + 1):
+            try:
+                r = self._session.post(self.endpoint, data=payload.encode('utf8'), timeout=self.timeout)
+                if r.status_code < 500:
+                    self.sent += len(batch)
+                    return True
+            except requests.RequestException as e:
+                logger.debug("Google Analytics batch of %d hits failed: %s" % (len(batch), str(e)))
+            if attempt < retries:
+                time.sleep(min(2 ** attempt * 0.5, 10))
+        self.dropped += len(batch)
+        return False
+
+    def flush(self):
+        """Sends whatever is still queued without retrying, giving up at the first failure; called at interpreter exit."""
+        if self._pid == os.getpid():
+            while not self.queue.empty():
+                if not self._post(self._next_batch(block=False), retries=0):
+                    break
+        return
+
+
+ga_forwarder = GAForwarder()
+atexit.register(ga_forwarder.flush)
+
+
+def forward_hit(hit):
+    ga_forwarder.send(hit)
+    return
@@ -0,0 +1,116 @@
+'''
+httpcache.py sets the HTTP caching headers of redirect responses and keeps the version they are validated against.
+
+Each short URL may be reused by browsers and edge caches for its own cache_max_age, or SHORTURL_CACHE_MAX_AGE if it
+has none, and is validated by an ETag built from its id and version and by its modified_on. Saving a short URL or
+its long URL bumps the version, and when a change affects where the short URL redirects to (it is deactivated or
+reactivated, or its long URL is edited) the SHORTURL_PURGE_HOOK is called, so edge caches can be told to drop it.
+'''
+
+import calendar
+
+from django.db import transaction as xaction
+from django.db.models import F
+from django.db.models.signals import pre_save, post_save
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_response_headers
+from django.utils.http import http_date
+from django.utils.module_loading import import_string
+
+from snakraws import settings
+from snakraws.logsinks import get_logger
+from snakraws.models import ShortURLs, LongURLs
+from snakraws.__init__ import VERSION
+
+_purge_hook = None
+
+
+def get_purge_hook():
+    """The SHORTURL_PURGE_HOOK callable, which is passed the ShortURLs row to purge, or None."""
+    global _purge_hook
+    if _purge_hook is None:
+        path = getattr(settings, "SHORTURL_PURGE_HOOK", None)
+        _purge_hook = import_string(path) if path else False
+    return _purge_hook or None
+
+
+def purge(shorturl):
+    hook = get_purge_hook()
+    if hook:
+        def run():
+            try:
+                hook(shorturl)
+            except Exception as e:
+                get_logger().warning('SHORTURL_PURGE_HOOK failed for %s: %s' % (shorturl.shorturl, str(e)))
+        # only once the change is visible to whatever refetches the short url
+        xaction.on_commit(run)
+    return
+
+
+def get_etag(shorturl_id, version):
+    # the release is part of it so a deploy that changes the redirect page revalidates everything
+    return '"%d-%d-%s"' % (shorturl_id, version, VERSION)
+
+
+def get_cache_max_age(cache_max_age):
+    return cache_max_age if cache_max_age is not None else getattr(settings, "SHORTURL_CACHE_MAX_AGE", 0)
+
+
+def conditional_redirect(request, response, shorturl_id, version, modified_on, max_age):
+    """
+    Adds Cache-Control, Expires, ETag and Last-Modified to a redirect response, and turns it into a 304 if the
+    request's If-None-Match or If-Modified-Since already matches. With a max_age of 0, clients must revalidate.
+    """
+    max_age = get_cache_max_age(max_age)
+    if max_age > 0:
+        patch_response_headers(response, cache_timeout=max_age)
+        patch_cache_control(response, public=True)
+    else:
+        patch_cache_control(response, no_cache=True, must_revalidate=True)
+    etag = get_etag(shorturl_id, version)
+    response['ETag'] = etag
+    # modified_on is a UTC TIMESTAMP, which may come back naive
+    last_modified = calendar.timegm(modified_on.utctimetuple()) if modified_on else None
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    return get_conditional_response(request, etag=etag, last_modified=last_modified, response=response)
+
+
+def not_modified(request, shorturl_id, version, modified_on, max_age):
+    """The 304 for a request that already has this version of the redirect, or None; needs no long url or render."""
+    response = conditional_redirect(request, HttpResponse(), shorturl_id, version, modified_on, max_age)
+    return response if response.status_code == 304 else None
+
+
+def _shorturl_saving(sender, instance, **kwargs):
+    # bump the version of an existing short url, remembering if it was (de)activated
+    instance.snakr_purge = False
+    if instance.pk is not None:
+        previous = ShortURLs.objects.filter(pk=instance.pk).values('is_active', 'version').first()
+        if previous:
+            instance.version = previous['version'] + 1
+            instance.snakr_purge = previous['is_active'] != instance.is_active
+    instance.modified_on = timezone.now()
+    return
+
+
+def _shorturl_saved(sender, instance, **kwargs):
+    if getattr(instance, 'snakr_purge', False):
+        purge(instance)
+    return
+
+
+def _longurl_saved(sender, instance, created, **kwargs):
+    if created:
+        return
+    shorturls = ShortURLs.objects.filter(longurl_id=instance.id)
+    shorturls.update(version=F('version') + 1, modified_on=timezone.now())
+    for s in shorturls:
+        purge(s)
+    return
+
+
+pre_save.connect(_shorturl_saving, sender=ShortURLs, dispatch_uid='snakraws_httpcache_shorturl_saving')
+post_save.connect(_shorturl_saved, sender=ShortURLs, dispatch_uid='snakraws_httpcache_shorturl_saved')
+post_save.connect(_longurl_saved, sender=LongURLs, dispatch_uid='snakraws_httpcache_longurl_saved')
@@ -11,6 +11,7 @@ import inspect
 from urllib.parse import urlparse
 
 from snakraws.utils import get_hash
+from snakraws.metrics import timed
 
 
 class SnakrIP:
@@ -38,6 +39,7 @@ class SnakrIP:
             pass
         return ip, errors
 
+    @timed('geolocate')
     def _geolocate(self, ip):
         jsondata = {}
         jsonstr = '{}'
@@ -101,6 +103,7 @@ class SnakrIP:
                 setattr(self, k, None)
         return is_error, errors
 
+    @timed('snakrip')
     def __init__(self, request, **kwargs):
         """
         get the client ip from the request META
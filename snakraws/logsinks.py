@@ -0,0 +1,124 @@
+'''
+logsinks.py configures Snakr's JSON event logging once per process. Request threads only put records on an in-memory
+queue; a single listener thread batches them into the configured file, stdout and/or syslog sinks, so log I/O never
+blocks a redirect and stays constant per request however long the process has been up.
+'''
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+
+from pythonjsonlogger import jsonlogger
+
+from snakraws import settings
+
+
+class SampleFilter(logging.Filter):
+    """
+    Keeps only a fraction of the records for high-volume HTTP statuses, e.g. LOG_SAMPLE_RATES = {301: 0.1} keeps ~10%
+    of 301 redirect lines. Warnings and errors are never sampled out.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = dict(rates)
+        return
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(getattr(record, 'http_status', None), 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class BatchingQueueListener(logging.handlers.QueueListener):
+    """A QueueListener that also flushes its buffering handlers whenever the queue has been idle for flush_seconds."""
+
+    def __init__(self, log_queue, *handlers, flush_seconds=1.0):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.flush_seconds = flush_seconds
+        return
+
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(block=block, timeout=self.flush_seconds if block else None)
+            except queue.Empty:
+                if not block:
+                    raise
+                for handler in self.handlers:
+                    handler.flush()
+
+
+def _make_sink(name):
+    if name == 'stdout':
+        return logging.StreamHandler(sys.stdout)
+    if name == 'file':
+        return logging.handlers.WatchedFileHandler(
+                os.path.join(getattr(settings, "LOG_PATH", "/var/logs"), "%s.log" % settings.VERBOSE_NAME.lower()))
+    if name == 'syslog':
+        return logging.handlers.SysLogHandler(address=getattr(settings, "LOG_SYSLOG_ADDRESS", "/dev/log"))
+    raise ValueError("Unknown log sink '%s'; expected one of stdout, file or syslog" % name)
+
+
+_lock = threading.Lock()
+_pid = None
+_listener = None
+
+
+def _configure(logger):
+    global _pid, _listener
+    if _listener:
+        # inherited from the parent process; its thread did not survive the fork
+        for handler in list(logger.handlers):
+            if isinstance(handler, logging.handlers.QueueHandler):
+                logger.removeHandler(handler)
+        _listener = None
+    if settings.VERBOSE_LOGGING:
+        formatter = jsonlogger.JsonFormatter()
+        batch_size = getattr(settings, "LOG_BATCH_SIZE", 100)
+        handlers = []
+        for name in getattr(settings, "LOG_SINKS", ['stdout']):
+            sink = _make_sink(name)
+            sink.setFormatter(formatter)
+            # errors are written straight through; everything else is batched
+            handlers.append(logging.handlers.MemoryHandler(batch_size, flushLevel=logging.ERROR, target=sink))
+        log_queue = queue.Queue()
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        queue_handler.addFilter(SampleFilter(getattr(settings, "LOG_SAMPLE_RATES", {})))
+        logger.addHandler(queue_handler)
+        logger.setLevel(logging.INFO)
+        _listener = BatchingQueueListener(log_queue, *handlers,
+                                          flush_seconds=getattr(settings, "LOG_FLUSH_SECONDS", 1.0))
+        _listener.start()
+    _pid = os.getpid()
+    return
+
+
+def get_logger():
+    """Returns the Snakr event logger, setting up its queue and sinks the first time it is called in each process."""
+    logger = logging.getLogger(settings.VERBOSE_NAME)
+    if _pid != os.getpid():
+        with _lock:
+            if _pid != os.getpid():
+                _configure(logger)
+    return logger
+
+
+def stop_logging():
+    """Drains the queue and flushes every sink; registered to run at interpreter exit."""
+    global _listener
+    if _listener and _pid == os.getpid():
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+    return
+
+
+atexit.register(stop_logging)
@@ -6,19 +6,23 @@ from urllib.parse import urlparse
 from urllib.request import urlopen
 
 from django.http import Http404
-from django.db import transaction as xaction
+from django.db import connection, transaction as xaction
 from django.forms import ValidationError
 from django.core.cache import cache
 
 from snakraws import settings
 from snakraws.models import LongURLs, ShortURLs
-from snakraws.shorturls import ShortURL
+from snakraws.shorturls import ShortURL, SHORTURL_GENERATION_ATTEMPTS
 from snakraws.persistence import SnakrLogger
 from snakraws.security import get_useragent_or_403_if_bot
 from snakraws.utils import get_json, is_url_valid, is_image, get_decodedurl, get_encodedurl, \
     get_longurlhash, get_host, get_referer, is_profane, fit_text, get_message, get_shorturlhash, inspect_url, urlparts
 from snakraws.ips import SnakrIP
 from snakraws.proxies import Proxies
+from snakraws.metrics import timed
+from snakraws.routers import mark_wrote_urls, pin_to_primary
+from snakraws.bloom import shorturl_created, shorturl_hash_filter
+from snakraws.previews import render_preview
 
 
 class LongURL:
@@ -61,7 +65,8 @@ class LongURL:
         dlurl = get_decodedurl(lurl)
 
         # DISALLOWED! a Snakr short url cannot be a subsequent long url to shorten!
-        if ShortURLs.objects.filter(hash=get_shorturlhash(dlurl)).exists():
+        shash = get_shorturlhash(dlurl)
+        if shorturl_hash_filter.might_contain(shash) and ShortURLs.objects.filter(hash=shash).exists():
             raise ValidationError(get_message("DISALLOW_DOUBLE_SHORTENING"))
 
         # 2019-6-21 bml BUGFIX issue where some sites don't accept encoded versions of their url and return 403s or something instead
@@ -95,20 +100,20 @@ class LongURL:
         return
 
     # get or make_short the short URL for an instance of this long URL
-    @xaction.atomic
     def get_or_make_short(self, request, *args, **kwargs):
+        # everything read from here on must see what this request is about to write, so skip the replicas
+        pin_to_primary()
         #
         # Does the long URL already exist?
         #
-        try:
-            l = LongURLs.objects.get(hash=self.hash)
-        except:
-            l = None
-            pass
+        l = LongURLs.objects.filter(hash=self.hash).first()
         if not l:
             #
             # NO IT DOESN'T
             #
+            # All the slow work (validation, profanity checks, making the short url) happens before the transaction
+            # opens, so the transaction itself is just two upserts and never holds locks while we think.
+            #
             # 1. Does the website even exist? If not, error
             #
             # if not site_exists(self.normalized_longurl):
@@ -147,64 +152,44 @@ class LongURL:
                 #                 messagekey='LONG_URL_CONTENT_INVALID',
                 #                 value=self.normalized_longurl,
                 #                 status_code=400)
-
-            #
-            # 3. Create a LongURLs persistence object
-            #
-            if self.longurl_is_preencoded:
-                originally_encoded = True
-            else:
-                originally_encoded = False
-            dl = LongURLs(hash=self.hash,
-                          longurl=self.normalized_longurl,
-                          originally_encoded=originally_encoded,
-                          title=self.meta.title,
-                          description=self.meta.description,
-                          image_url=self.meta.image_url,
-                          byline=self.byline,
-                          site_name=self.meta.site_name,
-                          meta_status=self.meta.status,
-                          meta_status_msg=self.meta.status_msg,
-                          is_active=True
-                          )
-            dl.save()
             #
-            # 4. Generate a short url for it (with collision handling) and calc its compression ratio vs the long url
+            # 3. Generate a short url for it
             #
             s = ShortURL(request)
             s.make_short(self.normalized_longurl_scheme, self.vanity_path)
-            compression_ratio = float(len(s.shorturl)) / float(len(self.normalized_longurl))
             #
-            # 5. Create a matching ShortURLs persistence object
+            # 4. Persist both in one short transaction. If someone else submitted the same long url concurrently,
+            #    their row wins and we return their short url instead of failing on the unique hash.
             #
-            ds = ShortURLs(hash=s.hash,
-                           longurl_id=dl.id,
-                           shorturl=s.shorturl,
-                           compression_ratio=compression_ratio,
-                           shorturl_path_size=settings.SHORTURL_PATH_SIZE,
-                           is_active=True
-                           )
+            with xaction.atomic():
+                dl = self._insert_longurl()
+                if dl:
+                    ds = self._insert_shorturl(s, dl)
+                else:
+                    l = LongURLs.objects.get(hash=self.hash)
+        if not l:
             #
-            # 6. *TBD, MAYBE* Is there an associated image? If so, download it to static.
+            # 5. Log the new short url once it is committed
             #
-            # if self.linked_image:
-            #    ft = file
+            with xaction.atomic():
+                msg = self.event.log(request=request,
+                                     ipobj=self.ip,
+                                     event_type='L',
+                                     messagekey='LONG_URL_SUBMITTED',
+                                     value=self.normalized_longurl,
+                                     longurl=dl,
+                                     shorturl=ds,
+                                     status_code=200
+                                     )
             #
-            # 7. Persist everything
+            # 6. Pre-render the page link preview crawlers will fetch
             #
-            ds.save()
-            msg = self.event.log(request=request,
-                                 ipobj=self.ip,
-                                 event_type='L',
-                                 messagekey='LONG_URL_SUBMITTED',
-                                 value=self.normalized_longurl,
-                                 longurl=dl,
-                                 shorturl=ds,
-                                 status_code=200
-                                 )
+            if getattr(settings, "ENABLE_PREVIEW_CACHE", True):
+                render_preview(ds, dl)
             #
-            # 8. Return the short url
+            # 7. Return the short url
             #
+            return ds.shorturl, msg
         else:
             #
             # YES IT DOES
@@ -223,29 +208,96 @@ class LongURL:
             #
             # 2. Lookup the short url. It must be active.
             #
-            s = ShortURLs.objects.get(longurl=l, is_active=True)
+            s = ShortURLs.objects.filter(longurl=l, is_active=True).first()
             if not s:
                 raise Http404
             #
             # 3. Log the lookup
             #
-            msg = self.event.log(
-                    request=request,
-                    ipobj=self.ip,
-                    event_type='R',
-                    messagekey='LONG_URL_RESUBMITTED',
-                    value=self.normalized_longurl,
-                    longurl=l,
-                    shorturl=s,
-                    status_code=200)
+            with xaction.atomic():
+                msg = self.event.log(
+                        request=request,
+                        ipobj=self.ip,
+                        event_type='R',
+                        messagekey='LONG_URL_RESUBMITTED',
+                        value=self.normalized_longurl,
+                        longurl=l,
+                        shorturl=s,
+                        status_code=200)
             #
             # 4. Return the short url
             #
-        return s.shorturl, msg
+            return s.shorturl, msg
+
+    def _insert_longurl(self):
+        """INSERTs the long url unless its hash already exists; returns the new LongURLs row, or None if it existed."""
+        dl = LongURLs(hash=self.hash,
+                      longurl=self.normalized_longurl,
+                      originally_encoded=self.longurl_is_preencoded,
+                      title=self.meta.title,
+                      description=self.meta.description,
+                      image_url=self.meta.image_url,
+                      byline=self.byline,
+                      site_name=self.meta.site_name,
+                      meta_status=self.meta.status,
+                      meta_status_msg=self.meta.status_msg,
+                      is_active=True
+                      )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                    "INSERT INTO %s (hash, longurl, originally_encoded, title, description, image_url, byline, site_name, "
+                    "meta_status, meta_status_msg, is_active) VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s) "
+                    "ON CONFLICT (hash) DO NOTHING RETURNING id" % LongURLs._meta.db_table,
+                    [dl.hash, dl.longurl, dl.originally_encoded, dl.title, dl.description, dl.image_url, dl.byline,
+                     dl.site_name, dl.meta_status, dl.meta_status_msg, dl.is_active])
+            row = cursor.fetchone()
+        if not row:
+            return None
+        # raw SQL doesn't go through the router, which would otherwise pin the client to the primary
+        mark_wrote_urls()
+        dl.id = row[0]
+        dl._state.adding = False
+        dl._state.db = connection.alias
+        return dl
+
+    def _insert_shorturl(self, s, dl):
+        """
+        INSERTs the short url for the new long url. A random short path that was taken in the meantime is regenerated;
+        a vanity path that was taken raises VANITY_PATH_EXISTS, rolling back the long url with it.
+        """
+        for attempt in range(SHORTURL_GENERATION_ATTEMPTS):
+            ds = ShortURLs(hash=s.hash,
+                           longurl_id=dl.id,
+                           shorturl=s.shorturl,
+                           compression_ratio=float(len(s.shorturl)) / float(len(self.normalized_longurl)),
+                           shorturl_path_size=settings.SHORTURL_PATH_SIZE,
+                           is_active=True
+                           )
+            with connection.cursor() as cursor:
+                cursor.execute(
+                        "INSERT INTO %s (hash, longurl_id, shorturl, compression_ratio, shorturl_path_size, is_active) "
+                        "VALUES (%%s, %%s, %%s, %%s, %%s, %%s) "
+                        "ON CONFLICT (hash) DO NOTHING RETURNING id" % ShortURLs._meta.db_table,
+                        [ds.hash, ds.longurl_id, ds.shorturl, ds.compression_ratio, ds.shorturl_path_size, ds.is_active])
+                row = cursor.fetchone()
+            if row:
+                mark_wrote_urls()
+                ds.id = row[0]
+                ds._state.adding = False
+                ds._state.db = connection.alias
+                shorturl_created(ds)
+                return ds
+            if self.vanity_path and self.vanity_path.strip():
+                break
+            s.make_short(self.normalized_longurl_scheme, None)
+        raise self.event.log(
+                messagekey='VANITY_PATH_EXISTS',
+                status_code=400)
 
 
 class Meta:
 
+    @timed('meta')
     def __init__(self, url, request=None):
 
         def _get_html_title(soupobj):
@@ -0,0 +1,78 @@
+'''
+build_redirect_table writes the memory-mapped redirect table that REDIRECT_TABLE_MODE serves redirects from (see
+snakraws/redirecttable.py), from the active short URLs and long URLs. The table is written next to its final name
+and renamed over it, so workers reading the old one pick up the new one whole:
+
+    ./manage.py build_redirect_table
+    ./manage.py build_redirect_table --path /var/lib/snakr/redirects.tbl
+'''
+
+import calendar
+import os
+import time
+
+from django.core.management import BaseCommand, CommandError
+from django.db import connection
+
+from snakraws import settings
+from snakraws.models import LongURLs, ShortURLs
+from snakraws.redirecttable import write_table
+from snakraws.utils import get_decodedurl
+
+TABLE_SQL = '''
+    SELECT s.hash, s.id, s.shorturl, s.cache_max_age, s.version, s.modified_on,
+           l.id, l.longurl, l.originally_encoded, l.title, l.description, l.image_url, l.byline, l.site_name
+    FROM {shorturls} s
+    JOIN {longurls} l ON l.id = s.longurl_id
+    WHERE s.id > 0 AND s.is_active AND l.is_active
+    ORDER BY s.hash
+'''
+
+
+class Command(BaseCommand):
+    help = 'Build the memory-mapped redirect table read by redirect-only nodes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', type=str, default=getattr(settings, "REDIRECT_TABLE_PATH", None),
+                            help='Table file to write (default REDIRECT_TABLE_PATH)')
+        parser.add_argument('--batch-size', type=int, default=50000,
+                            help='Rows fetched from the server-side cursor at a time (default 50000)')
+
+    def handle(self, *args, **kwargs):
+        filename = kwargs['path']
+        if not filename:
+            raise CommandError('No --path given and REDIRECT_TABLE_PATH is not set')
+        batch_size = max(kwargs['batch_size'], 1)
+        sql = TABLE_SQL.format(shorturls=ShortURLs._meta.db_table, longurls=LongURLs._meta.db_table)
+        tmpfilename = '%s.%d.tmp' % (filename, os.getpid())
+        started = time.time()
+
+        def entries():
+            # chunked_cursor() is a named (server-side) cursor on Postgres, so fetchmany() streams from the server
+            with connection.chunked_cursor() as cursor:
+                cursor.execute(sql)
+                while True:
+                    batch = cursor.fetchmany(batch_size)
+                    if not batch:
+                        break
+                    for shash, sid, shorturl, cache_max_age, version, modified_on, \
+                            lid, longurl, originally_encoded, title, description, image_url, byline, site_name in batch:
+                        yield shash, [
+                            sid, shorturl, cache_max_age, version,
+                            calendar.timegm(modified_on.utctimetuple()) if modified_on else None,
+                            lid, get_decodedurl(longurl) if originally_encoded else longurl,
+                            title, description, image_url, byline, site_name,
+                        ]
+
+        try:
+            with open(tmpfilename, 'wb') as f:
+                rows = write_table(f, entries())
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmpfilename, filename)
+        except BaseException:
+            if os.path.exists(tmpfilename):
+                os.remove(tmpfilename)
+            raise
+        self.stdout.write(self.style.SUCCESS('Wrote %d redirects (%d bytes) to %s in %.1fs'
+                                             % (rows, os.path.getsize(filename), filename, time.time() - started)))
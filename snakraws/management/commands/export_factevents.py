@@ -0,0 +1,194 @@
+'''
+export_factevents streams denormalized FactEvent rows (the fact joined to all of its dimensions) to compressed
+columnar Parquet or Arrow IPC files for offline analysis.
+
+Rows are read through a server-side cursor and written one record batch at a time, so memory use is constant no
+matter how many facts are exported. With --incremental, each run resumes after the last fact id it exported.
+
+Requires pyarrow (pip install pyarrow).
+'''
+
+import os
+import time
+
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, transaction as xaction
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+    PYARROW = True
+except ImportError:
+    PYARROW = False
+
+from snakraws.models import FactEvent, LongURLs, ShortURLs, DimGeoLocation, DimDevice, DimHost, DimIP, \
+    DimReferer, DimUserAgent
+from snakraws.persistence import current_max_id, lock_watermark, save_watermark, settled_max_id
+
+EXPORT_WATERMARK = 'export_factevents'
+
+EXPORT_SQL = '''
+    SELECT f.id, f.event_yyyymmdd, f.event_hhmiss, f.event_type, f.http_status_code, f.cid, f.info,
+           s.shorturl, l.longurl,
+           g.postalcode, g.city, g.regionname, g.regioncode, g.countryname, g.countrycode, g.lat, g.lng,
+           i.ip, h.hostname, r.referer, u.useragent, d.deviceid
+    FROM {facts} f
+    JOIN {shorturls} s ON s.id = f.shorturl_id
+    JOIN {longurls} l ON l.id = f.longurl_id
+    JOIN {geo} g ON g.id = f.geo_id
+    JOIN {ips} i ON i.id = f.ip_id
+    JOIN {hosts} h ON h.id = f.host_id
+    JOIN {referers} r ON r.id = f.referer_id
+    JOIN {useragents} u ON u.id = f.useragent_id
+    JOIN {devices} d ON d.id = f.device_id
+    WHERE f.id > %s AND f.id <= %s
+'''
+
+# (column, arrow type name) in EXPORT_SQL select order
+EXPORT_COLUMNS = (
+    ('id', 'int64'),
+    ('event_yyyymmdd', 'string'),
+    ('event_hhmiss', 'string'),
+    ('event_type', 'string'),
+    ('http_status_code', 'int16'),
+    ('cid', 'string'),
+    ('info', 'string'),
+    ('shorturl', 'string'),
+    ('longurl', 'string'),
+    ('postalcode', 'string'),
+    ('city', 'string'),
+    ('regionname', 'string'),
+    ('regioncode', 'string'),
+    ('countryname', 'string'),
+    ('countrycode', 'string'),
+    ('lat', 'float64'),
+    ('lng', 'float64'),
+    ('ip', 'string'),
+    ('hostname', 'string'),
+    ('referer', 'string'),
+    ('useragent', 'string'),
+    ('deviceid', 'string'),
+)
+
+
+class Command(BaseCommand):
+    help = 'Export denormalized FactEvent rows to compressed Parquet or Arrow files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', type=str, required=True,
+                            help='Directory to write the export file to')
+        parser.add_argument('--format', choices=['parquet', 'arrow'], default='parquet')
+        parser.add_argument('--compression', choices=['zstd', 'snappy', 'gzip', 'lz4', 'none'], default='zstd')
+        parser.add_argument('--from', dest='from_yyyymmdd', type=str, default=None,
+                            help='Only export facts on or after this day (YYYYMMDD)')
+        parser.add_argument('--to', dest='to_yyyymmdd', type=str, default=None,
+                            help='Only export facts on or before this day (YYYYMMDD)')
+        parser.add_argument('--incremental', action='store_true',
+                            help='Resume after the last fact id exported by the previous incremental run')
+        parser.add_argument('--batch-size', type=int, default=50000,
+                            help='Rows fetched from the server-side cursor and written per record batch (default 50000)')
+
+    def handle(self, *args, **kwargs):
+        if not PYARROW:
+            raise CommandError('export_factevents requires pyarrow; pip install pyarrow')
+        path = kwargs['path']
+        if not os.path.isdir(path):
+            raise CommandError('%s is not a directory' % path)
+        if kwargs['incremental'] and (kwargs['from_yyyymmdd'] or kwargs['to_yyyymmdd']):
+            # the watermark would move past facts the date range left out, and they would never be exported
+            raise CommandError('--incremental cannot be combined with --from/--to')
+        batch_size = max(kwargs['batch_size'], 1)
+        compression = None if kwargs['compression'] == 'none' else kwargs['compression']
+        schema = pyarrow.schema([(name, getattr(pyarrow, typename)()) for name, typename in EXPORT_COLUMNS])
+
+        sql = EXPORT_SQL.format(
+                facts=FactEvent._meta.db_table,
+                shorturls=ShortURLs._meta.db_table,
+                longurls=LongURLs._meta.db_table,
+                geo=DimGeoLocation._meta.db_table,
+                ips=DimIP._meta.db_table,
+                hosts=DimHost._meta.db_table,
+                referers=DimReferer._meta.db_table,
+                useragents=DimUserAgent._meta.db_table,
+                devices=DimDevice._meta.db_table)
+        if kwargs['from_yyyymmdd']:
+            sql += ' AND f.event_yyyymmdd >= %s'
+        if kwargs['to_yyyymmdd']:
+            sql += ' AND f.event_yyyymmdd <= %s'
+        sql += ' ORDER BY f.id'
+
+        if kwargs['incremental']:
+            # only incremental runs take the watermark and move the ceiling they depend on, and only briefly
+            with xaction.atomic():
+                lo = lock_watermark(EXPORT_WATERMARK).last_id
+                hi = settled_max_id(EXPORT_WATERMARK, FactEvent._meta.db_table)
+        else:
+            lo = 0
+            hi = current_max_id(FactEvent._meta.db_table)
+        if lo >= hi:
+            self.stdout.write('Nothing to export after fact id %d' % lo)
+            return
+        params = [lo, hi] + [v for v in (kwargs['from_yyyymmdd'], kwargs['to_yyyymmdd']) if v]
+
+        extension = 'parquet' if kwargs['format'] == 'parquet' else 'arrow'
+        filename = os.path.join(path, 'factevents_%d_%d.%s' % (lo + 1, hi, extension))
+        tmpfilename = filename + '.tmp'
+        started = time.time()
+        rows = 0
+        if kwargs['format'] == 'parquet':
+            writer = pyarrow.parquet.ParquetWriter(tmpfilename, schema, compression=compression)
+        else:
+            options = pyarrow.ipc.IpcWriteOptions(compression=compression) if compression in ('zstd', 'lz4') else None
+            writer = pyarrow.ipc.new_file(tmpfilename, schema, options=options)
+        try:
+            try:
+                # a read-only transaction that locks nothing; the server-side cursor needs one to stream
+                with xaction.atomic():
+                    with connection.cursor() as cursor:
+                        cursor.execute('SET TRANSACTION READ ONLY')
+                    # chunked_cursor() is a named (server-side) cursor on Postgres, so fetchmany() streams from the
+                    # server
+                    with connection.chunked_cursor() as cursor:
+                        cursor.execute(sql, params)
+                        while True:
+                            batch = cursor.fetchmany(batch_size)
+                            if not batch:
+                                break
+                            writer.write_table(self._to_table(batch, schema))
+                            rows += len(batch)
+                            self.stdout.write('%d rows (%.0f rows/sec)'
+                                              % (rows, rows / max(time.time() - started, 0.001)))
+            finally:
+                writer.close()
+        except BaseException:
+            if os.path.exists(tmpfilename):
+                os.remove(tmpfilename)
+            raise
+
+        if kwargs['incremental']:
+            with xaction.atomic():
+                watermark = lock_watermark(EXPORT_WATERMARK)
+                if watermark.last_id != lo:
+                    os.remove(tmpfilename)
+                    raise CommandError('Another incremental export moved the watermark to fact id %d; run again'
+                                       % watermark.last_id)
+                os.replace(tmpfilename, filename)
+                save_watermark(watermark, last_id=hi)
+        else:
+            os.replace(tmpfilename, filename)
+
+        self.stdout.write(self.style.SUCCESS('Exported %d facts (ids %d..%d) to %s in %.1fs'
+                                             % (rows, lo + 1, hi, filename, time.time() - started)))
+
+    @staticmethod
+    def _to_table(batch, schema):
+        columns = list(zip(*batch))
+        arrays = []
+        for idx, (name, typename) in enumerate(EXPORT_COLUMNS):
+            values = columns[idx]
+            if typename == 'float64':
+                # lat/lng come back from NUMERIC columns as Decimals
+                values = [float(v) if v is not None else None for v in values]
+            arrays.append(pyarrow.array(values, type=schema.field(name).type))
+        return pyarrow.Table.from_arrays(arrays, schema=schema)
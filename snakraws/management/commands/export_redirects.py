@@ -0,0 +1,189 @@
+'''
+export_redirects writes the short URL to long URL mapping in a form an edge cache, CDN worker or nginx can serve
+redirects from without calling Snakr.
+
+A snapshot holds every active short URL. With --delta, only the short URLs added or changed since the previous run
+are written, deactivated ones included (with status 404), resuming from a timestamp watermark. Rows changed in the
+last --settle-seconds are left for the next run, so a transaction that was still open when the export ran is never
+skipped. Each line maps a short URL path to its long URL and status:
+
+    jsonl   {"host": "bret.guru", "path": "/a6yEw4", "longurl": "https://...", "status": 301}
+    nginx   /a6yEw4 "https://...";     (the body of a `map $uri $snakr_longurl { ... }` block; snapshots only)
+
+With --verify, a sample of the exported entries is resolved through ShortURL.get_long inside a transaction that is
+rolled back, and the export fails unless every one agrees:
+
+    ./manage.py export_redirects --path /data/edge --format nginx --verify 1000
+    ./manage.py export_redirects --path /data/edge --delta
+'''
+
+import contextlib
+import json
+import os
+import random
+import time
+from unittest import mock
+from urllib.parse import urlparse
+
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, transaction as xaction
+from django.http import Http404
+from django.test import RequestFactory
+from django.utils import timezone
+
+from snakraws.models import LongURLs, ShortURLs
+from snakraws.persistence import lock_watermark, save_watermark
+from snakraws.shorturls import ShortURL
+from snakraws.stubs import STUB_IP, StubResponse
+from snakraws.utils import get_decodedurl
+
+EXPORT_WATERMARK = 'export_redirects'
+
+EXPORT_SQL = '''
+    SELECT s.shorturl, l.longurl, l.originally_encoded, s.is_active AND l.is_active
+    FROM {shorturls} s
+    JOIN {longurls} l ON l.id = s.longurl_id
+    WHERE s.id > 0 AND s.modified_on <= %s
+'''
+
+VERIFY_USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/76.0 Safari/537.36'
+VERIFY_REMOTE_ADDR = STUB_IP
+
+
+def _nginx_string(value):
+    # nginx would expand $variables in a map value, and a URL means the same with its $ percent-encoded
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"').replace('$', '%24')
+
+
+class Command(BaseCommand):
+    help = 'Export the short URL to long URL mapping for edge caches, CDN workers or an nginx map'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', type=str, required=True,
+                            help='Directory to write the export file to')
+        parser.add_argument('--format', choices=['jsonl', 'nginx'], default='jsonl')
+        parser.add_argument('--delta', action='store_true',
+                            help='Only export short URLs added or changed since the previous run')
+        parser.add_argument('--settle-seconds', type=int, default=60,
+                            help='Leave rows changed this recently for the next run (default 60)')
+        parser.add_argument('--verify', type=int, default=0, metavar='N',
+                            help='Check N sampled entries against ShortURL.get_long and fail on any mismatch')
+        parser.add_argument('--batch-size', type=int, default=50000,
+                            help='Rows fetched from the server-side cursor at a time (default 50000)')
+
+    def handle(self, *args, **kwargs):
+        path = kwargs['path']
+        if not os.path.isdir(path):
+            raise CommandError('%s is not a directory' % path)
+        if kwargs['delta'] and kwargs['format'] == 'nginx':
+            # nginx loads a map whole and rejects duplicate keys, so it can't apply a delta on top of a snapshot
+            raise CommandError('nginx maps can only be exported as snapshots; use --format jsonl for deltas')
+        batch_size = max(kwargs['batch_size'], 1)
+        sql = EXPORT_SQL.format(shorturls=ShortURLs._meta.db_table, longurls=LongURLs._meta.db_table)
+
+        with xaction.atomic():
+            watermark = lock_watermark(EXPORT_WATERMARK)
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT (now() AT TIME ZONE 'UTC') - make_interval(secs => %s)",
+                               [max(kwargs['settle_seconds'], 0)])
+                cutoff = cursor.fetchone()[0]
+            params = [cutoff]
+            if kwargs['delta']:
+                if watermark.last_ts is None:
+                    raise CommandError('No previous export to take a delta from; run a snapshot first')
+                since = timezone.make_naive(watermark.last_ts, timezone.utc) \
+                    if timezone.is_aware(watermark.last_ts) else watermark.last_ts
+                if since >= cutoff:
+                    self.stdout.write('Nothing to export since %s' % since.isoformat())
+                    return
+                sql += ' AND s.modified_on > %s'
+                params.append(since)
+                name = 'redirects_delta_%s_%s' % (since.strftime('%Y%m%d%H%M%S'), cutoff.strftime('%Y%m%d%H%M%S'))
+            else:
+                sql += ' AND s.is_active AND l.is_active'
+                name = 'redirects_snapshot_%s' % cutoff.strftime('%Y%m%d%H%M%S')
+            sql += ' ORDER BY s.id'
+
+            filename = os.path.join(path, '%s.%s' % (name, 'map' if kwargs['format'] == 'nginx' else 'jsonl'))
+            tmpfilename = filename + '.tmp'
+            started = time.time()
+            rows = 0
+            sample = []
+            with open(tmpfilename, 'wt', encoding='utf-8') as f:
+                # chunked_cursor() is a named (server-side) cursor on Postgres, so fetchmany() streams from the server
+                with connection.chunked_cursor() as cursor:
+                    cursor.execute(sql, params)
+                    while True:
+                        batch = cursor.fetchmany(batch_size)
+                        if not batch:
+                            break
+                        for shorturl, longurl, originally_encoded, is_active in batch:
+                            entry = self._entry(shorturl, longurl, originally_encoded, is_active)
+                            if kwargs['format'] == 'nginx':
+                                f.write('%s %s;\n' % (_nginx_string(entry['path']), _nginx_string(entry['longurl'])))
+                            else:
+                                f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+                            rows += 1
+                            # reservoir sample of the entries to verify
+                            if len(sample) < kwargs['verify']:
+                                sample.append((shorturl, entry))
+                            elif kwargs['verify'] and random.randrange(rows) < kwargs['verify']:
+                                sample[random.randrange(kwargs['verify'])] = (shorturl, entry)
+                        self.stdout.write('%d rows (%.0f rows/sec)' % (rows, rows / max(time.time() - started, 0.001)))
+
+            try:
+                if sample:
+                    self._verify(sample)
+            except CommandError:
+                os.remove(tmpfilename)
+                raise
+            os.replace(tmpfilename, filename)
+            save_watermark(watermark, last_ts=timezone.make_aware(cutoff, timezone.utc))
+
+        self.stdout.write(self.style.SUCCESS('Exported %d redirects to %s in %.1fs'
+                                             % (rows, filename, time.time() - started)))
+
+    @staticmethod
+    def _entry(shorturl, longurl, originally_encoded, is_active):
+        parts = urlparse(shorturl)
+        return {
+            'host': parts.netloc,
+            'path': parts.path,
+            'longurl': get_decodedurl(longurl) if originally_encoded else longurl,
+            'status': 301 if is_active else 404,
+        }
+
+    def _verify(self, sample):
+        factory = RequestFactory()
+        mismatches = []
+        with contextlib.ExitStack() as stack:
+            # resolving a short url logs an event and counts a click; keep all of that out of the real data
+            stack.enter_context(mock.patch('requests.get', return_value=StubResponse()))
+            stack.enter_context(mock.patch('snakraws.persistence.forward_hit'))
+            stack.enter_context(mock.patch('snakraws.shorturls.count_click'))
+            stack.enter_context(mock.patch('snakraws.shorturls.track_redirect'))
+            with xaction.atomic():
+                for shorturl, entry in sample:
+                    request = factory.get(entry['path'],
+                                          secure=urlparse(shorturl).scheme == 'https',
+                                          HTTP_HOST=entry['host'],
+                                          HTTP_USER_AGENT=VERIFY_USER_AGENT,
+                                          REMOTE_ADDR=VERIFY_REMOTE_ADDR)
+                    try:
+                        with xaction.atomic():
+                            l, status = ShortURL(request).get_long(request)
+                        got = (l.longurl, status)
+                    except Http404:
+                        got = (None, 404)
+                    except Exception as e:
+                        got = (None, '%s: %s' % (e.__class__.__name__, str(e)))
+                    expected = (entry['longurl'] if entry['status'] == 301 else None, entry['status'])
+                    if got != expected:
+                        mismatches.append((shorturl, expected, got))
+                xaction.set_rollback(True)
+        for shorturl, expected, got in mismatches[:20]:
+            self.stderr.write('%s: exported %s, get_long gave %s' % (shorturl, expected, got))
+        if mismatches:
+            raise CommandError('%d of %d sampled redirects disagree with ShortURL.get_long'
+                               % (len(mismatches), len(sample)))
+        self.stdout.write('Verified %d sampled redirects against ShortURL.get_long' % len(sample))
@@ -1,40 +1,129 @@
-# import csv
-# from django.core.management import BaseCommand
-# from snakraws.models import DimGeoLocation
-#
-# class Command(BaseCommand):
-#     help = 'Load a csv of geolocations into the datastore'
-#
-#     def add_arguments(self, parser):
-#         parser.add_argument('--path', type=str)
-#
-#     def handle(self, *args, **kwargs):
-#         path = kwargs['path']
-#         with open(path, 'rt') as f:
-#             fnmap = []
-#             reader = csv.reader(f, dialect='excel')
-#             header_processed = False
-#             for row in reader:
-#                 if not header_processed:
-#                     col = 0
-#                     while row[col]:
-#                         for fn in ['providername', 'postalcode', 'lat', 'lng', 'city',
-#                                    'regionname', 'regioncode', 'countryname', 'countrycode',
-#                                    'countyname', 'countyweight', 'allcountyweights']:
-#                             if row[col] == fn:
-#                                 fnmap.append(fn)
-#                                 break
-#                         fnmap.append("SKIP")
-#                         col += col
-#                     fnmap = fnmap[::-1]
-#                     header_processed = True
-#                 else:
-#                     col = 0
-#                     rmap = fnmap
-#                     fn = rmap.pop(0)
-#                     while fn:
-#                         if fn != "SKIP":
-#                             if fn
-#
-#
-#
+'''
+load_geolocations_from_csv bulk loads (or refreshes) postal-code geolocation reference data into snakraws_dimgeolocations.
+
+The CSV is streamed in chunks; each chunk is COPYed into a session-local staging table and merged into the dimension
+with a single INSERT ... ON CONFLICT, so multi-million-row files load in minutes rather than hours of ORM saves.
+Existing rows flagged is_mutable = FALSE are never overwritten.
+
+The first row must be a header naming the columns to load; unrecognized columns are ignored, and postalcode is required:
+
+    providername, postalcode, lat, lng, city, regionname, regioncode, countryname, countrycode,
+    countyname, countyweight, allcountyweights
+'''
+
+import csv
+import io
+import time
+from itertools import islice
+
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, transaction as xaction
+
+from snakraws.models import DimGeoLocation
+from snakraws.utils import get_hash
+
+GEO_COLUMNS = ['providername', 'postalcode', 'lat', 'lng', 'city', 'regionname', 'regioncode', 'countryname',
+               'countrycode', 'countyname', 'countyweight', 'allcountyweights']
+
+STAGING_TABLE = 'snakraws_dimgeolocations_staging'
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class Command(BaseCommand):
+    help = 'Bulk load a csv of postal code geolocations into the datastore'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', type=str, required=True)
+        parser.add_argument('--provider', type=str, default='snakr',
+                            help='providername to use when the csv has no providername column (default snakr)')
+        parser.add_argument('--chunk-size', type=int, default=50000,
+                            help='Rows copied and merged per transaction (default 50000)')
+        parser.add_argument('--delimiter', type=str, default=',')
+        parser.add_argument('--encoding', type=str, default='utf-8')
+        parser.add_argument('--immutable', action='store_true',
+                            help='Flag loaded rows is_mutable = FALSE so that geolocation lookups never overwrite them')
+
+    def handle(self, *args, **kwargs):
+        chunk_size = max(kwargs['chunk_size'], 1)
+        self.provider = kwargs['provider']
+        self.max_lengths = dict((fn, DimGeoLocation._meta.get_field(fn).max_length) for fn in GEO_COLUMNS)
+        table = DimGeoLocation._meta.db_table
+        columns = ['hash', 'is_mutable'] + GEO_COLUMNS
+        updates = ', '.join('%s = EXCLUDED.%s' % (fn, fn) for fn in GEO_COLUMNS if fn != 'postalcode')
+        merge_sql = 'INSERT INTO {table} ({columns}) ' \
+                    'SELECT DISTINCT ON (hash) {columns} FROM {staging} ORDER BY hash ' \
+                    'ON CONFLICT (hash) DO UPDATE SET {updates}, is_mutable = EXCLUDED.is_mutable ' \
+                    'WHERE {table}.is_mutable'.format(table=table,
+                                                      staging=STAGING_TABLE,
+                                                      columns=', '.join(columns),
+                                                      updates=updates)
+        copy_sql = 'COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (STAGING_TABLE, ', '.join(columns))
+
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE TEMP TABLE IF NOT EXISTS %s ('
+                           'hash BIGINT NOT NULL, is_mutable BOOLEAN NOT NULL, '
+                           'providername VARCHAR(50) NOT NULL, postalcode VARCHAR(32) NOT NULL, '
+                           'lat NUMERIC(7, 4) NULL, lng NUMERIC(7, 4) NULL, city VARCHAR(100) NULL, '
+                           'regionname VARCHAR(100) NULL, regioncode VARCHAR(2) NULL, countryname VARCHAR(100) NULL, '
+                           'countrycode VARCHAR(2) NULL, countyname VARCHAR(100) NULL, countyweight NUMERIC(5, 2) NULL, '
+                           'allcountyweights VARCHAR(100) NULL)' % STAGING_TABLE)
+
+        started = time.time()
+        read = 0
+        merged = 0
+        try:
+            with open(kwargs['path'], 'rt', encoding=kwargs['encoding'], newline='') as f:
+                rows = self._read_rows(f, kwargs['delimiter'], not kwargs['immutable'])
+                for chunk in _chunks(rows, chunk_size):
+                    buf = io.StringIO()
+                    csv.writer(buf).writerows(chunk)
+                    buf.seek(0)
+                    with xaction.atomic():
+                        with connection.cursor() as cursor:
+                            cursor.copy_expert(copy_sql, buf)
+                            cursor.execute(merge_sql)
+                            merged += cursor.rowcount
+                            cursor.execute('TRUNCATE %s' % STAGING_TABLE)
+                    read += len(chunk)
+                    elapsed = max(time.time() - started, 0.001)
+                    self.stdout.write('%d rows read, %d rows inserted or updated (%.0f rows/sec)' % (read, merged, read / elapsed))
+        except (OSError, csv.Error, UnicodeDecodeError) as e:
+            raise CommandError('Unable to load %s: %s' % (kwargs['path'], str(e)))
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute('DROP TABLE IF EXISTS %s' % STAGING_TABLE)
+
+        elapsed = max(time.time() - started, 0.001)
+        self.stdout.write(self.style.SUCCESS('Loaded %d rows (%d inserted or updated) in %.1fs, %.0f rows/sec'
+                                             % (read, merged, elapsed, read / elapsed)))
+
+    def _read_rows(self, f, delimiter, is_mutable):
+        reader = csv.reader(f, delimiter=delimiter)
+        header = next(reader, None)
+        if not header:
+            raise CommandError('The csv is empty')
+        fnmap = [fn.strip().lower() for fn in header]
+        if 'postalcode' not in fnmap:
+            raise CommandError('The csv header must include a postalcode column')
+        for row in reader:
+            values = dict((fn, value.strip()) for fn, value in zip(fnmap, row) if fn in self.max_lengths)
+            postalcode = values.get('postalcode', '')
+            if not postalcode:
+                continue
+            out = [get_hash(postalcode.lower()), is_mutable]
+            for fn in GEO_COLUMNS:
+                value = values.get(fn, '') or None
+                if fn == 'providername' and not value:
+                    value = self.provider
+                if value and self.max_lengths[fn]:
+                    value = value[:self.max_lengths[fn]]
+                out.append(value)
+            yield out
@@ -0,0 +1,96 @@
+'''
+rollup_factevents incrementally folds new FactEvent rows into the daily and hourly rollup tables.
+
+Each run picks up where the previous one left off using a high-water mark on snakraws_factevents.id, so the
+fact table is only ever scanned by primary key range. Each run only goes as far as the max id seen by the run before
+it, so the very first run rolls up nothing and only records where the next one stops; pass --now to roll up
+everything at once when nothing else is writing facts. Run it from cron every few minutes, e.g.:
+
+    */5 * * * * /var/www/django/venv/bin/python /var/www/django/manage.py rollup_factevents
+'''
+
+import time
+
+from django.core.management import BaseCommand
+from django.db import connection, transaction as xaction
+
+from snakraws.models import FactEvent, DimGeoLocation, RollupDaily, RollupHourly
+from snakraws.persistence import lock_watermark, save_watermark, settled_max_id
+
+# name of the watermark holding the last fact id folded into the rollups
+ROLLUP_WATERMARK = 'rollup_factevents'
+
+ROLLUP_DAILY_SQL = '''
+    INSERT INTO {daily} (shorturl_id, event_yyyymmdd, countrycode, event_type, events)
+    SELECT f.shorturl_id, f.event_yyyymmdd, COALESCE(g.countrycode, 'zz'), f.event_type, COUNT(*)
+    FROM {facts} f
+    JOIN {geo} g ON g.id = f.geo_id
+    WHERE f.id > %s AND f.id <= %s
+    GROUP BY 1, 2, 3, 4
+    ON CONFLICT (shorturl_id, event_yyyymmdd, countrycode, event_type)
+    DO UPDATE SET events = {daily}.events + EXCLUDED.events
+'''
+
+ROLLUP_HOURLY_SQL = '''
+    INSERT INTO {hourly} (shorturl_id, event_yyyymmdd, event_hh, event_type, events)
+    SELECT f.shorturl_id, f.event_yyyymmdd, SUBSTRING(f.event_hhmiss FROM 1 FOR 2), f.event_type, COUNT(*)
+    FROM {facts} f
+    WHERE f.id > %s AND f.id <= %s
+    GROUP BY 1, 2, 3, 4
+    ON CONFLICT (shorturl_id, event_yyyymmdd, event_hh, event_type)
+    DO UPDATE SET events = {hourly}.events + EXCLUDED.events
+'''
+
+
+class Command(BaseCommand):
+    help = 'Incrementally roll up new FactEvent rows into the daily and hourly rollup tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100000,
+                            help='Maximum number of fact ids to fold per transaction (default 100000)')
+        parser.add_argument('--now', action='store_true',
+                            help='Roll up to the current maximum fact id instead of the one seen by the previous run')
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Empty the rollup tables and rebuild them from the first fact')
+
+    def handle(self, *args, **kwargs):
+        batch_size = max(kwargs['batch_size'], 1)
+        tables = {
+            'daily': RollupDaily._meta.db_table,
+            'hourly': RollupHourly._meta.db_table,
+            'facts': FactEvent._meta.db_table,
+            'geo': DimGeoLocation._meta.db_table,
+        }
+        daily_sql = ROLLUP_DAILY_SQL.format(**tables)
+        hourly_sql = ROLLUP_HOURLY_SQL.format(**tables)
+
+        with xaction.atomic():
+            if kwargs['rebuild']:
+                with connection.cursor() as cursor:
+                    cursor.execute('TRUNCATE %s, %s' % (tables['daily'], tables['hourly']))
+                save_watermark(lock_watermark(ROLLUP_WATERMARK), last_id=0)
+            # only roll up to the max fact id seen by the previous run, so that facts still inside an open request
+            # transaction when this run starts are picked up by the next run instead of skipped
+            hi = settled_max_id(ROLLUP_WATERMARK, tables['facts'], kwargs['now'] or kwargs['rebuild'])
+
+        started = time.time()
+        folded = 0
+        while True:
+            with xaction.atomic():
+                watermark = lock_watermark(ROLLUP_WATERMARK)
+                lo = watermark.last_id
+                if lo >= hi:
+                    break
+                batch_hi = min(lo + batch_size, hi)
+                with connection.cursor() as cursor:
+                    cursor.execute(daily_sql, [lo, batch_hi])
+                    cursor.execute(hourly_sql, [lo, batch_hi])
+                save_watermark(watermark, last_id=batch_hi)
+            folded += batch_hi - lo
+            self.stdout.write('Rolled up fact ids %d..%d' % (lo + 1, batch_hi))
+
+        elapsed = time.time() - started
+        if not hi:
+            self.stdout.write('No settled fact ids yet; the next run rolls up the facts that exist now')
+        self.stdout.write(self.style.SUCCESS(
+                'Rollups current through fact id %d (%d ids in %.1fs)' % (hi, folded, elapsed)))
@@ -0,0 +1,278 @@
+'''
+run_benchmarks times Snakr's hot paths and saves the results as JSON so runs can be compared for regressions.
+
+Micro-benchmarks time get_hash, is_profane, get_shortpathcandidate, is_url_valid (memoized and not) and bot detection
+in-process.
+End-to-end benchmarks shorten unique long URLs through views.api_handler and then redirect them through
+views.request_handler at the requested concurrency, reporting throughput, p50/p95/p99 latency and SQL queries per
+request. Outbound HTTP (geolocation, long URL metadata, Google Analytics) is stubbed, so only Snakr and its database
+are measured. End-to-end runs write real rows, and the API only shortens when SITE_MODE is dev, so run them on a dev
+configuration against a local Postgres:
+
+    ./manage.py run_benchmarks --requests 1000 --concurrency 8 --output bench.json
+    ./manage.py run_benchmarks --output bench2.json --compare bench.json
+'''
+
+import contextlib
+import datetime
+import json
+import statistics
+import threading
+import time
+import timeit
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from django.core.management import BaseCommand, CommandError
+from django.db import close_old_connections, connection, connections
+from django.test import RequestFactory
+
+from snakraws import settings, views
+from snakraws.security import get_useragent_or_403_if_bot
+from snakraws.stubs import STUB_IP, StubResponse
+from snakraws.utils import get_hash, get_shortpathcandidate, is_profane, is_url_valid, validate_urls
+
+BENCHMARK_USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/76.0 Safari/537.36'
+BENCHMARK_BOT_USER_AGENT = 'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)'
+BENCHMARK_LONGURL = 'https://www.example.com/articles/2019/06/benchmarking-url-shorteners?utm_source=snakr&id=%s'
+BENCHMARK_REMOTE_ADDR = STUB_IP
+
+
+def _percentile(ordered, pct):
+    if not ordered:
+        return None
+    return ordered[min(int(round(pct / 100.0 * (len(ordered) - 1))), len(ordered) - 1)]
+
+
+class QueryCounter:
+    """connection.execute_wrapper() hook counting the statements run on this thread's connection."""
+
+    def __init__(self):
+        self.count = 0
+        return
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = 'Run micro and end-to-end benchmarks of the redirect and shorten paths, optionally comparing to a saved run'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200,
+                            help='End-to-end requests per scenario (default 200)')
+        parser.add_argument('--concurrency', type=int, default=4,
+                            help='Concurrent end-to-end requests (default 4)')
+        parser.add_argument('--stub-latency-ms', type=float, default=0.0,
+                            help='Simulated latency of each stubbed outbound HTTP call (default 0)')
+        parser.add_argument('--micro-only', action='store_true')
+        parser.add_argument('--e2e-only', action='store_true')
+        parser.add_argument('--output', type=str, default=None,
+                            help='Write the results as JSON to this file')
+        parser.add_argument('--compare', type=str, default=None,
+                            help='A previous --output file to compare against')
+        parser.add_argument('--threshold', type=float, default=10.0,
+                            help='Percent slowdown reported as a regression by --compare (default 10)')
+        parser.add_argument('--force', action='store_true',
+                            help='Allow end-to-end runs when DATABASE_MODE is prod')
+
+    def handle(self, *args, **kwargs):
+        if kwargs['micro_only'] and kwargs['e2e_only']:
+            raise CommandError('--micro-only and --e2e-only are mutually exclusive')
+        if not kwargs['micro_only'] and getattr(settings, 'DATABASE_MODE', 'prod') == 'prod' and not kwargs['force']:
+            raise CommandError('End-to-end benchmarks write short URLs and events; run them against a dev database '
+                               'or pass --force')
+        if not kwargs['micro_only'] and getattr(settings, 'SITE_MODE', 'prod') != 'dev':
+            # post_handler answers every API shorten with a 403 outside dev, so there would be nothing to time
+            raise CommandError('End-to-end benchmarks shorten through the API, which is disabled unless SITE_MODE is '
+                               'dev; set SITE_MODE = \'dev\' or pass --micro-only')
+        previous = None
+        if kwargs['compare']:
+            try:
+                with open(kwargs['compare'], 'rt') as f:
+                    previous = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError('Unable to read %s: %s' % (kwargs['compare'], str(e)))
+
+        self.factory = RequestFactory()
+        results = {
+            'started': datetime.datetime.utcnow().isoformat(),
+            'settings': {
+                'concurrency': kwargs['concurrency'],
+                'requests': kwargs['requests'],
+                'stub_latency_ms': kwargs['stub_latency_ms'],
+                'enable_analytics': getattr(settings, 'ENABLE_ANALYTICS', False),
+                'enable_bot_detection': getattr(settings, 'ENABLE_BOT_DETECTION', True),
+            },
+        }
+        with self._stubbed_outbound_http(kwargs['stub_latency_ms']):
+            if not kwargs['e2e_only']:
+                results['micro'] = self._run_micro()
+            if not kwargs['micro_only']:
+                results['e2e'] = self._run_e2e(max(kwargs['requests'], 1), max(kwargs['concurrency'], 1))
+
+        if kwargs['output']:
+            with open(kwargs['output'], 'wt') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            self.stdout.write('Results written to %s' % kwargs['output'])
+        if previous:
+            self._compare(previous, results, kwargs['threshold'])
+
+    @contextlib.contextmanager
+    def _stubbed_outbound_http(self, latency_ms):
+        def _stub(*args, **kwargs):
+            if latency_ms:
+                time.sleep(latency_ms / 1000.0)
+            return StubResponse()
+
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(mock.patch('requests.get', side_effect=_stub))
+            stack.enter_context(mock.patch('snakraws.longurls.urlopen', side_effect=_stub))
+            stack.enter_context(mock.patch('snakraws.persistence.forward_hit'))
+            yield
+
+    def _request(self, method, path, user_agent=BENCHMARK_USER_AGENT, **extra):
+        builder = getattr(self.factory, method)
+        return builder(path,
+                       secure=getattr(settings, 'SSL_ENABLED', False),
+                       HTTP_HOST=settings.SHORTURL_HOST,
+                       HTTP_USER_AGENT=user_agent,
+                       REMOTE_ADDR=BENCHMARK_REMOTE_ADDR,
+                       **extra)
+
+    #
+    # micro-benchmarks
+    #
+    def _run_micro(self):
+        human = self._request('get', '/bench')
+        bot = self._request('get', '/bench', user_agent=BENCHMARK_BOT_USER_AGENT)
+        longurl = BENCHMARK_LONGURL % 'micro'
+        cases = [
+            ('get_hash', lambda: get_hash(longurl)),
+            ('is_profane', lambda: is_profane(longurl)),
+            ('get_shortpathcandidate', lambda: get_shortpathcandidate()),
+            ('is_url_valid', lambda: is_url_valid(longurl)),
+            ('is_url_valid_uncached', lambda: validate_urls([longurl])),
+            ('bot_detection_human', lambda: get_useragent_or_403_if_bot(human)),
+            ('bot_detection_bot', lambda: get_useragent_or_403_if_bot(bot)),
+        ]
+        results = {}
+        for name, func in cases:
+            timer = timeit.Timer(func)
+            number, _ = timer.autorange()
+            runs = [t / number for t in timer.repeat(repeat=5, number=number)]
+            results[name] = {
+                'calls_per_run': number,
+                'best_us': min(runs) * 1e6,
+                'median_us': statistics.median(runs) * 1e6,
+            }
+            self.stdout.write('%-26s %12.2f us/call (best of 5 x %d)' % (name, results[name]['best_us'], number))
+        return results
+
+    #
+    # end-to-end benchmarks
+    #
+    def _run_e2e(self, requests, concurrency):
+        run_id = uuid.uuid4().hex[:12]
+        shortened = []
+        shortened_lock = threading.Lock()
+
+        def _shorten(n):
+            body = json.dumps({'lu': BENCHMARK_LONGURL % ('%s-%d' % (run_id, n))})
+            response = views.api_handler(self._request('post', '/api/', data=body, content_type='application/json'))
+            shorturl = json.loads(response.content.decode('utf8')).get('shorturl', None)
+            if not shorturl:
+                raise ValueError('api_handler returned no short URL')
+            with shortened_lock:
+                shortened.append(shorturl)
+            return response
+
+        def _redirect(n):
+            path = shortened[n % len(shortened)].split(settings.SHORTURL_HOST, 1)[-1]
+            return views.request_handler(self._request('get', path))
+
+        results = {}
+        results['shorten'] = self._drive('shorten', _shorten, requests, concurrency)
+        if not shortened:
+            raise CommandError('No short URLs were created, so redirects cannot be benchmarked')
+        results['redirect'] = self._drive('redirect', _redirect, requests, concurrency)
+        return results
+
+    def _drive(self, name, func, requests, concurrency):
+
+        def _one(n):
+            counter = QueryCounter()
+            started = time.perf_counter()
+            error = None
+            try:
+                with connection.execute_wrapper(counter):
+                    func(n)
+            except Exception as e:
+                error = '%s: %s' % (type(e).__name__, str(e)[:200])
+            elapsed = time.perf_counter() - started
+            # what Django does at the end of every request, outside the timed section
+            close_old_connections()
+            return elapsed, counter.count, error
+
+        wall_started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            samples = list(pool.map(_one, range(requests)))
+            wall = time.perf_counter() - wall_started
+            # every pool thread opened its own connections; the barrier hands each thread exactly one of these
+            barrier = threading.Barrier(concurrency)
+            list(pool.map(lambda _: (barrier.wait(), connections.close_all()), range(concurrency)))
+
+        latencies = sorted(s[0] for s in samples if not s[2])
+        queries = [s[1] for s in samples if not s[2]]
+        errors = [s[2] for s in samples if s[2]]
+        result = {
+            'requests': requests,
+            'errors': len(errors),
+            'throughput_rps': (requests - len(errors)) / wall if wall else None,
+            'p50_ms': _percentile(latencies, 50) * 1000 if latencies else None,
+            'p95_ms': _percentile(latencies, 95) * 1000 if latencies else None,
+            'p99_ms': _percentile(latencies, 99) * 1000 if latencies else None,
+            'queries_per_request': statistics.mean(queries) if queries else None,
+            'max_queries_per_request': max(queries) if queries else None,
+        }
+        if errors:
+            result['first_error'] = errors[0]
+        if latencies:
+            self.stdout.write('%-10s %8.1f req/s  p50 %7.2fms  p95 %7.2fms  p99 %7.2fms  %5.1f queries/req  %d errors'
+                              % (name, result['throughput_rps'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+                                 result['queries_per_request'], len(errors)))
+        else:
+            self.stdout.write(self.style.ERROR('%-10s all %d requests failed; first error: %s' % (name, requests, errors[0])))
+        return result
+
+    #
+    # comparison
+    #
+    def _compare(self, previous, current, threshold):
+        # (section, name, metric, True if lower is better)
+        rows = []
+        for name in current.get('micro', {}):
+            rows.append(('micro', name, 'best_us', True))
+        for name in current.get('e2e', {}):
+            for metric, lower_is_better in (('p50_ms', True), ('p95_ms', True), ('p99_ms', True),
+                                            ('throughput_rps', False), ('queries_per_request', True)):
+                rows.append(('e2e', name, metric, lower_is_better))
+
+        regressions = 0
+        self.stdout.write('Compared with the run started %s:' % previous.get('started', 'unknown'))
+        for section, name, metric, lower_is_better in rows:
+            before = previous.get(section, {}).get(name, {}).get(metric, None)
+            after = current.get(section, {}).get(name, {}).get(metric, None)
+            if before is None or after is None or not before:
+                continue
+            change = (after - before) / before * 100.0
+            regressed = change > threshold if lower_is_better else change < -threshold
+            regressions += 1 if regressed else 0
+            line = '  %-5s %-26s %-20s %12.3f -> %12.3f  %+7.1f%%' % (section, name, metric, before, after, change)
+            self.stdout.write(self.style.ERROR(line + '  REGRESSION') if regressed else line)
+        if regressions:
+            self.stdout.write(self.style.ERROR('%d regression(s) beyond %.0f%%' % (regressions, threshold)))
+        else:
+            self.stdout.write(self.style.SUCCESS('No regressions beyond %.0f%%' % threshold))
@@ -0,0 +1,174 @@
+'''
+metrics.py keeps in-process counters and latency histograms for the redirect and shortening hot paths and renders
+them in the Prometheus text exposition format for the /metrics endpoint.
+
+Recording a sample is a perf_counter() pair, a bisect and a dict update under an uncontended lock, i.e. around a
+microsecond per stage. Each worker process keeps its own registry, so scrape every worker (or sum over the process
+label) to see the whole node.
+'''
+
+import functools
+import os
+import threading
+from bisect import bisect_left
+from time import perf_counter
+
+from snakraws import settings
+
+METRICS_PREFIX = 'snakraws'
+
+# histogram bucket upper bounds in seconds
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class MetricsRegistry:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+        return
+
+    def inc(self, name, labels=(), amount=1):
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+        return
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self.histograms.get(key, None)
+            if histogram is None:
+                # per-bucket (non-cumulative) counts, with a final +Inf bucket, then sum
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[idx] += 1
+            histogram[-1] += value
+        return
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters), dict((key, list(value)) for key, value in self.histograms.items())
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+        return
+
+
+registry = MetricsRegistry()
+
+# read once; settings don't change at runtime and this is checked on every sample
+METRICS_ENABLED = getattr(settings, "ENABLE_METRICS", True)
+
+
+class timer:
+    """
+    Times the enclosed block into the snakraws_stage_seconds histogram for the given stage:
+
+        with timer('get_long_lookup'):
+            ...
+    """
+
+    __slots__ = ('stage', 'started')
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.started = None
+        return
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if METRICS_ENABLED:
+            registry.observe('stage_seconds', (('stage', self.stage),), perf_counter() - self.started)
+        return False
+
+
+def timed(stage):
+    """Decorator form of timer(stage). Functions decorated while ENABLE_METRICS is False are left unwrapped."""
+    def decorator(func):
+        if not METRICS_ENABLED:
+            return func
+        labels = (('stage', stage),)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                registry.observe('stage_seconds', labels, perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def record_cache(name, hit):
+    """Counts a lookup against the named cache; the /metrics endpoint reports hits, misses and the hit ratio."""
+    if METRICS_ENABLED:
+        registry.inc('cache_requests_total', (('cache', name), ('result', 'hit' if hit else 'miss')))
+    return
+
+
+def count(name, amount=1, **labels):
+    if METRICS_ENABLED:
+        registry.inc(name, tuple(sorted(labels.items())), amount)
+    return
+
+
+def _format_labels(labels, **extra):
+    pairs = list(labels) + sorted(extra.items())
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+
+
+def render_prometheus():
+    """Returns the registry in the Prometheus text exposition format (version 0.0.4)."""
+    counters, histograms = registry.snapshot()
+    process = (('process', os.getpid()),)
+    lines = []
+
+    seen = set()
+    for (name, labels) in sorted(counters):
+        metric = '%s_%s' % (METRICS_PREFIX, name)
+        if metric not in seen:
+            lines.append('# TYPE %s counter' % metric)
+            seen.add(metric)
+        lines.append('%s%s %s' % (metric, _format_labels(process + labels), counters[(name, labels)]))
+
+    # hit ratio per cache, derived from the cache_requests_total counters
+    caches = {}
+    for (name, labels), value in counters.items():
+        if name == 'cache_requests_total':
+            labels = dict(labels)
+            hits_total = caches.setdefault(labels['cache'], [0, 0])
+            hits_total[0] += value if labels['result'] == 'hit' else 0
+            hits_total[1] += value
+    if caches:
+        metric = '%s_cache_hit_ratio' % METRICS_PREFIX
+        lines.append('# TYPE %s gauge' % metric)
+        for cache_name in sorted(caches):
+            hits, total = caches[cache_name]
+            lines.append('%s%s %.6f' % (metric, _format_labels(process + (('cache', cache_name),)), float(hits) / total))
+
+    seen = set()
+    for (name, labels) in sorted(histograms):
+        metric = '%s_%s' % (METRICS_PREFIX, name)
+        if metric not in seen:
+            lines.append('# TYPE %s histogram' % metric)
+            seen.add(metric)
+        histogram = histograms[(name, labels)]
+        cumulative = 0
+        for idx, bound in enumerate(registry.buckets + ('+Inf',)):
+            cumulative += histogram[idx]
+            lines.append('%s_bucket%s %d' % (metric, _format_labels(process + labels, le=bound), cumulative))
+        lines.append('%s_sum%s %.9f' % (metric, _format_labels(process + labels), histogram[-1]))
+        lines.append('%s_count%s %d' % (metric, _format_labels(process + labels), cumulative))
+
+    return '\n'.join(lines) + '\n'
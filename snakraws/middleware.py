@@ -0,0 +1,243 @@
+'''
+middleware.py contains Snakr's request middleware.
+
+QueryProfilerMiddleware records every SQL statement a request runs, grouped by the snakraws call site that issued it,
+flags N+1 patterns (the same statement from the same line over and over) and enforces QUERY_BUDGET, so query count
+regressions show up in logs and tests before they reach production.
+
+ProfilerViewMiddleware tells the sampling profiler which view each thread is serving.
+
+ReplicaPinningMiddleware keeps clients that just created a short URL reading from the primary database.
+
+ConnectionHealthMiddleware pings persistent database connections that have sat idle before a request uses them.
+'''
+
+import contextlib
+import json
+import os
+import re
+import sys
+import threading
+from collections import deque
+from time import perf_counter
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from snakraws import settings
+from snakraws.logsinks import get_logger
+from snakraws.metrics import count
+from snakraws.profiler import active_views, profiler
+from snakraws.routers import replicas_enabled, reset_pin, request_wrote_urls
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+_IN_LISTS = re.compile(r"\(\s*(?:%s|\?)(?:\s*,\s*(?:%s|\?))*\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def normalize_sql(sql):
+    """Collapses literals, IN lists and whitespace so repeats of the same statement compare equal."""
+    sql = _LITERALS.sub('?', sql)
+    sql = _IN_LISTS.sub('(...)', sql)
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+def _call_site():
+    # the innermost frame in snakraws code, other than this module, that led to the query
+    frame = sys._getframe(2)
+    while frame:
+        filename = frame.f_code.co_filename
+        if filename.startswith(PACKAGE_DIR) and not filename.endswith('middleware.py'):
+            return '%s:%d %s' % (os.path.relpath(filename, PACKAGE_DIR), frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+    return 'django'
+
+
+class QueryRecorder:
+    """connection.execute_wrapper() hook that keeps (call site, normalized sql, seconds) for each statement."""
+
+    def __init__(self):
+        self.queries = []
+        return
+
+    def __call__(self, execute, sql, params, many, context):
+        started = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((_call_site(), sql, perf_counter() - started))
+
+    def profile(self, n_plus_one_threshold):
+        sites = {}
+        repeats = {}
+        for site, sql, seconds in self.queries:
+            summary = sites.setdefault(site, {'queries': 0, 'ms': 0.0})
+            summary['queries'] += 1
+            summary['ms'] += seconds * 1000
+            key = (site, normalize_sql(sql))
+            repeats[key] = repeats.get(key, 0) + 1
+        n_plus_one = [{'site': site, 'sql': sql[:200], 'count': n}
+                      for (site, sql), n in repeats.items() if n >= n_plus_one_threshold]
+        return {
+            'queries': len(self.queries),
+            'ms': round(sum(q[2] for q in self.queries) * 1000, 3),
+            'sites': dict((site, {'queries': s['queries'], 'ms': round(s['ms'], 3)}) for site, s in sites.items()),
+            'n_plus_one': n_plus_one,
+        }
+
+
+# the most recent request profiles in this process, newest last, for the staff-only /api/queries endpoint
+recent_profiles = deque(maxlen=100)
+_recent_lock = threading.Lock()
+
+
+class QueryProfilerMiddleware:
+    """
+    Profiles the SQL of each request; on by default only with DEBUG on or in dev, since it wraps every statement. When
+    a request runs more than QUERY_BUDGET statements it is logged as a warning, or raises QueryBudgetExceeded if
+    QUERY_BUDGET_STRICT is set (as it should be under test). With DEBUG on, or for staff users, the response carries
+    X-Snakr-Queries and an X-Snakr-Query-Profile JSON breakdown.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = getattr(settings, "ENABLE_QUERY_PROFILER",
+                               getattr(settings, "DEBUG", False) or getattr(settings, "SITE_MODE", "prod") == "dev")
+        self.budget = getattr(settings, "QUERY_BUDGET", 50)
+        self.strict = getattr(settings, "QUERY_BUDGET_STRICT", False)
+        self.n_plus_one_threshold = getattr(settings, "QUERY_N_PLUS_ONE_THRESHOLD", 3)
+        return
+
+    def __call__(self, request):
+        if not self.enabled:
+            return self.get_response(request)
+        recorder = QueryRecorder()
+        with contextlib.ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(recorder))
+            response = self.get_response(request)
+
+        profile = recorder.profile(self.n_plus_one_threshold)
+        profile['path'] = request.path
+        count('sql_queries_total', profile['queries'])
+        with _recent_lock:
+            recent_profiles.append(profile)
+
+        if profile['n_plus_one'] or (self.budget and profile['queries'] > self.budget):
+            message = '%s ran %d queries (budget %s)%s' % (
+                request.path, profile['queries'], self.budget,
+                '; possible N+1 at %s' % ', '.join(n['site'] for n in profile['n_plus_one']) if profile['n_plus_one'] else '')
+            if self.budget and profile['queries'] > self.budget:
+                count('query_budget_exceeded_total')
+                if self.strict:
+                    raise QueryBudgetExceeded(message)
+            get_logger().warning(message, extra={'query_profile': profile})
+
+        if getattr(settings, "DEBUG", False) or getattr(getattr(request, 'user', None), 'is_staff', False):
+            response['X-Snakr-Queries'] = str(profile['queries'])
+            response['X-Snakr-Query-Profile'] = json.dumps(
+                    {'sites': dict((site, s['queries']) for site, s in profile['sites'].items()),
+                     'n_plus_one': [n['site'] for n in profile['n_plus_one']]},
+                    separators=(',', ':'))
+        return response
+
+
+class ProfilerViewMiddleware:
+    """
+    Records the view each request thread is serving so profiler samples can be broken down per view. With
+    PROFILER_START_SECONDS set, each worker also profiles itself for that long from the first request it serves.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = getattr(settings, "ENABLE_SAMPLING_PROFILER", False)
+        self.start_seconds = getattr(settings, "PROFILER_START_SECONDS", 0)
+        self._pid = None
+        return
+
+    def __call__(self, request):
+        if not self.enabled:
+            return self.get_response(request)
+        if self.start_seconds and self._pid != os.getpid():
+            self._pid = os.getpid()
+            profiler.start(self.start_seconds)
+        ident = threading.get_ident()
+        try:
+            return self.get_response(request)
+        finally:
+            active_views.pop(ident, None)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if self.enabled:
+            active_views[threading.get_ident()] = '%s.%s' % (view_func.__module__, getattr(view_func, '__name__', 'view'))
+        return None
+
+
+# set on clients that created or changed a short URL, so their next reads go to the primary, not a lagging replica
+REPLICA_PIN_COOKIE = 'snakr_primary'
+
+
+class ReplicaPinningMiddleware:
+    """
+    Starts each request unpinned, unless the client carries the REPLICA_PIN_COOKIE, and sets that cookie for
+    REPLICA_PIN_SECONDS on responses to requests that wrote a short or long URL. Does nothing without DATABASE_REPLICAS.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.pin_seconds = getattr(settings, "REPLICA_PIN_SECONDS", 30)
+        return
+
+    def __call__(self, request):
+        if not replicas_enabled():
+            return self.get_response(request)
+        reset_pin(REPLICA_PIN_COOKIE in request.COOKIES)
+        try:
+            response = self.get_response(request)
+            if request_wrote_urls():
+                response.set_cookie(REPLICA_PIN_COOKIE, '1', max_age=self.pin_seconds, httponly=True)
+        finally:
+            reset_pin()
+        return response
+
+
+def _count_connection(sender, connection, **kwargs):
+    # a new physical connection with the stock backend; a pool checkout with snakraws.db.backends.postgresql_pool
+    count('db_connections_created_total', alias=connection.alias)
+
+
+connection_created.connect(_count_connection, dispatch_uid='snakraws_count_connection')
+
+
+class ConnectionHealthMiddleware:
+    """
+    With persistent connections (CONN_MAX_AGE > 0), Django only checks a connection after it has errored. This runs
+    a cheap SELECT 1 on any connection this thread has left idle for DB_HEALTH_CHECK_SECONDS and drops it if the
+    server has gone away, so the request reconnects instead of failing.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.health_check_seconds = getattr(settings, "DB_HEALTH_CHECK_SECONDS", 30)
+        return
+
+    def __call__(self, request):
+        now = perf_counter()
+        for connection in connections.all():
+            # CONN_MAX_AGE None means connections are kept forever, so they need the check most
+            if connection.connection is not None and connection.settings_dict.get('CONN_MAX_AGE', 0) != 0:
+                if now - getattr(connection, 'snakr_last_used', now) > self.health_check_seconds \
+                        and not connection.is_usable():
+                    count('db_connections_unusable_total', alias=connection.alias)
+                    connection.close()
+        try:
+            return self.get_response(request)
+        finally:
+            for connection in connections.all():
+                connection.snakr_last_used = perf_counter()
@@ -4,6 +4,7 @@ models.py contains the persistence logic for Snakr.
 
 from django.db import models
 from django.core.validators import URLValidator
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 from ipaddress import IPv6Interface, IPv4Interface, IPv6Address, IPv4Address, ip_interface
@@ -365,6 +366,17 @@ class ShortURLs(models.Model):
             null=True)
     is_active = models.BooleanField(
             null=False)
+    # seconds browsers and edge caches may reuse a redirect; NULL means SHORTURL_CACHE_MAX_AGE
+    cache_max_age = models.IntegerField(
+            null=True,
+            blank=True)
+    # bumped whenever the short url or its long url changes; part of the redirect's ETag
+    version = models.IntegerField(
+            default=1,
+            null=False)
+    modified_on = models.DateTimeField(
+            default=timezone.now,
+            null=False)
 
     class Meta:
         app_label = TABLE_PREFIX
@@ -378,6 +390,61 @@ class ShortURLs(models.Model):
         return self.shorturl
 
 
+class ShortURLClicks(models.Model):
+    shorturl = models.OneToOneField(
+            'ShortURLs',
+            db_column="shorturl_id",
+            to_field="id",
+            primary_key=True,
+            on_delete=models.CASCADE)
+    clicks = models.BigIntegerField(
+            default=0,
+            null=False)
+    updated_on = models.DateTimeField(
+            null=False)
+
+    class Meta:
+        app_label = TABLE_PREFIX
+        managed = False
+        db_table = '%s_shorturlclicks' % TABLE_PREFIX
+
+    def __str__(self):
+        return "%d" % self.clicks
+
+    def __unicode__(self):
+        return "%d" % self.clicks
+
+
+class VisitorSketch(models.Model):
+    id = models.AutoField(primary_key=True)
+    shorturl = models.ForeignKey(
+            'ShortURLs',
+            db_column="shorturl_id",
+            to_field="id",
+            null=False,
+            on_delete=models.CASCADE)
+    event_yyyymmdd = models.CharField(
+            max_length=8,
+            null=False)
+    dimension = models.CharField(
+            max_length=1,
+            null=False)
+    sketch = models.BinaryField(
+            null=False)
+
+    class Meta:
+        app_label = TABLE_PREFIX
+        managed = False
+        db_table = '%s_visitorsketches' % TABLE_PREFIX
+        unique_together = (('shorturl', 'event_yyyymmdd', 'dimension'),)
+
+    def __str__(self):
+        return '[ %d, "%s", "%s" ]' % (self.shorturl_id, self.event_yyyymmdd, self.dimension)
+
+    def __unicode__(self):
+        return u'[ %d, "%s", "%s" ]' % (self.shorturl_id, self.event_yyyymmdd, self.dimension)
+
+
 class FactEvent(models.Model):
     id = models.AutoField(primary_key=True)
     event_yyyymmdd = models.CharField(
@@ -519,3 +586,137 @@ class Blacklist(models.Model):
 
 
 
+
+
+class Watermark(models.Model):
+    name = models.CharField(
+            primary_key=True,
+            max_length=50
+    )
+    last_id = models.BigIntegerField(
+            default=0,
+            null=False
+    )
+    last_ts = models.DateTimeField(
+            null=True
+    )
+    updated_on = models.DateTimeField(
+            null=False
+    )
+
+    class Meta:
+        app_label = TABLE_PREFIX
+        managed = False
+        db_table = '%s_watermarks' % TABLE_PREFIX
+
+    def __str__(self):
+        return '%s: %d' % (self.name, self.last_id)
+
+    def __unicode__(self):
+        return u'%s: %d' % (self.name, self.last_id)
+
+
+class ProfanityVerdicts(models.Model):
+    id = models.BigAutoField(primary_key=True)
+    # digest of the profanity packages, word lists and settings the verdict was scored with
+    version = models.CharField(
+            max_length=16,
+            null=False
+    )
+    token_hash = models.BigIntegerField(
+            null=False
+    )
+    verdict = models.SmallIntegerField(
+            null=False
+    )
+    created_on = models.DateTimeField(
+            null=False
+    )
+
+    class Meta:
+        app_label = TABLE_PREFIX
+        managed = False
+        db_table = '%s_profanityverdicts' % TABLE_PREFIX
+        unique_together = (('version', 'token_hash'),)
+
+    def __str__(self):
+        return '%s %d: %d' % (self.version, self.token_hash, self.verdict)
+
+    def __unicode__(self):
+        return u'%s %d: %d' % (self.version, self.token_hash, self.verdict)
+
+
+class RollupDaily(models.Model):
+    id = models.AutoField(primary_key=True)
+    shorturl = models.ForeignKey(
+            'ShortURLs',
+            db_column="shorturl_id",
+            to_field="id",
+            null=False,
+            on_delete=models.DO_NOTHING)
+    event_yyyymmdd = models.CharField(
+            max_length=8,
+            null=False
+    )
+    countrycode = models.CharField(
+            max_length=2,
+            null=False
+    )
+    event_type = models.CharField(
+            max_length=1,
+            null=False
+    )
+    events = models.BigIntegerField(
+            default=0,
+            null=False
+    )
+
+    class Meta:
+        app_label = TABLE_PREFIX
+        managed = False
+        db_table = '%s_rollupdaily' % TABLE_PREFIX
+        unique_together = (('shorturl', 'event_yyyymmdd', 'countrycode', 'event_type'),)
+
+    def __str__(self):
+        return '[ %d, "%s", "%s", "%s", %d ]' % (self.shorturl_id, self.event_yyyymmdd, self.countrycode, self.event_type, self.events)
+
+    def __unicode__(self):
+        return u'[ %d, "%s", "%s", "%s", %d ]' % (self.shorturl_id, self.event_yyyymmdd, self.countrycode, self.event_type, self.events)
+
+
+class RollupHourly(models.Model):
+    id = models.AutoField(primary_key=True)
+    shorturl = models.ForeignKey(
+            'ShortURLs',
+            db_column="shorturl_id",
+            to_field="id",
+            null=False,
+            on_delete=models.DO_NOTHING)
+    event_yyyymmdd = models.CharField(
+            max_length=8,
+            null=False
+    )
+    event_hh = models.CharField(
+            max_length=2,
+            null=False
+    )
+    event_type = models.CharField(
+            max_length=1,
+            null=False
+    )
+    events = models.BigIntegerField(
+            default=0,
+            null=False
+    )
+
+    class Meta:
+        app_label = TABLE_PREFIX
+        managed = False
+        db_table = '%s_rolluphourly' % TABLE_PREFIX
+        unique_together = (('shorturl', 'event_yyyymmdd', 'event_hh', 'event_type'),)
+
+    def __str__(self):
+        return '[ %d, "%s", "%s", "%s", %d ]' % (self.shorturl_id, self.event_yyyymmdd, self.event_hh, self.event_type, self.events)
+
+    def __unicode__(self):
+        return u'[ %d, "%s", "%s", "%s", %d ]' % (self.shorturl_id, self.event_yyyymmdd, self.event_hh, self.event_type, self.events)
@@ -2,41 +2,37 @@
 Centralized persistence and logging for Snakr. Wraps the Django core logging system and adds JSON logging support.
 '''
 
-import logging
 import datetime
-import requests
 import uuid
-from urllib.parse import quote
 
 from django.core.exceptions import SuspiciousOperation, PermissionDenied
 from django.http import Http404, HttpResponseServerError
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
-from pythonjsonlogger import jsonlogger
-
 from snakraws import settings
 from snakraws.models import EVENT_TYPE, DEFAULT_EVENT_TYPE, HTTP_STATUS_CODE, DEFAULT_HTTP_STATUS_CODE, \
     DimGeoLocation, DimReferer, DimIP, DimHost, DimDevice, DimUserAgent, FactEvent, \
-    LongURLs, ShortURLs
+    LongURLs, ShortURLs, Watermark
 from snakraws.utils import get_meta, get_hash, get_message
 from snakraws.ips import SnakrIP
 from snakraws.security import is_blacklisted
+from snakraws.sketches import sketch_visit
+from snakraws.googleanalytics import forward_hit
+from snakraws.logsinks import get_logger
+from snakraws.metrics import timed
 
 
 class SnakrLogger(Exception):
 
     def __init__(self, *args, **kwargs):
         #
-        # initialize python-json-logger
+        # the python-json-logger sinks are set up once per process by logsinks, not per instance
         # see: https://github.com/madzak/python-json-logger
         #
-        self.logger = logging.getLogger(settings.VERBOSE_NAME)
-        if settings.VERBOSE_LOGGING:
-            self.__logHandler = logging.StreamHandler()
-            self.__formatter = jsonlogger.JsonFormatter()
-            self.__logHandler.setFormatter(self.__formatter)
-            self.logger.addHandler(self.__logHandler)
+        self.logger = get_logger()
         self.last_ip_address = 'N/A'
         self.last_dtnow = 'N/A'
         self.last_http_user_agent = 'N/A'
@@ -169,34 +165,32 @@ class SnakrLogger(Exception):
                             cc = ipobj.geodict["country_code"]
                         elif "countrycode" in ipobj.geodict:
                             cc = ipobj.geodict["countrycode"]
-                    gad = {
+                    # forward_hit only queues the hit; it is urlencoded and sent in batches by a background thread
+                    forward_hit({
                         'v':        1,
                         'tid':      self.ga_tid,
                         'ds':       'web',
                         't':        HTTP_STATUS_CODE[abs(status_code)],
                         'cid':      self.cid,
                         'uip':      ipobj.ip if ipobj else nada,
-                        'ua':       quote(useragent) if useragent else nada,
+                        'ua':       useragent if useragent else nada,
                         'geoid':    cc,
-                        'dr':       quote(referer) if referer else nada,
-                        'dl':       quote(shorturl.shorturl) if shorturl else quote(value) if value else nada,
+                        'dr':       referer if referer else nada,
+                        'dl':       shorturl.shorturl if shorturl else value if value else nada,
                         'cd1':      _('Snakr Long URL'),
-                        'cm1':      quote(longurl.longurl) if longurl else nada,
+                        'cm1':      longurl.longurl if longurl else nada,
                         'cd2':      _('Snakr Short URL'),
-                        'cm2':      quote(shorturl.shorturl) if shorturl else quote(value) if value else nada,
+                        'cm2':      shorturl.shorturl if shorturl else value if value else nada,
                         'cd3':      _('Snakr Status'),
                         'cm3':      msg
-                    }
-                    try:
-                        r = requests.post("www.google-analytics.com/collect", data=gad)
-                    except:
-                        pass
+                    })
 
                 return status
 
         return
 
     @staticmethod
+    @timed('log_event')
     def _log_event(request, dt, event_type, status_code, msg, shorturl, longurl, ipobj, hostname, useragent, referer, cid):
 
         # dimension log_event helper function here to keep it within the scope of the transaction
@@ -346,4 +340,50 @@ class SnakrLogger(Exception):
         )
         fact.save()
 
+        if event_type == 'S':
+            sketch_visit(shorturl.id, fact.event_yyyymmdd, ip.hash, useragent.hash)
+
         return fact.id, event_type, msg, status_code, shorturl, longurl
+
+
+def lock_watermark(name):
+    """
+    Returns the named Watermark row, creating it at zero if needed, locked FOR UPDATE.
+    Must be called inside a transaction so that concurrent jobs sharing the watermark serialize on it.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+                "INSERT INTO %s (name, last_id, updated_on) VALUES (%%s, 0, %%s) ON CONFLICT (name) DO NOTHING"
+                % Watermark._meta.db_table,
+                [name, timezone.now()])
+    return Watermark.objects.select_for_update().get(name=name)
+
+
+def save_watermark(watermark, last_id=None, last_ts=None):
+    if last_id is not None:
+        watermark.last_id = last_id
+    if last_ts is not None:
+        watermark.last_ts = last_ts
+    watermark.updated_on = timezone.now()
+    watermark.save()
+    return watermark
+
+
+def current_max_id(table):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT COALESCE(MAX(id), 0) FROM %s' % table)
+        return cursor.fetchone()[0]
+
+
+def settled_max_id(name, table, now=False):
+    """
+    Returns the highest id of `table` that an incremental job named `name` may safely process on this run: the max id
+    seen by the job's previous run, so that rows whose inserting transaction was still open back then are committed by
+    now. Records the current max id for the next run. Pass now=True to use the current max id instead. A job's first
+    run has no previous max id, so it returns 0 and only seeds the ceiling for the next run.
+    """
+    max_id = current_max_id(table)
+    ceiling = lock_watermark('%s_ceiling' % name)
+    settled = max_id if now else min(ceiling.last_id, max_id)
+    save_watermark(ceiling, last_id=max_id)
+    return settled
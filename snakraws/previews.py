@@ -0,0 +1,130 @@
+'''
+previews.py serves link-preview crawlers (Slack, Twitter, Facebook, LinkedIn, ...) from pre-rendered pages.
+
+The OpenGraph page a crawler unfurls is rendered once per short URL, when the short URL is created or on the first
+crawler request after its long URL or short URL changes, and kept in the Django cache under the short URL's hash.
+Crawler requests are answered from that cache with an ETag and Last-Modified, so repeat fetches get a 304, after one
+indexed query that checks the short URL is still active and unchanged. They skip bot detection, the lookups and
+event logging that a redirect costs.
+'''
+
+import hashlib
+import time
+from urllib.parse import urlparse
+
+from django.core.cache import cache
+from django.db.models.signals import post_save
+from django.http import HttpResponse
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from django.utils.safestring import mark_safe
+
+from snakraws import settings
+from snakraws.bloom import shorturl_hash_filter
+from snakraws.metrics import record_cache
+from snakraws.models import ShortURLs, LongURLs
+from snakraws.shorturls import get_lookup_shorturl
+from snakraws.utils import get_decodedurl, get_shorturlhash, get_useragent, requested_last, requested_last_shorturlref
+from snakraws.__init__ import VERSION
+
+DEFAULT_PREVIEW_USER_AGENTS = [
+    'facebookexternalhit', 'facebot', 'twitterbot', 'slackbot', 'linkedinbot', 'discordbot', 'telegrambot',
+    'whatsapp', 'skypeuripreview', 'redditbot', 'pinterestbot', 'embedly', 'iframely', 'vkshare', 'applebot',
+]
+
+
+def _preview_key(shash):
+    return 'snakraws_preview_%d' % shash
+
+
+def is_preview_crawler(request):
+    useragent = get_useragent(request, True)
+    return any(match in useragent for match in getattr(settings, "PREVIEW_USER_AGENTS", DEFAULT_PREVIEW_USER_AGENTS))
+
+
+def render_preview(s, l):
+    """Renders and caches the preview page of short URL `s` for long URL `l`; returns the cache entry."""
+    longurl = get_decodedurl(l.longurl) if l.originally_encoded else l.longurl
+    html = render_to_string(
+            'redirectr.html',
+            {
+                'ga_enabled': False,
+                'image_url': mark_safe(l.image_url),
+                'inpage': l.description,
+                'longurl': mark_safe(longurl),
+                'longurl_byline': l.byline,
+                'longurl_description': l.description,
+                'longurl_site_name': l.site_name,
+                'longurl_title': l.title,
+                'shorturl': mark_safe(s.shorturl),
+                'status_code': 301,
+                'verbose_name': getattr(settings, "PUBLIC_NAME", getattr(settings, "VERBOSE_NAME", "SnakrAWS")),
+                'version': VERSION,
+            }
+    )
+    entry = {
+        'version': s.version,
+        'html': html,
+        'etag': '"%s"' % hashlib.blake2b(html.encode('utf-8'), digest_size=12).hexdigest(),
+        'last_modified': int(time.time()),
+    }
+    cache.set(_preview_key(s.hash), entry, timeout=getattr(settings, "PREVIEW_CACHE_SECONDS", 86400))
+    return entry
+
+
+def invalidate_preview(shash):
+    cache.delete(_preview_key(shash))
+    return
+
+
+def preview_response(request):
+    """The preview page for a crawler's GET of a short URL, or None to handle the request as a normal redirect."""
+    if not getattr(settings, "ENABLE_PREVIEW_CACHE", True) or not is_preview_crawler(request):
+        return None
+    if requested_last(request) or requested_last_shorturlref(request):
+        return None
+    surl = get_lookup_shorturl(request.build_absolute_uri()).rstrip('/')
+    if surl != get_decodedurl(surl) or urlparse(surl).path in ('', '/'):
+        # encoded short urls and the bare host are left to the redirect path
+        return None
+    shash = get_shorturlhash(surl)
+    entry = cache.get(_preview_key(shash))
+    record_cache('preview', entry is not None)
+    if entry is not None:
+        # a short or long url deactivated with update() or raw SQL leaves its page in the cache, so check a cached
+        # page is still live, and still the current version, with one indexed query before serving it
+        current = ShortURLs.objects.filter(hash=shash).values_list('is_active', 'longurl__is_active', 'version').first()
+        if not current or not (current[0] and current[1]):
+            invalidate_preview(shash)
+            return None
+        if entry.get('version', None) != current[2]:
+            entry = None
+    if entry is None:
+        if not shorturl_hash_filter.might_contain(shash):
+            return None
+        s = ShortURLs.objects.select_related('longurl').filter(hash=shash, is_active=True).first()
+        if not s or s.shorturl != surl or not s.longurl.is_active:
+            return None
+        entry = render_preview(s, s.longurl)
+    response = HttpResponse(entry['html'], content_type="text/html")
+    response['ETag'] = entry['etag']
+    response['Last-Modified'] = http_date(entry['last_modified'])
+    patch_cache_control(response, public=True, max_age=getattr(settings, "PREVIEW_MAX_AGE", 300))
+    return get_conditional_response(request, etag=entry['etag'], last_modified=entry['last_modified'],
+                                    response=response)
+
+
+def _shorturl_saved(sender, instance, **kwargs):
+    invalidate_preview(instance.hash)
+    return
+
+
+def _longurl_saved(sender, instance, **kwargs):
+    for shash in ShortURLs.objects.filter(longurl_id=instance.id).values_list('hash', flat=True):
+        invalidate_preview(shash)
+    return
+
+
+post_save.connect(_shorturl_saved, sender=ShortURLs, dispatch_uid='snakraws_preview_shorturl_saved')
+post_save.connect(_longurl_saved, sender=LongURLs, dispatch_uid='snakraws_preview_longurl_saved')
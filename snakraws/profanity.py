@@ -0,0 +1,159 @@
+'''
+profanity.py remembers the profanity verdicts of URL parts, so that the domains and words that turn up in URL after
+URL are scored by the profanity model once instead of on every shorten.
+
+A verdict is looked up, in order, in a per-process LRU, in the Django cache, and, with ENABLE_PROFANITY_VERDICT_TABLE,
+in snakraws_profanityverdicts; only the parts found in none of them are scored, and their verdicts are written back to
+every tier. Verdicts are keyed by a version made from the profanity package versions, the word lists and the
+profanity settings, so upgrading the model, editing a word list or bumping PROFANITY_WORDLIST_VERSION starts over
+with fresh verdicts instead of serving stale ones.
+'''
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.db import DatabaseError, connection, transaction as xaction
+
+from snakraws import settings
+from snakraws.metrics import count
+
+try:
+    from importlib.metadata import version as _version
+except ImportError:
+    from pkg_resources import get_distribution
+
+    def _version(name):
+        return get_distribution(name).version
+
+
+# verdict flags: a part has one of the bad three-letter words in it; a part was scored profane
+BAD_THREE_LETTER_WORD = 1
+PROFANE = 2
+
+
+def package_version(name):
+    try:
+        return _version(name)
+    except Exception:
+        return 'unknown'
+
+
+def get_verdict_version(*parts):
+    """A short digest of everything a verdict depends on."""
+    return hashlib.blake2b(repr(parts).encode('utf-8'), digest_size=8).hexdigest()
+
+
+def _token_hash(token):
+    # signed, to fit a BIGINT
+    return int.from_bytes(hashlib.blake2b(token.encode('utf-8', 'replace'), digest_size=8).digest(), 'little',
+                          signed=True)
+
+
+class VerdictStore:
+    """Verdicts of `version` for tokens, from the fastest tier that has them."""
+
+    def __init__(self, version):
+        self.version = version
+        self.max_size = getattr(settings, "PROFANITY_VERDICT_CACHE_SIZE", 100000)
+        self.cache_seconds = getattr(settings, "PROFANITY_VERDICT_CACHE_SECONDS", 30 * 86400)
+        self.use_table = getattr(settings, "ENABLE_PROFANITY_VERDICT_TABLE", False)
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        return
+
+    def _cache_key(self, token_hash):
+        return 'snakraws_profanity_%s_%x' % (self.version, token_hash & 0xffffffffffffffff)
+
+    def _remember(self, verdicts):
+        with self._lock:
+            for token, verdict in verdicts.items():
+                self._local[token] = verdict
+                self._local.move_to_end(token)
+            while len(self._local) > self.max_size:
+                self._local.popitem(last=False)
+        return
+
+    def _from_cache(self, hashes):
+        try:
+            found = cache.get_many([self._cache_key(h) for h in hashes.values()])
+        except Exception:
+            count('profanity_verdict_errors_total', tier='cache')
+            return {}
+        return {token: found[self._cache_key(h)] for token, h in hashes.items() if self._cache_key(h) in found}
+
+    def _to_cache(self, hashes, verdicts):
+        try:
+            cache.set_many({self._cache_key(hashes[token]): verdict for token, verdict in verdicts.items()},
+                           timeout=self.cache_seconds)
+        except Exception:
+            count('profanity_verdict_errors_total', tier='cache')
+        return
+
+    def _from_table(self, hashes):
+        # models imports utils, which scores profanity through this module
+        from snakraws.models import ProfanityVerdicts
+        tokens = {h: token for token, h in hashes.items()}
+        try:
+            with xaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT token_hash, verdict FROM %s WHERE version = %%s AND token_hash IN (%s)'
+                                   % (ProfanityVerdicts._meta.db_table, ', '.join(['%s'] * len(tokens))),
+                                   [self.version] + list(tokens))
+                    rows = cursor.fetchall()
+        except DatabaseError:
+            count('profanity_verdict_errors_total', tier='table')
+            return {}
+        return {tokens[h]: verdict for h, verdict in rows}
+
+    def _to_table(self, hashes, verdicts):
+        from snakraws.models import ProfanityVerdicts
+        params = []
+        for token, verdict in verdicts.items():
+            params += [self.version, hashes[token], verdict]
+        try:
+            with xaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute('INSERT INTO %s (version, token_hash, verdict) VALUES %s '
+                                   'ON CONFLICT (version, token_hash) DO NOTHING'
+                                   % (ProfanityVerdicts._meta.db_table, ', '.join(['(%s, %s, %s)'] * len(verdicts))),
+                                   params)
+        except DatabaseError:
+            count('profanity_verdict_errors_total', tier='table')
+        return
+
+    def get_many(self, tokens, score):
+        """{token: verdict} for every token; `score` is called with the tokens no tier has and returns theirs."""
+        verdicts = {}
+        with self._lock:
+            for token in tokens:
+                verdict = self._local.get(token, None)
+                if verdict is not None:
+                    verdicts[token] = verdict
+                    self._local.move_to_end(token)
+        count('profanity_verdicts_total', len(verdicts), tier='local')
+        missing = {token: _token_hash(token) for token in tokens if token not in verdicts}
+        if not missing:
+            return verdicts
+
+        found = self._from_cache(missing)
+        count('profanity_verdicts_total', len(found), tier='cache')
+        if self.use_table and len(found) < len(missing):
+            found_in_table = self._from_table({t: h for t, h in missing.items() if t not in found})
+            count('profanity_verdicts_total', len(found_in_table), tier='table')
+            if found_in_table:
+                self._to_cache(missing, found_in_table)
+            found.update(found_in_table)
+
+        unscored = [token for token in missing if token not in found]
+        scored = score(unscored) if unscored else {}
+        count('profanity_verdicts_total', len(scored), tier='scored')
+        if scored:
+            if self.use_table:
+                self._to_table(missing, scored)
+            self._to_cache(missing, scored)
+            found.update(scored)
+        self._remember(found)
+        verdicts.update(found)
+        return verdicts
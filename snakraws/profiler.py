@@ -0,0 +1,147 @@
+'''
+profiler.py is an opt-in, in-process sampling profiler for live workers. For a bounded window a daemon thread
+samples the Python stacks of the threads serving requests every few milliseconds, tags each sample with the view
+being served, and writes the result as collapsed stacks (for flamegraph.pl or speedscope) and as a speedscope JSON
+profile with one flame graph per view.
+'''
+
+import json
+import os
+import sys
+import threading
+import time
+
+from snakraws import settings
+
+# thread id -> name of the view it is serving; maintained by ProfilerViewMiddleware
+active_views = {}
+
+
+def _frame_label(code):
+    filename = code.co_filename
+    marker = filename.rfind('site-packages' + os.sep)
+    if marker >= 0:
+        filename = filename[marker + len('site-packages' + os.sep):]
+    elif filename.startswith(settings.BASE_DIR):
+        filename = os.path.relpath(filename, settings.BASE_DIR)
+    return '%s (%s:%d)' % (code.co_name, filename, code.co_firstlineno)
+
+
+class SamplingProfiler:
+
+    def __init__(self):
+        self.output_dir = getattr(settings, "PROFILER_OUTPUT_DIR", getattr(settings, "LOG_PATH", "/tmp"))
+        self.max_seconds = getattr(settings, "PROFILER_MAX_SECONDS", 60)
+        self._lock = threading.Lock()
+        self._thread = None
+        self.started = None
+        self.seconds = None
+        self.interval = None
+        self.last_result = None
+        return
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds=10, interval_ms=None):
+        """Starts a profile of this process for `seconds` (capped at PROFILER_MAX_SECONDS); False if one is running."""
+        with self._lock:
+            if self.running:
+                return False
+            self.seconds = min(max(float(seconds), 0.1), self.max_seconds)
+            self.interval = max(interval_ms or getattr(settings, "PROFILER_INTERVAL_MS", 10), 1) / 1000.0
+            self.started = time.time()
+            self._thread = threading.Thread(target=self._run, name="snakraws-profiler", daemon=True)
+            self._thread.start()
+        return True
+
+    def status(self):
+        return {
+            'pid': os.getpid(),
+            'running': self.running,
+            'started': self.started,
+            'seconds': self.seconds,
+            'interval_ms': self.interval * 1000 if self.interval else None,
+            'last_result': self.last_result,
+        }
+
+    def _run(self):
+        me = threading.get_ident()
+        stacks = {}
+        samples = 0
+        deadline = time.monotonic() + self.seconds
+        while time.monotonic() < deadline:
+            frames = sys._current_frames()
+            for ident, view in list(active_views.items()):
+                frame = frames.get(ident, None)
+                if frame is None or ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                stack.reverse()
+                key = (view, tuple(stack))
+                stacks[key] = stacks.get(key, 0) + 1
+                samples += 1
+            del frames
+            time.sleep(self.interval)
+        try:
+            self.last_result = self._write(stacks, samples)
+        except OSError as e:
+            self.last_result = {'samples': samples, 'error': str(e)}
+        return
+
+    def _write(self, stacks, samples):
+        labels = {}
+        collapsed = {}
+        for (view, codes), n in stacks.items():
+            names = []
+            for code in codes:
+                label = labels.get(code, None)
+                if label is None:
+                    label = labels[code] = _frame_label(code).replace(';', ',')
+                names.append(label)
+            key = (view, tuple(names))
+            collapsed[key] = collapsed.get(key, 0) + n
+
+        stamp = time.strftime('%Y%m%d%H%M%S', time.gmtime(self.started))
+        basename = os.path.join(self.output_dir, 'snakraws-profile-%s-%d' % (stamp, os.getpid()))
+        with open(basename + '.collapsed', 'wt') as f:
+            for (view, names), n in sorted(collapsed.items()):
+                f.write('%s %d\n' % (';'.join((view,) + names), n))
+
+        frame_index = {}
+        frames = []
+        profiles = {}
+        for (view, names), n in sorted(collapsed.items()):
+            indexes = []
+            for name in names:
+                idx = frame_index.get(name, None)
+                if idx is None:
+                    idx = frame_index[name] = len(frames)
+                    frames.append({'name': name})
+                indexes.append(idx)
+            profile = profiles.setdefault(view, {'type': 'sampled', 'name': view, 'unit': 'milliseconds',
+                                                 'startValue': 0, 'endValue': 0, 'samples': [], 'weights': []})
+            profile['samples'].append(indexes)
+            profile['weights'].append(n * self.interval * 1000)
+            profile['endValue'] += n * self.interval * 1000
+        with open(basename + '.speedscope.json', 'wt') as f:
+            json.dump({
+                '$schema': 'https://www.speedscope.app/file-format-schema.json',
+                'name': os.path.basename(basename),
+                'exporter': settings.VERBOSE_NAME,
+                'shared': {'frames': frames},
+                'profiles': [profiles[view] for view in sorted(profiles)],
+            }, f)
+
+        return {
+            'samples': samples,
+            'views': dict((view, sum(p['weights']) / 1000.0) for view, p in profiles.items()),
+            'files': [basename + '.collapsed', basename + '.speedscope.json'],
+        }
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,199 @@
+'''
+ratelimits.py throttles clients that hammer the redirect, shorten and API views, before any geolocation, metadata
+fetch or event write is spent on them.
+
+Each request takes one token from three token buckets: one for its client IP (see client_ip), one for the IP's /24
+(IPv4) or /64 (IPv6) network, and one for a hash of its user agent. RATE_LIMITS sets the refill rate (tokens per second) and size
+of each kind of bucket for each scope, e.g.
+
+    RATE_LIMITS = {
+        'redirect': {'ip': (10, 50), 'prefix': (50, 200), 'ua': (100, 500)},
+        ...
+    }
+
+Buckets live in the Django cache when RATE_LIMIT_BACKEND is 'cache', so every node sees the same ones, or in an
+in-process LRU when it is 'local' or the cache fails. The cache backend reads and writes a bucket without locking,
+so concurrent requests for one client can occasionally both get the last token.
+'''
+
+import hashlib
+import ipaddress
+import random
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache, wraps
+
+from django.core.cache import cache
+from django.http import HttpResponse
+
+from snakraws import settings
+from snakraws.logsinks import get_logger
+from snakraws.metrics import count
+
+DEFAULT_RATE_LIMITS = {
+    'redirect': {'ip': (10, 50), 'prefix': (50, 200), 'ua': (100, 500)},
+    'shorten': {'ip': (0.2, 10), 'prefix': (1, 30), 'ua': (2, 60)},
+    'api': {'ip': (1, 30), 'prefix': (5, 100), 'ua': (10, 200)},
+}
+
+IPV4_PREFIX = 24
+IPV6_PREFIX = 64
+
+
+def _parse_ip(value):
+    try:
+        return ipaddress.ip_address(value.strip())
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=1)
+def _trusted_proxies():
+    return [ipaddress.ip_network(network, strict=False) for network in getattr(settings, "TRUSTED_PROXIES", [])]
+
+
+def client_ip(request):
+    """
+    The client IP, which can't be spoofed with X-Forwarded-For: the peer address, unless that is one of
+    TRUSTED_PROXIES, in which case X-Forwarded-For is read from the right, skipping the entries the trusted proxies
+    appended, and the first entry no trusted proxy vouches for is the client. Entries further left were sent by the
+    client itself and are never used.
+    """
+    fake_ip = getattr(settings, 'FAKE_IP', None)
+    if fake_ip:
+        return _parse_ip(fake_ip)
+    ip = _parse_ip(request.META.get('REMOTE_ADDR', None) or '')
+    trusted = _trusted_proxies()
+    if ip is None or not trusted:
+        return ip
+    forwarded = [entry for entry in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if entry.strip()]
+    while ip is not None and any(ip in network for network in trusted) and forwarded:
+        ip = _parse_ip(forwarded.pop())
+    return ip
+
+
+def bucket_keys(request, scope):
+    """(kind, cache key) for each bucket this request draws from."""
+    keys = []
+    ip = client_ip(request)
+    if ip is not None:
+        keys.append(('ip', 'rl:%s:ip:%s' % (scope, ip.compressed)))
+        prefix = ipaddress.ip_network('%s/%d' % (ip, IPV4_PREFIX if ip.version == 4 else IPV6_PREFIX), strict=False)
+        keys.append(('prefix', 'rl:%s:prefix:%s' % (scope, prefix.compressed)))
+    ua = request.META.get('HTTP_USER_AGENT', '')
+    keys.append(('ua', 'rl:%s:ua:%s' % (scope, hashlib.blake2b(ua.encode('utf-8', 'replace'), digest_size=8).hexdigest())))
+    return ip, keys
+
+
+def _refill(bucket, rate, size, now):
+    tokens, updated = bucket if bucket else (size, now)
+    return min(size, tokens + (now - updated) * rate)
+
+
+class LocalBuckets:
+    """Token buckets kept in this process, least recently used dropped first once there are max_keys of them."""
+
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        return
+
+    def take(self, keys, limits, now):
+        """Takes a token from every bucket; returns the kinds that had none (and so took nothing)."""
+        denied = []
+        with self._lock:
+            for kind, key in keys:
+                rate, size = limits[kind]
+                tokens = _refill(self._buckets.get(key, None), rate, size, now)
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    denied.append(kind)
+                self._buckets[key] = (tokens, now)
+                self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return denied
+
+
+class CacheBuckets:
+    """Token buckets kept in the Django cache, read and written in one round trip each."""
+
+    def take(self, keys, limits, now):
+        buckets = cache.get_many([key for kind, key in keys])
+        denied = []
+        updates = {}
+        timeout = 1
+        for kind, key in keys:
+            rate, size = limits[kind]
+            tokens = _refill(buckets.get(key, None), rate, size, now)
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                denied.append(kind)
+            updates[key] = (tokens, now)
+            # a bucket left alone this long is full again, so it can expire
+            timeout = max(timeout, int(size / rate) + 1)
+        cache.set_many(updates, timeout=timeout)
+        return denied
+
+
+class RateLimiter:
+
+    def __init__(self):
+        self.enabled = getattr(settings, "ENABLE_RATE_LIMITING", False)
+        self.limits = getattr(settings, "RATE_LIMITS", DEFAULT_RATE_LIMITS)
+        self.exempt_ips = set(getattr(settings, "RATE_LIMIT_EXEMPT_IPS", ['127.0.0.1', '::1']))
+        self.log_sample_rate = getattr(settings, "RATE_LIMIT_LOG_SAMPLE_RATE", 0.01)
+        self.local = LocalBuckets(getattr(settings, "RATE_LIMIT_LOCAL_MAX_KEYS", 100000))
+        self.shared = CacheBuckets() if getattr(settings, "RATE_LIMIT_BACKEND", "cache") == "cache" else None
+        return
+
+    def check(self, request, scope):
+        """None if the request may go ahead; otherwise a 429 response to return instead."""
+        limits = self.limits.get(scope, None)
+        if not self.enabled or not limits:
+            return None
+        ip, keys = bucket_keys(request, scope)
+        if ip is not None and str(ip) in self.exempt_ips:
+            return None
+        keys = [(kind, key) for kind, key in keys if kind in limits]
+        now = time.time()
+        denied = None
+        if self.shared:
+            try:
+                denied = self.shared.take(keys, limits, now)
+            except Exception:
+                count('rate_limit_cache_errors_total')
+        if denied is None:
+            denied = self.local.take(keys, limits, now)
+        if not denied:
+            return None
+        for kind in denied:
+            count('rate_limited_total', scope=scope, kind=kind)
+        if random.random() < self.log_sample_rate:
+            get_logger().warning('rate limited %s %s for %s' % (scope, request.path, ','.join(denied)),
+                                 extra={'http_status': 429, 'ip': str(ip), 'rate_limit': denied})
+        rate, size = limits[denied[0]]
+        response = HttpResponse('Too Many Requests', status=429, content_type="text/plain")
+        response['Retry-After'] = str(max(int(1 / rate), 1))
+        return response
+
+
+rate_limiter = RateLimiter()
+
+
+def rate_limited(scope, methods=None):
+    """View decorator that answers with a 429 once the client is out of tokens for `scope`."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if methods is None or request.method in methods:
+                response = rate_limiter.check(request, scope)
+                if response is not None:
+                    return response
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
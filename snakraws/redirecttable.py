@@ -0,0 +1,201 @@
+'''
+redirecttable.py resolves short URLs from a static, memory-mapped redirect table instead of Postgres, for nodes that
+only serve redirects.
+
+The table is built by `./manage.py build_redirect_table` from the active rows of snakraws_shorturls and
+snakraws_longurls. It is one file laid out as
+
+    header    magic, entry count, offset of the index, build time (HEADER_SIZE bytes)
+    data      per entry: a 4-byte length and a JSON list of the ShortURLs and LongURLs fields a redirect needs
+    index     per entry: the short URL's hash and the offset of its data, sorted by hash (RECORD_SIZE bytes each)
+
+Every worker maps the file read-only, so all of them share one copy in the page cache, and looks a hash up with a
+binary search over the index. A new table is written under a temporary name and renamed over the old one; workers
+notice the rename by stat()ing the file every REDIRECT_TABLE_CHECK_SECONDS and map the new one, while lookups already
+under way finish on the old mapping.
+'''
+
+import datetime
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+from django.utils import timezone
+
+from snakraws import settings
+from snakraws.logsinks import get_logger
+from snakraws.metrics import count
+from snakraws.models import ShortURLs, LongURLs
+
+MAGIC = b'SNKRRT01'
+HEADER = struct.Struct('<8sQQd')
+HEADER_SIZE = 64
+RECORD = struct.Struct('<qQ')
+RECORD_SIZE = RECORD.size
+LENGTH = struct.Struct('<I')
+
+# seconds that redirects found in the table skip writing their events after a write fails
+EVENT_LOG_RETRY_SECONDS = 30
+
+# the order the fields of an entry are written in
+ENTRY_FIELDS = ('shorturl_id', 'shorturl', 'cache_max_age', 'version', 'modified_on', 'longurl_id', 'longurl',
+                'title', 'description', 'image_url', 'byline', 'site_name')
+
+
+def redirect_table_mode():
+    """'off', 'fallback' (the table first, then the database on a miss) or 'only' (a miss is a 404)."""
+    return getattr(settings, "REDIRECT_TABLE_MODE", "off")
+
+
+def encode_entry(values):
+    data = json.dumps(values, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    return LENGTH.pack(len(data)) + data
+
+
+def write_table(f, entries):
+    """
+    Writes a table to binary file `f` from (hash, values) pairs in ascending hash order, values as in ENTRY_FIELDS.
+    Returns the number of entries written.
+    """
+    index = bytearray()
+    f.write(b'\0' * HEADER_SIZE)
+    offset = HEADER_SIZE
+    previous = None
+    for shash, values in entries:
+        if previous is not None and shash <= previous:
+            raise ValueError('redirect table entries must be in ascending hash order')
+        previous = shash
+        data = encode_entry(values)
+        f.write(data)
+        index += RECORD.pack(shash, offset)
+        offset += len(data)
+    f.write(index)
+    entries = len(index) // RECORD_SIZE
+    f.seek(0)
+    f.write(HEADER.pack(MAGIC, entries, offset, time.time()))
+    return entries
+
+
+class RedirectTable:
+    """One mapped table file. get() is a lock-free binary search and never writes."""
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.entries, self._index, self.built_at = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or self._index + self.entries * RECORD_SIZE != len(self._map):
+            raise ValueError('%s is not a redirect table' % filename)
+        return
+
+    def get(self, shash):
+        """The ENTRY_FIELDS dict of the short URL with hash `shash`, or None."""
+        m = self._map
+        lo, hi = 0, self.entries
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key, offset = RECORD.unpack_from(m, self._index + mid * RECORD_SIZE)
+            if key < shash:
+                lo = mid + 1
+            elif key > shash:
+                hi = mid
+            else:
+                length, = LENGTH.unpack_from(m, offset)
+                start = offset + LENGTH.size
+                return dict(zip(ENTRY_FIELDS, json.loads(m[start:start + length].decode('utf-8'))))
+        return None
+
+
+class RedirectTableReader:
+    """The current table at REDIRECT_TABLE_PATH, remapped whenever the file is replaced."""
+
+    def __init__(self):
+        self.filename = getattr(settings, "REDIRECT_TABLE_PATH", None)
+        self.check_seconds = getattr(settings, "REDIRECT_TABLE_CHECK_SECONDS", 5)
+        self._table = None
+        self._checked_at = 0
+        self._log_retry_at = 0
+        self._lock = threading.Lock()
+        return
+
+    def event_log_paused(self):
+        """True for a while after an event write for a table redirect failed, e.g. in a database maintenance window."""
+        return time.time() < self._log_retry_at
+
+    def event_log_failed(self):
+        self._log_retry_at = time.time() + EVENT_LOG_RETRY_SECONDS
+        return
+
+    def _refresh(self):
+        with self._lock:
+            if time.time() - self._checked_at < self.check_seconds:
+                return
+            self._checked_at = time.time()
+            try:
+                st = os.stat(self.filename)
+            except OSError as e:
+                if self._table is not None:
+                    get_logger().warning('redirect table %s is gone, keeping the one mapped: %s'
+                                         % (self.filename, str(e)))
+                return
+            current = self._table
+            if current and (current.stat.st_ino, current.stat.st_mtime_ns, current.stat.st_size) \
+                    == (st.st_ino, st.st_mtime_ns, st.st_size):
+                return
+            try:
+                table = RedirectTable(self.filename)
+            except (OSError, ValueError) as e:
+                get_logger().warning('redirect table %s not loaded: %s' % (self.filename, str(e)))
+                return
+            # lookups holding the previous table finish on it; its mapping is closed once they drop it
+            self._table = table
+            count('redirect_table_loads_total')
+            get_logger().info('redirect table %s loaded, %d short URLs built %s'
+                              % (self.filename, table.entries,
+                                 datetime.datetime.utcfromtimestamp(table.built_at).isoformat()))
+        return
+
+    def table(self):
+        if not self.filename:
+            return None
+        if time.time() - self._checked_at >= self.check_seconds:
+            self._refresh()
+        return self._table
+
+    def lookup(self, shash):
+        """
+        Unsaved ShortURLs and LongURLs instances for the active short URL with hash `shash`, or (None, None) if it
+        isn't in the table. The long URL is already decoded.
+        """
+        table = self.table()
+        entry = table.get(shash) if table is not None else None
+        count('redirect_table_lookups_total', answer='unloaded' if table is None else 'hit' if entry else 'miss')
+        if entry is None:
+            return None, None
+        l = LongURLs(
+                id=entry['longurl_id'],
+                longurl=entry['longurl'],
+                originally_encoded=False,
+                is_active=True,
+                title=entry['title'],
+                description=entry['description'],
+                image_url=entry['image_url'],
+                byline=entry['byline'],
+                site_name=entry['site_name'])
+        s = ShortURLs(
+                id=entry['shorturl_id'],
+                hash=shash,
+                longurl=l,
+                shorturl=entry['shorturl'],
+                is_active=True,
+                cache_max_age=entry['cache_max_age'],
+                version=entry['version'],
+                modified_on=datetime.datetime.fromtimestamp(entry['modified_on'], timezone.utc)
+                if entry['modified_on'] is not None else None)
+        return s, l
+
+
+redirect_table = RedirectTableReader()
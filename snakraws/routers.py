@@ -0,0 +1,120 @@
+'''
+routers.py sends read-only short URL, long URL and stats queries to read replicas, and everything else to the primary.
+
+Replicas listed in DATABASE_REPLICAS are used only while their replication lag is within REPLICA_MAX_LAG_SECONDS.
+Once a request writes anything, the rest of it reads from the primary, and ReplicaPinningMiddleware keeps the client
+that wrote on the primary for REPLICA_PIN_SECONDS more, so a short URL is never a 404 right after it was created.
+'''
+
+import random
+import threading
+import time
+
+from django.db import connections, DatabaseError
+
+from snakraws import settings
+from snakraws.models import ShortURLs, LongURLs, ShortURLClicks, VisitorSketch, RollupDaily, RollupHourly
+
+PRIMARY_DB = 'default'
+
+# models whose reads may be served by a replica
+REPLICA_READ_MODELS = (ShortURLs, LongURLs, ShortURLClicks, VisitorSketch, RollupDaily, RollupHourly)
+
+REPLICA_LAG_SQL = '''
+    SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END
+'''
+
+_state = threading.local()
+
+
+def pin_to_primary():
+    """Sends the rest of this request's reads to the primary."""
+    _state.pinned = True
+    return
+
+
+def is_pinned():
+    return getattr(_state, 'pinned', False)
+
+
+def reset_pin(pinned=False):
+    _state.pinned = pinned
+    _state.wrote_urls = False
+    return
+
+
+def mark_wrote_urls():
+    """Records that this request created or changed a short or long URL, for writes that bypass the router."""
+    _state.wrote_urls = True
+    pin_to_primary()
+    return
+
+
+def request_wrote_urls():
+    """True if this request created or changed a short or long URL."""
+    return getattr(_state, 'wrote_urls', False)
+
+
+def replicas_enabled():
+    return bool(getattr(settings, "DATABASE_REPLICAS", []))
+
+
+class ReplicaLagMonitor:
+    """Caches each replica's measured lag for REPLICA_LAG_CHECK_SECONDS; unreachable replicas count as unhealthy."""
+
+    def __init__(self):
+        self.max_lag = getattr(settings, "REPLICA_MAX_LAG_SECONDS", 5)
+        self.check_seconds = getattr(settings, "REPLICA_LAG_CHECK_SECONDS", 5)
+        self.checked = {}
+        self._lock = threading.Lock()
+        return
+
+    def _lag(self, alias):
+        try:
+            with connections[alias].cursor() as cursor:
+                cursor.execute(REPLICA_LAG_SQL)
+                return float(cursor.fetchone()[0])
+        except DatabaseError:
+            return None
+
+    def is_healthy(self, alias):
+        now = time.monotonic()
+        checked_at, healthy = self.checked.get(alias, (None, False))
+        if checked_at is None or now - checked_at > self.check_seconds:
+            with self._lock:
+                checked_at, healthy = self.checked.get(alias, (None, False))
+                if checked_at is None or now - checked_at > self.check_seconds:
+                    lag = self._lag(alias)
+                    healthy = lag is not None and lag <= self.max_lag
+                    self.checked[alias] = (now, healthy)
+        return healthy
+
+    def healthy_replicas(self):
+        return [alias for alias in getattr(settings, "DATABASE_REPLICAS", []) if self.is_healthy(alias)]
+
+
+lag_monitor = ReplicaLagMonitor()
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        if is_pinned() or not issubclass(model, REPLICA_READ_MODELS) or not replicas_enabled():
+            return PRIMARY_DB
+        replicas = lag_monitor.healthy_replicas()
+        return random.choice(replicas) if replicas else PRIMARY_DB
+
+    def db_for_write(self, model, **hints):
+        if issubclass(model, (ShortURLs, LongURLs)):
+            mark_wrote_urls()
+        else:
+            pin_to_primary()
+        return PRIMARY_DB
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == PRIMARY_DB
@@ -7,8 +7,10 @@ from django.db.models.query_utils import Q
 from snakraws import settings
 from snakraws.utils import get_useragent, requested_directive
 from snakraws.models import Blacklist
+from snakraws.metrics import timed, record_cache
 
 
+@timed('bot_detection')
 def get_useragent_or_403_if_bot(request):
     bot_name = None
     enabled = getattr(settings, "ENABLE_BOT_DETECTION", True)
@@ -16,10 +18,12 @@ def get_useragent_or_403_if_bot(request):
         if not requested_directive(request):
             lc_http_useragent = get_useragent(request, True)
             botblacklist = cache.get('botblacklist')
+            record_cache('botblacklist', botblacklist is not None)
             if not botblacklist:
                 botblacklist = settings.BOTBLACKLIST
                 cache.set('botblacklist', botblacklist)
             botwhitelist = cache.get('botwhitelist')
+            record_cache('botwhitelist', botwhitelist is not None)
             if not botwhitelist:
                 botwhitelist = settings.BOTWHITELIST
                 cache.set('botwhitelist', botwhitelist)
@@ -38,6 +42,7 @@ def get_useragent_or_403_if_bot(request):
     return bot_name, get_useragent(request, False)
 
 
+@timed('is_blacklisted')
 def is_blacklisted(
         dimgeolocation=None,
         dimdevice=None,
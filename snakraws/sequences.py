@@ -0,0 +1,136 @@
+'''
+sequences.py generates short URL paths from a database sequence instead of at random, for
+SHORTURL_GENERATION_MODE = 'sequence'.
+
+Each worker leases a block of ids at a time from the snakraws_shorturl_codes sequence (one nextval() per block,
+since the sequence increments by the block size), scrambles each id with a keyed Feistel permutation over the
+keyspace of SHORTURL_PATH_SIZE characters, and encodes the result in SHORTURL_PATH_ALPHABET. Distinct ids always
+give distinct paths, so a new short URL needs no collision lookup, and consecutive ids don't give guessable paths.
+'''
+
+import hashlib
+import os
+import threading
+
+from django.db import connections
+
+from snakraws import settings
+from snakraws.utils import is_shortpath_valid
+
+SHORTURL_SEQUENCE = 'snakraws_shorturl_codes'
+
+FEISTEL_ROUNDS = 4
+
+LEASE_SQL = '''
+    SELECT nextval(%s), (SELECT increment_by FROM pg_sequences WHERE sequencename = %s)
+'''
+
+
+class KeyspaceExhausted(Exception):
+    pass
+
+
+class FeistelPermutation:
+    """
+    A keyed bijection on [0, size). A balanced Feistel network permutes the smallest even-width power of two that
+    holds size; values that land outside [0, size) are put through it again (cycle walking) until they don't.
+    """
+
+    def __init__(self, size, key, rounds=FEISTEL_ROUNDS):
+        self.size = size
+        self.rounds = rounds
+        bits = max((size - 1).bit_length(), 2)
+        self.half_bits = (bits + 1) // 2
+        self.half_mask = (1 << self.half_bits) - 1
+        self.keys = [hashlib.blake2b(('%s:%d' % (key, r)).encode('utf-8'), digest_size=32).digest()[:16]
+                     for r in range(rounds)]
+        return
+
+    def _round(self, r, value):
+        digest = hashlib.blake2b(value.to_bytes(8, 'big'), key=self.keys[r], digest_size=8).digest()
+        return int.from_bytes(digest, 'big') & self.half_mask
+
+    def _permute(self, value):
+        left, right = value >> self.half_bits, value & self.half_mask
+        for r in range(self.rounds):
+            left, right = right, left ^ self._round(r, right)
+        return (left << self.half_bits) | right
+
+    def __call__(self, value):
+        if not 0 <= value < self.size:
+            raise ValueError('%d is outside the permutation domain [0, %d)' % (value, self.size))
+        value = self._permute(value)
+        while value >= self.size:
+            value = self._permute(value)
+        return value
+
+
+def encode(value, alphabet, size):
+    """value written in base len(alphabet), left-padded with alphabet[0] to size characters."""
+    base = len(alphabet)
+    chars = []
+    for _ in range(size):
+        value, digit = divmod(value, base)
+        chars.append(alphabet[digit])
+    return ''.join(reversed(chars))
+
+
+class ShortPathSequence:
+    """Hands out scrambled, encoded short paths from id blocks leased from SHORTURL_SEQUENCE."""
+
+    def __init__(self):
+        self.alphabet = settings.SHORTURL_PATH_ALPHABET
+        self.size = settings.SHORTURL_PATH_SIZE
+        self.keyspace = len(self.alphabet) ** self.size
+        self.permutation = FeistelPermutation(self.keyspace, '%s:%s:%d' % (settings.SECRET_KEY, self.alphabet, self.size))
+        self._lock = threading.Lock()
+        self._pid = None
+        self._next = 0
+        self._end = 0
+        return
+
+    def _lease(self):
+        with connections['default'].cursor() as cursor:
+            cursor.execute(LEASE_SQL, [SHORTURL_SEQUENCE, SHORTURL_SEQUENCE])
+            start, block = cursor.fetchone()
+        self._next = start
+        self._end = start + (block or 1)
+        return
+
+    def next_id(self):
+        with self._lock:
+            # a block inherited across a fork is being handed out by the parent too, so lease a fresh one
+            if self._pid != os.getpid() or self._next >= self._end:
+                self._pid = os.getpid()
+                self._lease()
+            value = self._next
+            self._next += 1
+        return value
+
+    def next_shortpath(self):
+        while True:
+            value = self.next_id()
+            if value >= self.keyspace:
+                raise KeyspaceExhausted('All %d short paths of %d characters have been used; raise SHORTURL_PATH_SIZE'
+                                        % (self.keyspace, self.size))
+            shortpath = encode(self.permutation(value), self.alphabet, self.size)
+            # profane and reserved paths just burn their id
+            if is_shortpath_valid(shortpath):
+                return shortpath
+
+
+_sequence = None
+_sequence_lock = threading.Lock()
+
+
+def get_sequence():
+    global _sequence
+    if _sequence is None:
+        with _sequence_lock:
+            if _sequence is None:
+                _sequence = ShortPathSequence()
+    return _sequence
+
+
+def sequence_mode():
+    return getattr(settings, "SHORTURL_GENERATION_MODE", "random") == "sequence"
@@ -39,17 +39,24 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE = [
+    'snakraws.middleware.ConnectionHealthMiddleware',
+    'snakraws.middleware.QueryProfilerMiddleware',
+    'snakraws.middleware.ReplicaPinningMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'snakraws.middleware.ProfilerViewMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
 ROOT_URLCONF = 'snakraws.urls'
 
+# read-only short/long URL and stats queries go to DATABASE_REPLICAS (see local_settings) when any are configured
+DATABASE_ROUTERS = ['snakraws.routers.ReplicaRouter']
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -86,4 +93,33 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Database connection reuse per worker role, chosen with the SNAKR_WORKER_ROLE environment variable. Redirect
+# workers serve many tiny requests and keep connections (or pooled connections) for a long time; admin workers are
+# few and bursty. CONN_MAX_AGE applies to the stock backend, POOL to snakraws.db.backends.postgresql_pool.
+# Values set explicitly on a DATABASES entry win. Override the profiles in local_settings if needed.
+DATABASE_CONNECTION_PROFILES = {
+    'redirect': {
+        'CONN_MAX_AGE': 600,
+        'POOL': {'MAX': 20, 'TIMEOUT': 2, 'MAX_AGE': 1800, 'HEALTH_CHECK_SECONDS': 30},
+    },
+    'admin': {
+        'CONN_MAX_AGE': 60,
+        'POOL': {'MAX': 4, 'TIMEOUT': 10, 'MAX_AGE': 300, 'HEALTH_CHECK_SECONDS': 30},
+    },
+    'all': {
+        'CONN_MAX_AGE': 300,
+        'POOL': {'MAX': 10, 'TIMEOUT': 5, 'MAX_AGE': 900, 'HEALTH_CHECK_SECONDS': 30},
+    },
+}
+
 from snakraws.local_settings import *
+
+SNAKR_WORKER_ROLE = os.environ.get('SNAKR_WORKER_ROLE', 'all')
+_connection_profile = DATABASE_CONNECTION_PROFILES.get(SNAKR_WORKER_ROLE, DATABASE_CONNECTION_PROFILES['all'])
+for _database in DATABASES.values():
+    if _database.get('ENGINE', '') == 'snakraws.db.backends.postgresql_pool':
+        # the pool keeps the connections; Django hands its connection back at the end of every request
+        _database.setdefault('CONN_MAX_AGE', 0)
+        _database['POOL'] = dict(_connection_profile['POOL'], **_database.get('POOL', {}))
+    else:
+        _database.setdefault('CONN_MAX_AGE', _connection_profile['CONN_MAX_AGE'])
@@ -3,18 +3,31 @@ ShortURLs.py contains the logic necessary to take a short URL and redirect to it
 needed to construct a short URL when a long URL is submitted to Snakr.
 '''
 
+import random
+
 from urllib.parse import urlparse, urlunparse
-from django.db import transaction as xaction
+from django.db import DatabaseError, InterfaceError, transaction as xaction
 from django.http import Http404
 from django.utils.safestring import mark_safe
 
 from snakraws import settings
 from snakraws.persistence import SnakrLogger
+from snakraws.counters import count_click
+from snakraws.trending import track_redirect
+from snakraws.metrics import count, timer
+from snakraws.httpcache import not_modified
+from snakraws.routers import PRIMARY_DB, replicas_enabled
 from snakraws.security import get_useragent_or_403_if_bot
 from snakraws.models import ShortURLs, LongURLs
+from snakraws.bloom import shortpath_filter, shorturl_hash_filter
+from snakraws.redirecttable import redirect_table, redirect_table_mode
+from snakraws.sequences import KeyspaceExhausted, get_sequence, sequence_mode
 from snakraws.utils import get_shortpathcandidate, get_shorturlhash, get_decodedurl, get_host, get_referer, \
     is_url_valid, is_shortpath_valid, requested_last, requested_last_shorturlref
 
+# how many random short paths to try before giving up on finding an unused one
+SHORTURL_GENERATION_ATTEMPTS = 10
+
 
 class ShortURL:
     """Validates and processes the short URL in the GET request."""
@@ -45,6 +58,10 @@ class ShortURL:
         self.normalized_shorturl_scheme = None
         self.hash = None
         self.id = -1
+        self.cache_max_age = None
+        self.version = None
+        self.modified_on = None
+        self.not_modified = None
         return
 
     def make_short(self, normalized_longurl_scheme, vanity_path):
@@ -66,33 +83,49 @@ class ShortURL:
         # 2. Make a short url.
         #    a. If vanity_path was passed, use it; otherwise:
         #    b. If no vanity path was passed, build a path with SHORTURL_PATH_SIZE characters from SHORTURL_PATH_ALPHABET.
-        #    c. Does it exist already? If so, regenerate it and try again.
+        #       With SHORTURL_GENERATION_MODE = 'sequence', the path comes from sequences.py instead.
+        #    c. Does it exist already? If so, regenerate it and try again. A path from the sequence is unique by
+        #       construction, so it isn't looked up, and the path filter rules most others out without a query.
+        #    d. Vet a vanity path (reserved words, profanity) only once we know it's free.
         #
-        if vanity_path:
-            vp = vanity_path.strip()
+        vp = vanity_path.strip() if vanity_path else None
+        from_sequence = not vp and sequence_mode()
+        for attempt in range(SHORTURL_GENERATION_ATTEMPTS):
             if vp:
-                if not is_shortpath_valid(vp):
-                    shorturl_candidate = shorturl_prefix + vp
+                shortpath = vp
+            elif from_sequence:
+                try:
+                    shortpath = get_sequence().next_shortpath()
+                except KeyspaceExhausted as e:
+                    # logged as critical, since no new short url can be made until SHORTURL_PATH_SIZE is raised
                     raise self.event.log(
-                            messagekey='SHORT_PATH_INVALID',
-                            value=shorturl_candidate,
-                            status_code=400)
-                shorturl_candidate = shorturl_prefix + vp
+                            messagekey='SHORT_URL_KEYSPACE_EXHAUSTED',
+                            value=str(e),
+                            status_code=422)
             else:
-                shorturl_candidate = shorturl_prefix + get_shortpathcandidate()
+                shortpath = get_shortpathcandidate()
+            shorturl_candidate = shorturl_prefix + shortpath
+            if not is_url_valid(shorturl_candidate):
+                raise self.event.log(
+                        messagekey='SHORT_URL_INVALID',
+                        value=shorturl_candidate,
+                        status_code=400)
+            shash = get_shorturlhash(shorturl_candidate)
+            if from_sequence or not shortpath_filter.might_contain(shortpath) \
+                    or not ShortURLs.objects.filter(hash=shash).exists():
+                break
+            if vp:
+                raise self.event.log(
+                        messagekey='VANITY_PATH_EXISTS',
+                        status_code=400)
         else:
-            shorturl_candidate = shorturl_prefix + get_shortpathcandidate()
-        if not is_url_valid(shorturl_candidate):
             raise self.event.log(
-                    messagekey='SHORT_URL_INVALID',
-                    value=shorturl_candidate,
+                    messagekey='VANITY_PATH_EXISTS',
                     status_code=400)
-        shash = get_shorturlhash(shorturl_candidate)
-        s = ShortURLs.objects.filter(hash=shash)
-        sc = s.count()
-        if sc != 0:
+        if vp and not is_shortpath_valid(vp):
             raise self.event.log(
-                    messagekey='VANITY_PATH_EXISTS',
+                    messagekey='SHORT_PATH_INVALID',
+                    value=shorturl_candidate,
                     status_code=400)
         #
         # 3. SUCCESS! Complete it and return it as a ****decoded**** url (which it is at this point)
@@ -103,7 +136,6 @@ class ShortURL:
         self.hash = shash
         return self.normalized_shorturl
 
-    @xaction.atomic
     def get_long(self, request):
         #
         # cleanse the passed short url
@@ -126,17 +158,8 @@ class ShortURL:
             else:
                 raise Http404
 
-        # 2019-6-21 bml BUGFIX if SITE_MODE <> DATABASE_MODE (meaning we're debugging),
-        # replace the host name in the normalized short url with SHORTURL_HOST b4 lookup
         if settings.SITE_MODE != settings.DATABASE_MODE:
-            # can't update sparts directly as methods/properties are private, so do this roundabout hacky thing
-            tmp = list(sparts)
-            if settings.SSL_ENABLED:
-                tmp[0] = "https"
-            else:
-                tmp[0] = "http"
-            tmp[1] = settings.SHORTURL_HOST
-            surl = urlunparse(tmp)
+            surl = get_lookup_shorturl(surl)
             dsurl = get_decodedurl(surl)
             sparts = urlparse(dsurl)
 
@@ -171,12 +194,45 @@ class ShortURL:
         # Lookup the short url
         #
         self.hash = get_shorturlhash(self.normalized_shorturl)
+        mode = redirect_table_mode()
+        if mode != 'off':
+            s, l = redirect_table.lookup(self.hash)
+            if s is not None:
+                # served without opening a transaction, which would connect to the database; that keeps table
+                # redirects working while the database is away
+                return self._redirect(request, s, l, from_table=True)
+            if mode == 'only':
+                # a redirect-only node never asks the database, and doesn't log what it can't find
+                raise Http404
+        with xaction.atomic():
+            return self._redirect(request, self._lookup(request), None, from_table=False)
+
+    def _lookup(self, request):
+        """The ShortURLs row for self.hash from the database; raises a 404 if there isn't one."""
         s = None
-        try:
-            if ShortURLs.objects.filter(hash=self.hash).exists():
-                s = ShortURLs.objects.get(hash=self.hash)
-        except:
-            pass
+        # a "no" from the hash filter has already caught up with every short url created since it last did, so it is
+        # answered without a query; it usually means a scan of random paths, so only a sample of them is logged
+        if not shorturl_hash_filter.might_contain(self.hash):
+            count('unknown_shorturl_filtered_total')
+            if random.random() >= getattr(settings, "UNKNOWN_SHORTURL_LOG_SAMPLE_RATE", 0.01):
+                raise Http404
+            raise self.event.log(
+                    request=request,
+                    event_type='U',
+                    messagekey='SHORT_URL_NOT_FOUND',
+                    value=self.shorturl,
+                    status_code=404
+            )
+        with timer('get_long_shorturl_lookup'):
+            # a replica may not have the short url yet if it was only just created, so check the primary first
+            for shorturls in (ShortURLs.objects, ShortURLs.objects.using(PRIMARY_DB)) if replicas_enabled() \
+                    else (ShortURLs.objects,):
+                try:
+                    if shorturls.filter(hash=self.hash).exists():
+                        s = shorturls.get(hash=self.hash)
+                        break
+                except:
+                    pass
         if not s:
             raise self.event.log(
                     request=request,
@@ -185,6 +241,13 @@ class ShortURL:
                     value=self.shorturl,
                     status_code=404
             )
+        return s
+
+    def _redirect(self, request, s, l, from_table):
+        """
+        (long url, status code) for short url `s`. `l` is its long url if already known, and `from_table` says both came
+        from the redirect table, in which case failing to write the event doesn't fail the redirect.
+        """
         if s.shorturl != self.shorturl:
             raise self.event.log(
                     request=request,
@@ -201,10 +264,24 @@ class ShortURL:
                     messagekey='HTTP_404',
                     value=self.shorturl,
                     status_code=404)
+        self.id = s.id
+        self.cache_max_age = s.cache_max_age
+        self.version = s.version
+        self.modified_on = s.modified_on
+        #
+        # If the client already has this version of the redirect, a 304 is all it needs: no long url lookup, event or
+        # click. The version changes whenever the short url or its long url does
+        #
+        self.not_modified = not_modified(request, s.id, s.version, s.modified_on, s.cache_max_age)
+        if self.not_modified is not None:
+            count('redirects_not_modified_total')
+            return None, 304
         #
         # Lookup the matching long url by the short url's id, and decode it. Must be active!
         #
-        l = LongURLs.objects.get(id=s.longurl_id, is_active=True)
+        if l is None:
+            with timer('get_long_longurl_lookup'):
+                l = LongURLs.objects.get(id=s.longurl_id, is_active=True)
         if not l:
             raise self.event.log(request=request,
                                  messagekey='HTTP_404',
@@ -219,7 +296,29 @@ class ShortURL:
         # Log that a permanent redirect response to the matching long url is about to occur
         #
         status_code = 301
-        msg = self.event.log(
+        if not from_table:
+            self._log_redirect(request, s, l, status_code)
+        elif redirect_table.event_log_paused():
+            # the database is away; don't make every redirect wait on it to find out again
+            count('redirect_table_log_skipped_total')
+        else:
+            # in a transaction of its own, caught outside it, so a failed write is rolled back rather than left open
+            try:
+                with xaction.atomic():
+                    self._log_redirect(request, s, l, status_code)
+            except (DatabaseError, InterfaceError):
+                # the redirect table keeps redirects working while the database is away; only the event is lost
+                redirect_table.event_log_failed()
+                count('redirect_table_log_errors_total')
+        count_click(s.id)
+        track_redirect(s.shorturl)
+        #
+        # Return the longurl
+        #
+        return l, status_code
+
+    def _log_redirect(self, request, s, l, status_code):
+        self.event.log(
                 request=request,
                 event_type='S',
                 messagekey='HTTP_%d' % status_code,
@@ -228,7 +327,52 @@ class ShortURL:
                 shorturl=s,
                 status_code=status_code
         )
-        #
-        # Return the longurl
-        #
-        return l, status_code
+        return
+
+
+def get_lookup_shorturl(surl):
+    """The short url as it is stored, for looking up the requested short url `surl`."""
+    # 2019-6-21 bml BUGFIX if SITE_MODE <> DATABASE_MODE (meaning we're debugging),
+    # replace the host name in the normalized short url with SHORTURL_HOST b4 lookup
+    if settings.SITE_MODE != settings.DATABASE_MODE:
+        # can't update sparts directly as methods/properties are private, so do this roundabout hacky thing
+        tmp = list(urlparse(get_decodedurl(surl)))
+        if settings.SSL_ENABLED:
+            tmp[0] = "https"
+        else:
+            tmp[0] = "http"
+        tmp[1] = settings.SHORTURL_HOST
+        surl = urlunparse(tmp)
+    return surl
+
+
+def _shorturl_prefixes():
+    # every prefix make_short can give a short url, so a path taken under any of them counts as taken
+    if settings.SITE_MODE == 'dev':
+        return ['http://' + settings.SHORTURL_HOST + '/']
+    return ['http://' + settings.SHORTURL_HOST + '/', 'https://' + settings.SECURE_SHORTURL_HOST + '/']
+
+
+def taken_vanity_paths(paths):
+    """The subset of `paths` already in use, answering from the path filter where it can and one query otherwise."""
+    maybe = [path for path in paths if shortpath_filter.might_contain(path)]
+    if not maybe:
+        return set()
+    hashes = dict((get_shorturlhash(prefix + path), path) for path in maybe for prefix in _shorturl_prefixes())
+    return set(hashes[h] for h in ShortURLs.objects.filter(hash__in=list(hashes)).values_list('hash', flat=True))
+
+
+def suggest_vanity_paths(vanity_path, n=5):
+    """Up to n free, vetted alternatives to vanity_path: numbered variants first, then random suffixes."""
+    vp = vanity_path.strip()
+    candidates = ['%s-%d' % (vp, i) for i in range(2, 2 + n)] + \
+                 ['%s-%s' % (vp, get_shortpathcandidate()[:3]) for _ in range(n)]
+    candidates = [c for c in candidates if len(c) <= 40]
+    taken = taken_vanity_paths(candidates)
+    suggestions = []
+    for candidate in candidates:
+        if candidate not in taken and candidate not in suggestions and is_shortpath_valid(candidate):
+            suggestions.append(candidate)
+            if len(suggestions) >= n:
+                break
+    return suggestions
@@ -0,0 +1,205 @@
+'''
+sketches.py keeps HyperLogLog sketches of the distinct IPs and user agents that visit each short URL per day, so
+unique-visitor counts never mean running COUNT(DISTINCT ...) over the fact table.
+'''
+
+import atexit
+import math
+import struct
+
+from django.db import connection, transaction as xaction
+
+from snakraws import settings
+from snakraws.counters import WriteBehindBuffer
+from snakraws.models import VisitorSketch
+
+MASK_64 = (1 << 64) - 1
+
+SKETCH_DENSE = 0
+SKETCH_SPARSE = 1
+
+SKETCH_DIMENSION = {
+    'I': 'ips',
+    'U': 'useragents',
+}
+
+
+def mix64(value):
+    """splitmix64 finalizer; spreads the (weakly avalanching) FNV1a dimension hashes over all 64 bits."""
+    z = value & MASK_64
+    z = ((z ^ (z >> 30)) * 0xbf58476d1ce4e5b9) & MASK_64
+    z = ((z ^ (z >> 27)) * 0x94d049bb133111eb) & MASK_64
+    return z ^ (z >> 31)
+
+
+class HyperLogLog:
+    """
+    A HyperLogLog cardinality sketch over signed 64-bit hashes with 2**precision one-byte registers.
+    Standard error is about 1.04 / sqrt(2**precision), i.e. ~1.6% at the default precision of 12.
+    """
+
+    def __init__(self, precision=12, registers=None):
+        if not 4 <= precision <= 16:
+            raise ValueError("HyperLogLog precision must be between 4 and 16")
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = registers if registers is not None else bytearray(self.m)
+        return
+
+    def add(self, hash64):
+        x = mix64(hash64)
+        idx = x >> (64 - self.precision)
+        rest = x & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+        return
+
+    def merge(self, other):
+        if other.precision < self.precision:
+            self.precision, self.m, self.registers = other.precision, other.m, self._reduced(other.precision)
+        elif other.precision > self.precision:
+            other = HyperLogLog(self.precision, other._reduced(self.precision))
+        registers = self.registers
+        for idx, rank in enumerate(other.registers):
+            if rank > registers[idx]:
+                registers[idx] = rank
+        return self
+
+    def _reduced(self, precision):
+        # fold the registers down to a lower precision; the index bits we drop become the leading bits of the rank
+        dropped = self.precision - precision
+        registers = bytearray(1 << precision)
+        for idx, rank in enumerate(self.registers):
+            if rank:
+                low = idx & ((1 << dropped) - 1)
+                rank = dropped - low.bit_length() + 1 if low else dropped + rank
+                if rank > registers[idx >> dropped]:
+                    registers[idx >> dropped] = rank
+        return registers
+
+    def count(self):
+        m = self.m
+        alpha = 0.7213 / (1.0 + 1.079 / m) if m >= 128 else {16: 0.673, 32: 0.697, 64: 0.709}[m]
+        zeros = 0
+        total = 0.0
+        for rank in self.registers:
+            total += 2.0 ** -rank
+            if not rank:
+                zeros += 1
+        estimate = alpha * m * m / total
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        # sparse (index, rank) pairs while the sketch is mostly empty, which is most short URLs on most days
+        nonzero = [(idx, rank) for idx, rank in enumerate(self.registers) if rank]
+        if len(nonzero) * 3 < self.m:
+            return bytes([SKETCH_SPARSE, self.precision]) + b''.join(struct.pack('>HB', idx, rank) for idx, rank in nonzero)
+        return bytes([SKETCH_DENSE, self.precision]) + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data, precision=12):
+        data = bytes(data or b'')
+        if len(data) < 2:
+            return cls(precision)
+        sketch = cls(data[1])
+        if data[0] == SKETCH_SPARSE:
+            for idx, rank in struct.iter_unpack('>HB', data[2:]):
+                sketch.registers[idx] = rank
+        else:
+            sketch.registers[:] = data[2:2 + sketch.m]
+        return sketch
+
+
+class VisitorSketches(WriteBehindBuffer):
+    """
+    Sketches keyed by (shorturl_id, event_yyyymmdd, dimension), merged into snakraws_visitorsketches on flush.
+    Registers only ever grow, so merging a flushed batch into the stored sketch is an element-wise max.
+    """
+
+    def __init__(self):
+        self.precision = getattr(settings, "VISITOR_SKETCH_PRECISION", 12)
+        super().__init__(getattr(settings, "VISITOR_SKETCH_FLUSH_SECONDS", 30),
+                         getattr(settings, "VISITOR_SKETCH_FLUSH_SIZE", 500))
+        return
+
+    def _fold(self, aggregate, value):
+        if aggregate is None:
+            aggregate = HyperLogLog(self.precision)
+        aggregate.add(value)
+        return aggregate
+
+    def _combine(self, aggregate, other):
+        return aggregate.merge(other)
+
+    def _write(self, rows):
+        table = VisitorSketch._meta.db_table
+        keys = []
+        for (shorturl_id, yyyymmdd, dimension), _ in rows:
+            keys.extend([shorturl_id, yyyymmdd, dimension])
+        placeholders = ', '.join(['(%s, %s, %s)'] * len(rows))
+        with xaction.atomic():
+            with connection.cursor() as cursor:
+                # make sure every row exists first so that the FOR UPDATE below serializes concurrent flushes
+                cursor.execute(
+                        "INSERT INTO %s (shorturl_id, event_yyyymmdd, dimension, sketch) "
+                        "SELECT v.shorturl_id, v.event_yyyymmdd, v.dimension, ''::bytea "
+                        "FROM (VALUES %s) AS v (shorturl_id, event_yyyymmdd, dimension) "
+                        "ON CONFLICT (shorturl_id, event_yyyymmdd, dimension) DO NOTHING" % (table, placeholders),
+                        keys)
+                cursor.execute(
+                        "SELECT shorturl_id, event_yyyymmdd, dimension, sketch FROM %s "
+                        "WHERE (shorturl_id, event_yyyymmdd, dimension) IN (VALUES %s) "
+                        "ORDER BY shorturl_id, event_yyyymmdd, dimension FOR UPDATE" % (table, placeholders),
+                        keys)
+                stored = dict(((r[0], r[1].strip(), r[2]), r[3]) for r in cursor.fetchall())
+                params = []
+                for key, sketch in rows:
+                    merged = HyperLogLog.from_bytes(stored.get(key), self.precision).merge(sketch)
+                    params.extend([key[0], key[1], key[2], merged.to_bytes()])
+                cursor.execute(
+                        "UPDATE %s AS t SET sketch = v.sketch "
+                        "FROM (VALUES %s) AS v (shorturl_id, event_yyyymmdd, dimension, sketch) "
+                        "WHERE t.shorturl_id = v.shorturl_id AND t.event_yyyymmdd = v.event_yyyymmdd "
+                        "AND t.dimension = v.dimension"
+                        % (table, ', '.join(['(%s::int, %s::char(8), %s::char(1), %s::bytea)'] * len(rows))),
+                        params)
+        return
+
+
+visitor_sketches = VisitorSketches()
+atexit.register(visitor_sketches.flush)
+
+
+def sketch_visit(shorturl_id, yyyymmdd, ip_hash, useragent_hash):
+    if shorturl_id and shorturl_id > 0:
+        visitor_sketches.add((shorturl_id, yyyymmdd, 'I'), ip_hash)
+        visitor_sketches.add((shorturl_id, yyyymmdd, 'U'), useragent_hash)
+    return
+
+
+def get_unique_visitors(shorturl_id, from_yyyymmdd=None, to_yyyymmdd=None):
+    """
+    Returns approximate distinct IP and user agent counts for the short URL, merging the stored day sketches in the
+    (inclusive) date range with whatever this process has not flushed yet.
+    """
+    precision = visitor_sketches.precision
+    merged = dict((dimension, HyperLogLog(precision)) for dimension in SKETCH_DIMENSION)
+    sketches = VisitorSketch.objects.filter(shorturl_id=shorturl_id)
+    if from_yyyymmdd:
+        sketches = sketches.filter(event_yyyymmdd__gte=from_yyyymmdd)
+    if to_yyyymmdd:
+        sketches = sketches.filter(event_yyyymmdd__lte=to_yyyymmdd)
+    for dimension, sketch in sketches.values_list('dimension', 'sketch').iterator():
+        merged[dimension].merge(HyperLogLog.from_bytes(sketch, precision))
+
+    def _in_range(key):
+        return key[0] == shorturl_id \
+            and (not from_yyyymmdd or key[1] >= from_yyyymmdd) \
+            and (not to_yyyymmdd or key[1] <= to_yyyymmdd)
+
+    for (_, _, dimension), sketch in visitor_sketches.pending_items(_in_range):
+        merged[dimension].merge(sketch)
+    return dict((name, merged[dimension].count()) for dimension, name in SKETCH_DIMENSION.items())
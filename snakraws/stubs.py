@@ -0,0 +1,35 @@
+'''
+stubs.py holds the stand-in for outbound HTTP that management commands use when they drive the redirect and shorten
+paths in-process (run_benchmarks, export_redirects --verify), so that only Snakr and its database are exercised.
+'''
+
+STUB_IP = '75.76.77.78'
+
+STUB_HTML = b'<html><head><title>Benchmark</title>' \
+            b'<meta property="og:title" content="Benchmark page"/>' \
+            b'<meta property="og:description" content="A page for benchmarking"/>' \
+            b'<meta property="og:site_name" content="Example"/></head><body></body></html>'
+
+STUB_GEOLOCATION = {
+    'ip': STUB_IP, 'type': 'ipv4', 'continent_code': 'NA', 'continent_name': 'North America',
+    'country_code': 'US', 'country_name': 'United States', 'region_code': 'TX', 'region_name': 'Texas',
+    'city': 'Austin', 'zip': '78701', 'latitude': 30.27, 'longitude': -97.74,
+}
+
+
+class StubResponse:
+    """Stands in for every outbound requests.get(): geolocation lookups read .json(), metadata fetches read .content."""
+
+    status_code = 200
+    reason = 'OK'
+    headers = {'content-type': 'text/html; charset=utf-8'}
+    content = STUB_HTML
+
+    def __bool__(self):
+        return True
+
+    def json(self):
+        return dict(STUB_GEOLOCATION)
+
+    def getcode(self):
+        return self.status_code
@@ -0,0 +1,255 @@
+'''
+trending.py tracks which short URLs are being redirected to most right now, using bounded-memory Space-Saving
+heavy-hitter summaries over sliding time windows fed from the redirect path.
+
+Each worker process summarizes the redirects it serves itself, and a daemon thread publishes its top
+TRENDING_CAPACITY short URLs per window to the Django cache every TRENDING_PUBLISH_SECONDS, under a key listed in a
+shared registry. get_trending() merges the summaries of every worker still publishing, so all workers, and all nodes
+sharing the cache, give the same answer to within TRENDING_PUBLISH_SECONDS. A worker that stops publishing drops out
+of the merge with its counts once its key expires.
+'''
+
+import os
+import socket
+import threading
+import time
+
+from django.core.cache import cache
+
+from snakraws import settings
+from snakraws.logsinks import get_logger
+
+# window name: (bucket width in seconds, number of buckets)
+TRENDING_WINDOWS = {
+    '1m': (5, 12),
+    '1h': (60, 60),
+    '24h': (3600, 24),
+}
+
+DEFAULT_TRENDING_WINDOW = '1h'
+
+# cache key of the {worker: key of its published summaries} registry, and the prefix of those keys
+TRENDING_REGISTRY_KEY = 'snakraws_trending_workers'
+TRENDING_SUMMARY_KEY_PREFIX = 'snakraws_trending_'
+
+# published summaries expire after this many publish intervals without a refresh
+TRENDING_SUMMARY_TTL_INTERVALS = 3
+
+
+class _Bucket:
+    """The keys of a Space-Saving summary that share one count, linked in ascending count order."""
+
+    __slots__ = ('count', 'keys', 'prev', 'next')
+
+    def __init__(self, count, prev=None, next=None):
+        self.count = count
+        self.keys = {}
+        self.prev = prev
+        self.next = next
+        return
+
+
+class SpaceSaving:
+    """
+    Space-Saving heavy-hitter summary holding at most `capacity` counters. When a new key arrives and the summary is
+    full, it takes over the smallest counter and inherits its count as its overestimation error, so any key whose true
+    frequency exceeds total/capacity is guaranteed to be present.
+
+    The counters are kept in a stream summary: buckets of equal counts in a list sorted by count, so the smallest
+    counter is always the first bucket and adding one to a key only moves it to the next bucket. Both take O(1).
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counters = {}
+        self._buckets = {}
+        self._head = _Bucket(0)
+        return
+
+    def _link(self, key, count, node):
+        # node is a linked bucket with a lower count; the bucket for count is at most a few steps after it
+        while node.next is not None and node.next.count < count:
+            node = node.next
+        if node.next is not None and node.next.count == count:
+            bucket = node.next
+        else:
+            bucket = _Bucket(count, node, node.next)
+            if node.next is not None:
+                node.next.prev = bucket
+            node.next = bucket
+        bucket.keys[key] = None
+        self._buckets[key] = bucket
+        return
+
+    def _unlink(self, key):
+        # returns a bucket still linked with a lower count than the key's new one, to search forward from
+        bucket = self._buckets.pop(key)
+        del bucket.keys[key]
+        if bucket.keys:
+            return bucket
+        bucket.prev.next = bucket.next
+        if bucket.next is not None:
+            bucket.next.prev = bucket.prev
+        return bucket.prev
+
+    def add(self, key, count=1):
+        counter = self.counters.get(key, None)
+        if counter:
+            counter[0] += count
+            self._link(key, counter[0], self._unlink(key))
+        elif len(self.counters) < self.capacity:
+            self.counters[key] = [count, 0]
+            self._link(key, count, self._head)
+        else:
+            victim = next(iter(self._head.next.keys))
+            floor = self.counters.pop(victim)[0]
+            self.counters[key] = [floor + count, floor]
+            self._link(key, floor + count, self._unlink(victim))
+        return
+
+
+class SlidingWindow:
+    """A ring of per-bucket Space-Saving summaries covering width * buckets seconds."""
+
+    def __init__(self, width, buckets, capacity):
+        self.width = width
+        self.capacity = capacity
+        self.ring = [(None, None)] * buckets
+        return
+
+    def _bucket(self, now):
+        epoch = int(now // self.width)
+        slot = epoch % len(self.ring)
+        bucket_epoch, summary = self.ring[slot]
+        if bucket_epoch != epoch:
+            summary = SpaceSaving(self.capacity)
+            self.ring[slot] = (epoch, summary)
+        return summary
+
+    def add(self, key, now):
+        self._bucket(now).add(key)
+        return
+
+    def top(self, k, now):
+        oldest = int(now // self.width) - len(self.ring) + 1
+        totals = {}
+        for bucket_epoch, summary in self.ring:
+            if bucket_epoch is not None and bucket_epoch >= oldest:
+                for key, (count, error) in summary.counters.items():
+                    total = totals.setdefault(key, [0, 0])
+                    total[0] += count
+                    total[1] += error
+        ranked = sorted(totals.items(), key=lambda item: item[1][0], reverse=True)[:k]
+        return [(key, count, error) for key, (count, error) in ranked]
+
+
+class TrendingTracker:
+    """
+    Heavy hitters over the TRENDING_WINDOWS. Memory is bounded by TRENDING_CAPACITY counters per bucket no matter how
+    many short URLs exist. Each worker process counts the redirects it served itself and publishes them for top() to
+    merge with every other worker's.
+    """
+
+    def __init__(self):
+        self.capacity = getattr(settings, "TRENDING_CAPACITY", 200)
+        self.publish_seconds = getattr(settings, "TRENDING_PUBLISH_SECONDS", 10)
+        self.windows = dict((name, SlidingWindow(width, buckets, self.capacity))
+                            for name, (width, buckets) in TRENDING_WINDOWS.items())
+        self._lock = threading.Lock()
+        self._pid = None
+        self._worker = None
+        return
+
+    def _ensure_publisher(self):
+        # (re)start the publisher lazily, and again in each forked worker process, since threads don't survive a fork
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    # counts inherited across a fork were served by the parent, which publishes them itself
+                    self.windows = dict((name, SlidingWindow(width, buckets, self.capacity))
+                                        for name, (width, buckets) in TRENDING_WINDOWS.items())
+                    self._worker = '%s-%d' % (socket.gethostname(), os.getpid())
+                    threading.Thread(target=self._run, name="snakraws-trending-publisher", daemon=True).start()
+                    self._pid = os.getpid()
+        return
+
+    def _run(self):
+        while True:
+            time.sleep(self.publish_seconds)
+            try:
+                self.publish()
+            except Exception as e:
+                get_logger().warning('trending summaries not published: %s' % str(e))
+
+    def _snapshot(self):
+        now = time.time()
+        with self._lock:
+            return dict((name, window.top(self.capacity, now)) for name, window in self.windows.items())
+
+    def publish(self):
+        """Writes this worker's summaries to the cache, and lists the worker in the registry if it isn't yet."""
+        key = TRENDING_SUMMARY_KEY_PREFIX + self._worker
+        cache.set(key, self._snapshot(), timeout=self.publish_seconds * TRENDING_SUMMARY_TTL_INTERVALS)
+        registry = cache.get(TRENDING_REGISTRY_KEY) or {}
+        if registry.get(self._worker, None) != key:
+            # a concurrent registration can overwrite this one; it is simply made again on the next publish
+            registry[self._worker] = key
+            cache.set(TRENDING_REGISTRY_KEY, registry, timeout=None)
+        return
+
+    def observe(self, key):
+        self._ensure_publisher()
+        now = time.time()
+        with self._lock:
+            for window in self.windows.values():
+                window.add(key, now)
+        return
+
+    def top(self, window_name=DEFAULT_TRENDING_WINDOW, k=10):
+        """
+        Merges this worker's live summary of the window with those the other workers published, summing each short
+        URL's counts and errors. Falls back to this worker's alone if the cache can't be read.
+        """
+        window = self.windows[window_name]
+        with self._lock:
+            own = window.top(self.capacity, time.time())
+        summaries = [own]
+        try:
+            registry = cache.get(TRENDING_REGISTRY_KEY) or {}
+            others = dict((worker, key) for worker, key in registry.items() if worker != self._worker)
+            published = cache.get_many(list(others.values()))
+            summaries += [published[key][window_name] for key in others.values() if key in published]
+            expired = [worker for worker, key in others.items() if key not in published]
+            if expired:
+                # workers that stopped publishing; re-read so registrations made meanwhile aren't dropped
+                registry = cache.get(TRENDING_REGISTRY_KEY) or {}
+                for worker in expired:
+                    registry.pop(worker, None)
+                cache.set(TRENDING_REGISTRY_KEY, registry, timeout=None)
+        except Exception as e:
+            get_logger().warning('trending summaries of other workers not read: %s' % str(e))
+        totals = {}
+        for summary in summaries:
+            for key, count, error in summary:
+                total = totals.setdefault(key, [0, 0])
+                total[0] += count
+                total[1] += error
+        ranked = sorted(totals.items(), key=lambda item: item[1][0], reverse=True)[:k]
+        return [(key, count, error) for key, (count, error) in ranked]
+
+
+trending = TrendingTracker()
+
+
+def track_redirect(shorturl):
+    if getattr(settings, "ENABLE_TRENDING", True):
+        trending.observe(shorturl)
+    return
+
+
+def get_trending(window_name=DEFAULT_TRENDING_WINDOW, k=10):
+    """
+    Returns up to k (shorturl, count, error) tuples for the window across every worker, highest count first; count -
+    error is a lower bound.
+    """
+    return trending.top(window_name, k)
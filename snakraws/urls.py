@@ -33,7 +33,18 @@ urlpatterns = [
     re_path(r'^accounts/login/$', LoginView.as_view(template_name='login.html', extra_context=login_extra_context), name="login"),
     re_path(r'^accounts/logout/$', LogoutView.as_view(template_name='logout.html', extra_context=logout_extra_context), name="logout"),
     re_path(r'^accounts/profile/$', lambda r: HttpResponsePermanentRedirect(get_shortening_redirect(), content_type="text/html")),
+    re_path(r'^profiler/?$', views.profiler_handler, name="profiler_handler"),
+    re_path(r'^metrics/?$', views.metrics_handler, name="metrics_handler"),
+    re_path(r'^api/queries/?$', views.queries_handler, name="queries_handler"),
+    re_path(r'^api/vanity/?$', views.vanity_handler, name="vanity_handler"),
+    re_path(r'^api/stats/?$', views.stats_handler, name="stats_handler"),
+    re_path(r'^api/trending/?$', views.trending_api_handler, name="trending_api_handler"),
+    re_path(r'^trending/?$', views.trending_handler, name="trending_handler"),
     re_path(r'^api/$', csrf_exempt(views.api_handler), name="api_handler"),
     re_path(r'^api$', csrf_exempt(views.api_handler), name="api_handler"),
     re_path(r'^.*$', csrf_exempt(views.request_handler)),
 ]
+
+if getattr(settings, "SITE_MODE", "prod") == "dev":
+    # local Measurement Protocol stub for exercising the Google Analytics forwarder without sending real hits
+    urlpatterns.insert(-1, re_path(r'^ga-stub/batch$', csrf_exempt(views.ga_stub_handler), name="ga_stub_handler"))
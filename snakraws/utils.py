@@ -6,6 +6,7 @@ import re
 import random
 import json
 import mimetypes
+from functools import lru_cache
 from urllib.parse import urlparse, quote, unquote
 from string import digits
 import requests
@@ -21,6 +22,9 @@ from validator_collection.errors import InvalidURLError
 
 from bs4 import BeautifulSoup
 
+from snakraws.metrics import timed
+from snakraws.profanity import BAD_THREE_LETTER_WORD, PROFANE, VerdictStore, get_verdict_version, package_version
+
 
 # DO NOT CHANGE THESE CONSTANTS AT ALL EVER
 # See http://www.isthe.com/chongo/tech/comp/fnv/index.html for math-y details.
@@ -289,7 +293,21 @@ def is_shortpath_valid(shortpath):
     return True
 
 
-def is_url_valid(test):
+def _is_url_structurally_valid(test):
+    # cheap checks that reject what the validator certainly would, before its regex runs
+    if not isinstance(test, str) or not test:
+        return False
+    try:
+        parts = urlparse(test)
+        return bool(parts.netloc) and bool(parts.hostname)
+    except ValueError:
+        return False
+
+
+@lru_cache(maxsize=getattr(settings, "URL_VALIDATION_CACHE_SIZE", 10000))
+def _is_url_valid(test):
+    if not _is_url_structurally_valid(test):
+        return False
     is_valid = False
     try:
         # 2-21-2019 bml workaround for current bug in validator-collection v1.3.2 (reported as issue #28)
@@ -303,6 +321,25 @@ def is_url_valid(test):
     return is_valid
 
 
+def is_url_valid(test):
+    """True if `test` is a valid URL. Verdicts are memoized per process, as the same URLs are validated repeatedly."""
+    if not isinstance(test, str):
+        return False
+    return _is_url_valid(test)
+
+
+def validate_urls(urls):
+    """
+    is_url_valid for many URLs at once, e.g. for bulk imports: returns {url: verdict}, validating each distinct URL
+    once and without filling the per-process memo with URLs that are unlikely to be seen again.
+    """
+    verdicts = {}
+    for url in urls:
+        if url not in verdicts:
+            verdicts[url] = _is_url_structurally_valid(url) and _is_url_valid.__wrapped__(url)
+    return verdicts
+
+
 def urlparts(url="http://www.dummyurl.com"):
     return urlparse(url)
 
@@ -406,6 +443,46 @@ def get_all_substrings(input_string, min_length=1):
         return ""
 
 
+def _score_profanity(tokens):
+    """Verdict flags for URL parts no verdict tier has yet: the costly part of is_profane."""
+    substrings = {}
+    verdicts = {}
+    for token in tokens:
+        substrings[token] = [substring for substring in get_all_substrings(token, 2) if len(substring) > 0]
+        verdicts[token] = BAD_THREE_LETTER_WORD \
+            if any(substring in BAD_THREE_LETTER_WORDS for substring in substrings[token]) else 0
+    stringlist = list(dict.fromkeys(substring for token in tokens for substring in substrings[token]))  # removes dupes
+    if stringlist:
+        scores = dict(zip(stringlist, PredictProfanity(stringlist)))
+        for token in tokens:
+            if any(scores[substring] == 1 for substring in substrings[token]):
+                verdicts[token] |= PROFANE
+    unflagged = [token for token in tokens if not verdicts[token] & PROFANE]
+    if unflagged and getattr(settings, "ENABLE_DEEP_PROFANITY_CHECKING", True):
+        pf = ProfanityFilter()
+        for token in unflagged:
+            if any(pf.is_profane(substring) for substring in substrings[token]):
+                verdicts[token] |= PROFANE
+    return verdicts
+
+
+_profanity_verdicts = None
+
+
+def get_profanity_verdicts():
+    global _profanity_verdicts
+    if _profanity_verdicts is None:
+        _profanity_verdicts = VerdictStore(get_verdict_version(
+                package_version('profanity-check'),
+                package_version('profanity-filter'),
+                BAD_THREE_LETTER_WORDS,
+                getattr(settings, "ENABLE_DEEP_PROFANITY_CHECKING", True),
+                getattr(settings, "PROFANITY_WORDLIST_VERSION", 1),
+        ))
+    return _profanity_verdicts
+
+
+@timed('is_profane')
 def is_profane(url):
 
     if len(url) < 3:
@@ -423,33 +500,16 @@ def is_profane(url):
             partslist = partslist + re.split(splitters, parts.path)
         if parts.query:
             partslist = partslist + re.split(splitters, parts.query)
+        partslist = list(dict.fromkeys(item for item in partslist if len(item) > 0))  # removes dupes
 
         # speed optimization
-        check4btlw = True
-        stringlist = []
-        for item in partslist:
-            if len(item) > 0:
-                if len(item) > 5:
-                    check4btlw = False
-                for substring in get_all_substrings(item, 2):
-                    if len(substring) > 0:
-                        stringlist.append(substring)
-        partslist = list(dict.fromkeys(stringlist))  # removes dupes
-
-        if check4btlw:
-            for part in partslist:
-                if part in BAD_THREE_LETTER_WORDS:
-                    return True
-
-        score = PredictProfanity(partslist)
-        if score.any() == 1:
-            return True
+        check4btlw = all(len(item) <= 5 for item in partslist)
 
-        if getattr(settings, "ENABLE_DEEP_PROFANITY_CHECKING", True):
-            pf = ProfanityFilter()
-            for part in partslist:
-                if pf.is_profane(part):
-                    return True
+        # verdicts are remembered per URL part, so only parts never seen before are scored
+        verdicts = get_profanity_verdicts().get_many(partslist, _score_profanity)
+        for item in partslist:
+            if verdicts[item] & PROFANE or (check4btlw and verdicts[item] & BAD_THREE_LETTER_WORD):
+                return True
 
     return False
 
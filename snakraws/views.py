@@ -6,17 +6,28 @@ import json
 
 from django.template import RequestContext
 from django.shortcuts import render
-from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, QueryDict
 from django.utils.translation import ugettext_lazy as _
 from django.forms.forms import NON_FIELD_ERRORS
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.utils.safestring import mark_safe
 
 from snakraws import settings
-from snakraws.shorturls import ShortURL
+from snakraws.shorturls import ShortURL, taken_vanity_paths, suggest_vanity_paths
 from snakraws.longurls import LongURL
-from snakraws.forms import ShortForm
-from snakraws.utils import get_message, get_json, fit_text
+from snakraws.forms import ShortForm, VANITY_PATH_PATTERN, VANITY_PATH_MIN_SIZE
+from snakraws.models import ShortURLs
+from snakraws.counters import get_click_count, get_top_clicked
+from snakraws.sketches import get_unique_visitors
+from snakraws.trending import get_trending, TRENDING_WINDOWS, DEFAULT_TRENDING_WINDOW
+from snakraws.metrics import timer, render_prometheus, METRICS_ENABLED
+from snakraws.middleware import recent_profiles
+from snakraws.profiler import profiler
+from snakraws.ratelimits import client_ip, rate_limited, rate_limiter
+from snakraws.previews import preview_response
+from snakraws.httpcache import conditional_redirect
+from snakraws.utils import get_message, get_json, fit_text, get_shorturlhash, is_shortpath_valid
 from snakraws.__init__ import VERSION
 
 
@@ -26,9 +37,9 @@ def homepage(request, template_name="homepage.html"):
 
 def request_handler(request):
     if request.method == "POST":
-        return post_handler(request)
+        return rate_limiter.check(request, 'shorten') or post_handler(request)
     elif request.method == "GET":
-        return get_handler(request)
+        return rate_limiter.check(request, 'redirect') or preview_response(request) or get_handler(request)
     else:
         return HttpResponseBadRequest(get_message("MALFORMED_REQUEST"))
 
@@ -43,6 +54,8 @@ def get_handler(request):
     # lookup the long url previously used to generate the short url
     #
     l, redirect_status_code = s.get_long(request)
+    if s.not_modified is not None:
+        return s.not_modified
     #
     # if found, redirect to it; otherwise, 404
     #
@@ -51,41 +64,43 @@ def get_handler(request):
         public_version = VERSION
         ga_enabled = getattr(settings, "ENABLE_GOOGLE_ANALYTICS", False)
         ga_id = getattr(settings, "GOOGLE_ANALYTICS_WEB_PROPERTY_ID", "")
-        if redirect_status_code == 991:
-            # return /last/ref
-            return render(
-                    request,
-                    'lastref.html',
-                    {
-                        'ga_enabled': ga_enabled,
-                        'ga_id': ga_id,
-                        'inpage': mark_safe(l),
-                        'shorturl': mark_safe(s.normalized_shorturl),
-                        'verbose_name': public_name,
-                        'version': public_version,
-                        'status_code': 200
-                    }
-            )
-        else:
-            return render(
-                    request,
-                    'redirectr.html',
-                    {
-                        'ga_enabled': ga_enabled,
-                        'ga_id': ga_id,
-                        'image_url': mark_safe(l.image_url),
-                        'inpage': l.description,
-                        'longurl': mark_safe(l.longurl),
-                        'longurl_byline': l.byline,
-                        'longurl_description': l.description,
-                        'longurl_site_name': l.site_name,
-                        'longurl_title': l.title,
-                        'shorturl': mark_safe(s.normalized_shorturl),
-                        'status_code': redirect_status_code,
-                        'verbose_name': public_name,
-                        'version': public_version,
-                    }
-            )
+        with timer('render'):
+            if redirect_status_code == 991:
+                # return /last/ref
+                return render(
+                        request,
+                        'lastref.html',
+                        {
+                            'ga_enabled': ga_enabled,
+                            'ga_id': ga_id,
+                            'inpage': mark_safe(l),
+                            'shorturl': mark_safe(s.normalized_shorturl),
+                            'verbose_name': public_name,
+                            'version': public_version,
+                            'status_code': 200
+                        }
+                )
+            else:
+                response = render(
+                        request,
+                        'redirectr.html',
+                        {
+                            'ga_enabled': ga_enabled,
+                            'ga_id': ga_id,
+                            'image_url': mark_safe(l.image_url),
+                            'inpage': l.description,
+                            'longurl': mark_safe(l.longurl),
+                            'longurl_byline': l.byline,
+                            'longurl_description': l.description,
+                            'longurl_site_name': l.site_name,
+                            'longurl_title': l.title,
+                            'shorturl': mark_safe(s.normalized_shorturl),
+                            'status_code': redirect_status_code,
+                            'verbose_name': public_name,
+                            'version': public_version,
+                        }
+                )
+                return conditional_redirect(request, response, s.id, s.version, s.modified_on, s.cache_max_age)
 
     return Http404
 
@@ -93,6 +108,8 @@ def get_handler(request):
 def post_handler(request, **kwargs):
     lu = None
     vp = None
+    bl = None
+    de = None
     form = kwargs.pop('form', None)
     if form:
         if "longurl" in form.cleaned_data:
@@ -155,6 +172,7 @@ def test_post_handler(request, *args, **kwargs):
     return HttpResponse("<H2>Test value: {%s}</H2>", content_type="text/html")
 
 
+@rate_limited('shorten', methods=('POST',))
 @login_required
 def form_handler(request, *args, **kwargs):
     message = ""
@@ -185,30 +203,174 @@ def form_handler(request, *args, **kwargs):
     sitekey = getattr(settings, "RECAPTCHA_PUBLIC_KEY", "")
     submit_label = _("Shorten It")
     action = _("shorten_url")
+    with timer('render'):
+        return render(
+                request,
+                'shorten_url.html',
+                {
+                    'action': action,
+                    'debug': debug,
+                    'form': form,
+                    'heading': heading,
+                    'message': message,
+                    'post_byline': post_byline,
+                    'post_description': post_description,
+                    'post_image_url': post_image_url,
+                    'post_title': post_title,
+                    'shorturl': shorturl,
+                    'sitekey': sitekey,
+                    'title': title,
+                    'submit_label': submit_label,
+                }
+        )
+
+
+@rate_limited('api')
+def api_handler(request):
+    if request.method == "POST":
+        if get_json(request, 'lu'):
+            return post_handler(request)
+    return HttpResponseForbidden(_("Invalid Request"))
+
+
+@rate_limited('api')
+@login_required
+def vanity_handler(request):
+    """Whether the vanity path in ?vp= is free to use and, if it isn't, some free alternatives; used by the form."""
+    vp = request.GET.get('vp', '').strip()
+    if not vp or len(vp) > 40:
+        return HttpResponseBadRequest(get_message("MALFORMED_REQUEST"))
+    response_data = {'vp': vp}
+    if len(vp) < VANITY_PATH_MIN_SIZE or not VANITY_PATH_PATTERN.match(vp):
+        response_data['available'] = False
+        response_data['reason'] = 'invalid'
+    elif taken_vanity_paths([vp]):
+        response_data['available'] = False
+        response_data['reason'] = 'taken'
+    elif not is_shortpath_valid(vp):
+        response_data['available'] = False
+        response_data['reason'] = 'reserved'
+    else:
+        response_data['available'] = True
+    response_data['suggestions'] = [] if response_data['available'] else suggest_vanity_paths(vp)
+    return HttpResponse(json.dumps(response_data), content_type="application/json")
+
+
+@login_required
+def stats_handler(request):
+    if request.method != "GET":
+        return HttpResponseBadRequest(get_message("MALFORMED_REQUEST"))
+    su = request.GET.get('su', None)
+    response_data = {}
+    if su:
+        s = ShortURLs.objects.filter(hash=get_shorturlhash(su.strip())).first()
+        if not s:
+            raise Http404
+        response_data['shorturl'] = s.shorturl
+        response_data['clicks'] = get_click_count(s.id)
+        response_data['visitors'] = get_unique_visitors(s.id, request.GET.get('from', None), request.GET.get('to', None))
+    else:
+        try:
+            limit = min(max(int(request.GET.get('top', 10)), 1), 1000)
+        except ValueError:
+            return HttpResponseBadRequest(get_message("MALFORMED_REQUEST"))
+        response_data['top'] = [{'shorturl': shorturl, 'clicks': clicks} for shorturl, clicks in get_top_clicked(limit)]
+    return HttpResponse(json.dumps(response_data), content_type="application/json")
+
+
+@login_required
+def trending_api_handler(request):
+    window = request.GET.get('window', DEFAULT_TRENDING_WINDOW)
+    try:
+        k = min(max(int(request.GET.get('k', 10)), 1), 100)
+    except ValueError:
+        return HttpResponseBadRequest(get_message("MALFORMED_REQUEST"))
+    if window not in TRENDING_WINDOWS:
+        return HttpResponseBadRequest(get_message("MALFORMED_REQUEST"))
+    response_data = {
+        'window': window,
+        'top': [{'shorturl': shorturl, 'count': count, 'error': error} for shorturl, count, error in get_trending(window, k)]
+    }
+    return HttpResponse(json.dumps(response_data), content_type="application/json")
+
+
+@staff_member_required
+def trending_handler(request):
+    title = getattr(settings, "PAGE_TITLE", settings.VERBOSE_NAME)
+    heading = getattr(settings, "PAGE_HEADING", settings.VERBOSE_NAME)
+    windows = [(name, get_trending(name, 25)) for name in sorted(TRENDING_WINDOWS, key=lambda n: TRENDING_WINDOWS[n][0])]
     return render(
             request,
-            'shorten_url.html',
+            'trending.html',
             {
-                'action': action,
-                'debug': debug,
-                'form': form,
                 'heading': heading,
-                'message': message,
-                'post_byline': post_byline,
-                'post_description': post_description,
-                'post_image_url': post_image_url,
-                'post_title': post_title,
-                'shorturl': shorturl,
-                'sitekey': sitekey,
                 'title': title,
-                'submit_label': submit_label,
+                'windows': windows,
             }
     )
 
 
-def api_handler(request):
+def metrics_handler(request):
+    """
+    Prometheus scrape endpoint; open to staff users and to the IPs in METRICS_ALLOWED_IPS. The IP is the client_ip()
+    rate limiting uses, so behind a load balancer in TRUSTED_PROXIES it is the scraper's, not the balancer's.
+    """
+    if not METRICS_ENABLED:
+        raise Http404
+    if not request.user.is_staff:
+        ip = client_ip(request)
+        if ip is None or str(ip) not in getattr(settings, "METRICS_ALLOWED_IPS", ['127.0.0.1', '::1']):
+            return HttpResponseForbidden(_("Invalid Request"))
+    return HttpResponse(render_prometheus(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@staff_member_required
+def queries_handler(request):
+    """The SQL profiles of the most recent requests served by this process, newest first."""
+    try:
+        limit = min(max(int(request.GET.get('n', 20)), 1), recent_profiles.maxlen)
+    except ValueError:
+        return HttpResponseBadRequest(get_message("MALFORMED_REQUEST"))
+    profiles = list(recent_profiles)[-limit:]
+    profiles.reverse()
+    return HttpResponse(json.dumps({'requests': profiles}), content_type="application/json")
+
+
+@staff_member_required
+def profiler_handler(request):
+    """
+    GET returns the sampling profiler's status in the worker that served it; POST starts a profile of that worker,
+    e.g. seconds=30&interval_ms=5, and needs the CSRF token like any other staff POST. Only available when
+    ENABLE_SAMPLING_PROFILER is True.
+    """
+    if not getattr(settings, "ENABLE_SAMPLING_PROFILER", False):
+        raise Http404
     if request.method == "POST":
-        if get_json(request, 'lu'):
-            return post_handler(request)
-    return HttpResponseForbidden(_("Invalid Request"))
+        try:
+            seconds = float(request.POST.get('seconds', 10))
+            interval_ms = float(request.POST.get('interval_ms', 0)) or None
+        except ValueError:
+            return HttpResponseBadRequest(get_message("MALFORMED_REQUEST"))
+        response_data = profiler.status()
+        response_data['started_now'] = profiler.start(seconds, interval_ms)
+        if response_data['started_now']:
+            response_data.update(profiler.status())
+        return HttpResponse(json.dumps(response_data), content_type="application/json")
+    return HttpResponse(json.dumps(profiler.status()), content_type="application/json")
+
+
+# hits received by ga_stub_handler, newest last; only used in dev mode
+GA_STUB_HITS = []
 
+
+def ga_stub_handler(request):
+    """
+    Local stand-in for the Measurement Protocol batch endpoint (dev mode only). Point GOOGLE_ANALYTICS_ENDPOINT at it;
+    POSTed hits are kept in memory and a GET returns the most recent ones as JSON.
+    """
+    if request.method == "POST":
+        hits = [QueryDict(line).dict() for line in request.body.decode('utf8').splitlines() if line]
+        GA_STUB_HITS.extend(hits)
+        del GA_STUB_HITS[:-1000]
+        return HttpResponse(json.dumps({'hits': len(hits)}), content_type="application/json")
+    return HttpResponse(json.dumps({'hits': GA_STUB_HITS}), content_type="application/json")